@@ -0,0 +1,373 @@
+"""
+A local stand-in for the MBTA API, for development, testing and load testing without
+network access or API quota.
+
+Serves synthetic vehicles and predictions as JSON:API documents (with page[offset]/
+page[limit] paging) and, when asked for text/event-stream, as a live stream of
+reset/add/update/remove events. Run it with 'manage.py run_fake_api' and point
+MBTA_API_ROOT at it.
+
+Other paths are served from fixtures (see Fixtures): recorded documents, or synthetic
+resources generated from a spec of each object's attributes and relationships, which
+run_fake_api takes from the params tables. Included resources (include=...) and sparse
+fieldsets (fields[type]=...) are supported.
+
+Latency, jitter, server errors and rate limiting can be simulated (see Behaviour). Like
+the real API, responses report the rate limit in x-ratelimit-* headers (see RateWindow).
+"""
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import datetime
+import json
+import math
+import os
+import random
+import threading
+import time
+
+
+RESOURCE_TYPES = {
+    '/vehicles': 'vehicle',
+    '/predictions': 'prediction',
+}
+
+
+class FakeData:
+    """ The current state of the fake resources, which drift when the clock ticks """
+
+    def __init__(self, count: int, seed: int = 0):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.resources = {resource_type: {} for resource_type in RESOURCE_TYPES.values()}
+        for _ in range(count):
+            for resource_type in self.resources:
+                self.add(resource_type)
+
+    def add(self, resource_type: str) -> dict:
+        i = self.next_id
+        self.next_id += 1
+        if resource_type == 'vehicle':
+            resource = {
+                'type': 'vehicle',
+                'id': f'y{i}',
+                'attributes': {
+                    'label': str(1000 + i),
+                    'latitude': 42.35 + self.random.uniform(-0.1, 0.1),
+                    'longitude': -71.06 + self.random.uniform(-0.1, 0.1),
+                    'bearing': self.random.randrange(360),
+                    'speed': None,
+                    'current_status': 'IN_TRANSIT_TO',
+                    'updated_at': now(),
+                },
+                'relationships': {
+                    'route': {'data': {'type': 'route', 'id': str(self.random.randrange(1, 120))}},
+                    'trip': {'data': {'type': 'trip', 'id': f't{i}'}},
+                    'stop': {'data': None},
+                },
+            }
+        else:
+            resource = {
+                'type': 'prediction',
+                'id': f'prediction-{i}',
+                'attributes': {
+                    'arrival_time': now(minutes=self.random.randrange(1, 30)),
+                    'departure_time': None,
+                    'direction_id': self.random.randrange(2),
+                    'status': None,
+                },
+                'relationships': {
+                    'route': {'data': {'type': 'route', 'id': str(self.random.randrange(1, 120))}},
+                    'stop': {'data': {'type': 'stop', 'id': str(self.random.randrange(1, 5000))}},
+                    'vehicle': {'data': None},
+                },
+            }
+        self.resources[resource_type][resource['id']] = resource
+        return resource
+
+    def tick(self, resource_type: str):
+        """ Change something, and return the (event, resource) describing it """
+        with self.lock:
+            resources = self.resources[resource_type]
+            roll = self.random.random()
+            if roll < 0.05 or not resources:
+                return 'add', self.add(resource_type)
+            resource = resources[self.random.choice(list(resources))]
+            if roll < 0.1:
+                del resources[resource['id']]
+                return 'remove', {'type': resource_type, 'id': resource['id']}
+            attributes = resource['attributes']
+            if resource_type == 'vehicle':
+                attributes['latitude'] += self.random.uniform(-0.002, 0.002)
+                attributes['longitude'] += self.random.uniform(-0.002, 0.002)
+                attributes['updated_at'] = now()
+            else:
+                attributes['arrival_time'] = now(minutes=self.random.randrange(1, 30))
+            return 'update', resource
+
+    def list(self, resource_type: str) -> list:
+        with self.lock:
+            return [json.loads(json.dumps(r)) for r in self.resources[resource_type].values()]
+
+
+class Fixtures:
+    """
+    Documents for paths which aren't served from the live data.
+
+    specs maps paths to {'type': resource type, 'attributes': {name: (data_type, data_format)},
+    'relationships': {name: related resource type}}, and 'count' resources are generated
+    for each (or counts[path]). Recorded documents take precedence. They're read from a
+    directory laid out like the paths, e.g. 'stops.json' for /stops and 'routes/1.json'
+    for /routes/1.
+    """
+
+    def __init__(self, specs: dict = None, recorded_dir: str = None, count: int = 100,
+                 counts: dict = None, seed: int = 0):
+        rng = random.Random(seed)
+        specs = specs or {}
+        counts = counts or {}
+        sizes = {spec['type']: counts.get(path, count) for path, spec in specs.items()}
+        self.data = {}
+        self.resources = {}
+        for path, spec in specs.items():
+            self.data[path] = [synthetic_resource(spec, i, rng, sizes) for i in range(sizes[spec['type']])]
+            self.index(self.data[path])
+        for directory, _, filenames in os.walk(recorded_dir) if recorded_dir else ():
+            for filename in sorted(f for f in filenames if f.endswith('.json')):
+                filepath = os.path.join(directory, filename)
+                with open(filepath) as f:
+                    document = json.load(f)
+                path = os.path.relpath(filepath, recorded_dir)[:-len('.json')].replace(os.sep, '/')
+                data = document.get('data') or []
+                self.data[f'/{path}'] = data if isinstance(data, list) else [data]
+                self.index(document.get('included') or [])
+
+    def index(self, resources: list) -> None:
+        for resource in resources:
+            self.resources[(resource['type'], resource['id'])] = resource
+
+    def included(self, resources: list, include: str) -> list:
+        """ The resources which the included relationships of some resources refer to """
+        names = {name.split('.')[0] for name in include.split(',') if name}
+        found = {}
+        for resource in resources:
+            for name, relationship in (resource.get('relationships') or {}).items():
+                if name not in names:
+                    continue
+                refs = relationship.get('data')
+                for ref in (refs if isinstance(refs, list) else [refs]):
+                    if ref and (ref['type'], ref['id']) in self.resources:
+                        found[(ref['type'], ref['id'])] = self.resources[(ref['type'], ref['id'])]
+        return list(found.values())
+
+
+def synthetic_resource(spec: dict, i: int, rng: random.Random, sizes: dict) -> dict:
+    """ A resource with a plausible value of each attribute's type """
+    return {
+        'type': spec['type'],
+        'id': str(i),
+        'attributes': {
+            name: synthetic_value(name, data_type, data_format, rng)
+            for name, (data_type, data_format) in spec['attributes'].items()
+        },
+        'relationships': {
+            name: {'data': {'type': related_type, 'id': str(rng.randrange(sizes.get(related_type, 100)))}}
+            for name, related_type in spec['relationships'].items()
+        },
+    }
+
+
+def synthetic_value(name: str, data_type: str, data_format: str, rng: random.Random):
+    if rng.random() < 0.05:
+        return None
+    if name == 'latitude':
+        return 42.35 + rng.uniform(-0.1, 0.1)
+    if name == 'longitude':
+        return -71.06 + rng.uniform(-0.1, 0.1)
+    if data_type == 'string' and data_format == 'date-time':
+        return now(minutes=rng.randrange(-60, 60))
+    if data_type == 'integer':
+        return rng.randrange(100)
+    if data_type == 'number':
+        return rng.uniform(0, 100)
+    if data_type == 'boolean':
+        return rng.random() < 0.5
+    if data_type == 'array' and name == 'properties':
+        # Like facilities' properties, which are flattened into columns by name
+        return [{'name': f'property-{rng.randrange(5)}', 'value': rng.randrange(10)}
+                for _ in range(rng.randrange(3))]
+    if data_type == 'array':
+        return [f'{name}-{rng.randrange(10)}' for _ in range(rng.randrange(3))]
+    if data_type == 'object':
+        return {'value': rng.randrange(10)}
+    return f'{name}-{rng.randrange(50)}'
+
+
+# Seconds of latency (give or take up to 'jitter'), the fractions of document requests
+# which fail with a server error or are rate limited (429, with Retry-After), and the
+# rate limit: 'rate_limit' document requests per 'rate_window' seconds, like an API key's
+Behaviour = namedtuple(
+    'Behaviour', ['latency', 'jitter', 'error_rate', 'throttle_rate', 'rate_limit', 'rate_window'])
+Behaviour.__new__.__defaults__ = (0.0, 0.0, 0.0, 0.0, 1000, 60.0)
+
+
+class RateWindow:
+    """ Counts requests against the rate limit, like the real API, which reports it in the
+        x-ratelimit-limit, -remaining and -reset (a Unix time) headers of every response """
+
+    def __init__(self, limit: int, seconds: float):
+        self.limit = limit
+        self.seconds = seconds
+        self.remaining = limit
+        self.reset = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Spend one request. Returns whether that was possible, and the headers to send. """
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.remaining = self.limit
+                self.reset = math.ceil(now + self.seconds)
+            allowed = self.remaining > 0
+            if allowed:
+                self.remaining -= 1
+            headers = {
+                'x-ratelimit-limit': str(self.limit),
+                'x-ratelimit-remaining': str(self.remaining),
+                'x-ratelimit-reset': str(self.reset),
+            }
+            if not allowed:
+                headers['Retry-After'] = str(max(math.ceil(self.reset - now), 1))
+            return allowed, headers
+
+
+def now(minutes: int = 0) -> str:
+    moment = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=minutes)
+    return moment.replace(microsecond=0).isoformat()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    data = None
+    fixtures = Fixtures()
+    behaviour = Behaviour()
+    rate_window = RateWindow(Behaviour().rate_limit, Behaviour().rate_window)
+    random = random.Random(0)
+    tick_seconds = 1.0
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        resource_type = RESOURCE_TYPES.get(path)
+        if 'text/event-stream' in self.headers.get('Accept', ''):
+            if resource_type is None:
+                self.send_json(404, {'errors': [{'status': '404', 'code': 'not_found'}]})
+            else:
+                self.send_stream(resource_type)
+            return
+
+        self.wait()
+        allowed, headers = self.rate_window.take()
+        roll = self.random.random()
+        if not allowed:
+            self.send_json(429, {'errors': [{'status': '429', 'code': 'rate_limited'}]}, headers)
+        elif roll < self.behaviour.error_rate:
+            self.send_json(500, {'errors': [{'status': '500', 'code': 'internal_error'}]}, headers)
+        elif roll < self.behaviour.error_rate + self.behaviour.throttle_rate:
+            self.send_json(429, {'errors': [{'status': '429', 'code': 'rate_limited'}]},
+                           dict(headers, **{'Retry-After': '1'}))
+        elif path in self.fixtures.data:
+            self.send_document(self.fixtures.data[path], parse_qs(url.query), headers)
+        elif resource_type is not None:
+            self.send_document(self.data.list(resource_type), parse_qs(url.query), headers)
+        else:
+            self.send_json(404, {'errors': [{'status': '404', 'code': 'not_found'}]}, headers)
+
+    def wait(self) -> None:
+        delay = self.behaviour.latency + self.random.uniform(-self.behaviour.jitter, self.behaviour.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def send_document(self, resources: list, query: dict, headers: dict = None) -> None:
+        document = {'jsonapi': {'version': '1.0'}}
+        if 'page[limit]' in query:
+            limit = max(int(query['page[limit]'][0]), 1)
+            offset = int(query.get('page[offset]', ['0'])[0])
+            last_offset = max(len(resources) - 1, 0) // limit * limit
+            document['links'] = {
+                'first': f'{self.path_only()}?page[offset]=0&page[limit]={limit}',
+                'last': f'{self.path_only()}?page[offset]={last_offset}&page[limit]={limit}',
+            }
+            resources = resources[offset:offset + limit]
+        document['data'] = resources
+        if 'include' in query:
+            document['included'] = self.fixtures.included(resources, query['include'][0])
+        fields = {key[len('fields['):-1]: value[0].split(',') for key, value in query.items()
+                  if key.startswith('fields[') and key.endswith(']')}
+        if fields:
+            document['data'] = sparse(document['data'], fields)
+            document['included'] = sparse(document.get('included', []), fields)
+        self.send_json(200, document, headers)
+
+    def send_stream(self, resource_type: str) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            self.send_event('reset', self.data.list(resource_type))
+            while True:
+                time.sleep(self.tick_seconds)
+                self.send_event(*self.data.tick(resource_type))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_event(self, event: str, payload) -> None:
+        self.wfile.write(f'event: {event}\ndata: {json.dumps(payload)}\n\n'.encode())
+        self.wfile.flush()
+
+    def send_json(self, status: int, document: dict, headers: dict = None) -> None:
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.api+json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def path_only(self) -> str:
+        return urlsplit(self.path).path
+
+
+def sparse(resources: list, fields: dict) -> list:
+    """ Resources with only the attributes asked for with fields[type] """
+    trimmed = []
+    for resource in resources:
+        if resource['type'] in fields:
+            names = fields[resource['type']]
+            attributes = resource.get('attributes') or {}
+            resource = dict(resource, attributes={n: attributes[n] for n in names if n in attributes})
+        trimmed.append(resource)
+    return trimmed
+
+
+def make_server(host: str = '127.0.0.1', port: int = 8001, count: int = 100,
+                tick_seconds: float = 1.0, seed: int = 0, fixtures: Fixtures = None,
+                behaviour: Behaviour = None) -> ThreadingHTTPServer:
+    behaviour = behaviour or Behaviour()
+    handler = type('FakeApiHandler', (Handler,), {
+        'data': FakeData(count, seed),
+        'fixtures': fixtures or Fixtures(),
+        'behaviour': behaviour,
+        'rate_window': RateWindow(behaviour.rate_limit, behaviour.rate_window),
+        'random': random.Random(seed),
+        'tick_seconds': tick_seconds,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
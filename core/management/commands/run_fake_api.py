@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand, CommandError
+from core import fake_api
+from params.models import MbtaObject
+from queries.schema import resource_type
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the MBTA API (point MBTA_API_ROOT at it)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--count', type=int, default=100,
+                            help='Number of resources of each type')
+        parser.add_argument('--count-for', action='append', default=[], metavar='PATH=COUNT',
+                            help='Number of resources for one path, e.g. /stops=5000 (repeatable)')
+        parser.add_argument('--fixtures', default=None, metavar='DIR',
+                            help='Directory of recorded documents, laid out like the paths (stops.json for /stops)')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Milliseconds to wait before responding')
+        parser.add_argument('--jitter', type=float, default=0.0,
+                            help='Milliseconds by which the latency varies, either way')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of requests which fail with a server error')
+        parser.add_argument('--throttle-rate', type=float, default=0.0,
+                            help='Fraction of requests which are rate limited (429)')
+        parser.add_argument('--rate-limit', type=int, default=1000,
+                            help='Requests allowed per rate limit window, reported in x-ratelimit-* headers')
+        parser.add_argument('--rate-window', type=float, default=60.0,
+                            help='Seconds in each rate limit window')
+        parser.add_argument('--tick', type=float, default=1.0,
+                            help='Seconds between events on live streams')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            counts = {path: int(count) for path, count in (c.split('=', 1) for c in options['count_for'])}
+        except ValueError:
+            raise CommandError('--count-for takes PATH=COUNT, e.g. /stops=5000')
+        fixtures = fake_api.Fixtures(
+            specs=object_specs(),
+            recorded_dir=options['fixtures'],
+            count=options['count'],
+            counts=counts,
+            seed=options['seed'],
+        )
+        behaviour = fake_api.Behaviour(
+            latency=options['latency'] / 1000,
+            jitter=options['jitter'] / 1000,
+            error_rate=options['error_rate'],
+            throttle_rate=options['throttle_rate'],
+            rate_limit=options['rate_limit'],
+            rate_window=options['rate_window'],
+        )
+        server = fake_api.make_server(
+            options['host'], options['port'], options['count'], options['tick'], options['seed'],
+            fixtures=fixtures, behaviour=behaviour)
+        self.stdout.write(f'Fake MBTA API running at http://{options["host"]}:{options["port"]}/')
+        self.stdout.write(f'Serving {", ".join(sorted(set(fixtures.data) | set(fake_api.RESOURCE_TYPES)))}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def object_specs() -> dict:
+    """ What the resources of each object in the params tables look like (see fake_api.Fixtures) """
+    specs = {}
+    objects = MbtaObject.objects.prefetch_related('attributes', 'includes__associated_object')
+    for obj in objects:
+        specs[obj.path] = {
+            'type': resource_type(obj.name),
+            'attributes': {a.name: (a.data_type, a.data_format) for a in obj.attributes.all()},
+            'relationships': {
+                include.name: resource_type(include.associated_object.name) if include.associated_object
+                else include.name
+                for include in obj.includes.all()
+            },
+        }
+    return specs
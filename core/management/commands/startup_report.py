@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import subprocess
+import sys
+import time
+
+
+# Only needed by specific features, so they shouldn't be imported when a process starts
+LAZY_MODULES = ('pandas_profiling', 'matplotlib', 'bokeh', 'pyproj')
+# Dependencies which import some of those themselves: pandas < 1.0 imports matplotlib
+# (when it's installed) to register its plotting backend
+EAGER_IMPORTERS = ('pandas',)
+
+STARTUP_CODE = (
+    'import django; django.setup(); '
+    'from django.urls import get_resolver; get_resolver().url_patterns'
+)
+
+
+class Command(BaseCommand):
+    help = 'Measure how long a fresh process takes to set up Django and import the URLconf'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15,
+                            help='Number of slowest top-level imports to list')
+        parser.add_argument('--budget', type=float, default=settings.STARTUP_BUDGET_SECONDS,
+                            help='Fail if startup takes longer than this many seconds')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP_CODE],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            raise CommandError(process.stderr[-2000:])
+
+        imports = parse_importtime(process.stderr)
+        top_level = sorted(
+            ((name, cumulative) for name, cumulative, depth in imports if depth == 0),
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        self.stdout.write(f'{"module":<40} {"cumulative (ms)":>16}')
+        for name, cumulative in top_level[:options['top']]:
+            self.stdout.write(f'{name:<40} {cumulative / 1000:>16.1f}')
+        import_total = sum(cumulative for _, cumulative in top_level) / 1e6
+        self.stdout.write(f'\nImports: {import_total:.2f}s, startup: {elapsed:.2f}s (budget {options["budget"]:.2f}s)')
+
+        chains = import_chains(imports)
+        loaded_lazy_modules = sorted({
+            name for name, _, _ in imports
+            if name.split('.')[0] in LAZY_MODULES
+            and not any(m.split('.')[0] in EAGER_IMPORTERS for m in chains[name])
+        })
+        if loaded_lazy_modules:
+            raise CommandError(f'Imported at startup: {", ".join(loaded_lazy_modules)}')
+        if elapsed > options['budget']:
+            raise CommandError(f'Startup took {elapsed:.2f}s, over the {options["budget"]:.2f}s budget')
+
+
+def parse_importtime(output: str) -> list:
+    """ Parse the output of 'python -X importtime' into (module, cumulative µs, depth) """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(cumulative), depth))
+    return imports
+
+
+def import_chains(imports: list) -> dict:
+    """ The modules which led to each module being imported, outermost first. In the output
+        of 'python -X importtime' a module's imports are listed (indented) before it. """
+    chains = {}
+    stack = []
+    for name, _, depth in reversed(imports):
+        del stack[depth:]
+        chains[name] = list(stack)
+        stack.append(name)
+    return chains
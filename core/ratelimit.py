@@ -0,0 +1,205 @@
+"""
+Keeps traffic to the MBTA API within the API key's rate limit.
+
+The API reports the quota on every response (x-ratelimit-limit, -remaining and -reset,
+the reset being a Unix time). The latest figures are kept in the shared cache, so every
+worker spends from the same budget. Before a request is sent it waits its turn in a
+priority queue: interactive requests go first, and background requests (such as the
+parameter sync) can't spend the last MBTA_API_RATE_LIMIT_RESERVE of the quota. When the
+budget runs out, requests wait for the window to reset instead of failing with a 429,
+for up to MBTA_API_QUEUE_TIMEOUT; after that they're sent anyway.
+
+The budget is decremented with a read and a write, so workers can briefly overspend it;
+the next response's headers put it right again.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from collections import deque
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+import requests
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+BUDGET_KEY = 'ratelimit:budget'
+# Waiting requests check the budget at least this often, in case another worker's
+# responses have changed it
+MAX_POLL_SECONDS = 1.0
+# Assumed length of a window until the API reports when it resets
+DEFAULT_RESET_SECONDS = 60
+REMEMBER_SECONDS = 60 * 60
+
+
+class Scheduler:
+    """ The queue of requests waiting to be sent by this process """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiting = []  # heap of (priority, sequence number)
+        self.sequence = itertools.count()
+        self.waits = deque(maxlen=1000)  # (priority, seconds) for recent requests
+        self.stats = {'sent': 0, 'queued': 0, 'timed_out': 0, 'rate_limited': 0}
+
+    def acquire(self, priority: int = INTERACTIVE) -> float:
+        """ Wait until a request with this priority can be sent. Returns the time waited. """
+        ticket = (priority, next(self.sequence))
+        started = time.monotonic()
+        deadline = started + settings.MBTA_API_QUEUE_TIMEOUT
+        timed_out = False
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    delay = MAX_POLL_SECONDS
+                    if self.waiting[0] == ticket:
+                        # The cache round trip is made without holding the lock, so other
+                        # threads can join the queue meanwhile (a request which jumps ahead
+                        # may overspend the budget by one, like another worker can)
+                        self.condition.release()
+                        try:
+                            delay = take(priority)
+                        finally:
+                            self.condition.acquire()
+                        if delay <= 0:
+                            break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        timed_out = True
+                        break
+                    self.condition.wait(min(delay, remaining, MAX_POLL_SECONDS))
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+            waited = time.monotonic() - started
+            self.waits.append((priority, waited))
+            self.stats['sent'] += 1
+            self.stats['queued'] += int(waited > 0.01)
+            self.stats['timed_out'] += int(timed_out)
+        return waited
+
+    def status(self) -> dict:
+        with self.condition:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self.waiting:
+                depth[PRIORITY_NAMES[priority]] += 1
+            waits = {name: [] for name in PRIORITY_NAMES.values()}
+            for priority, seconds in self.waits:
+                waits[PRIORITY_NAMES[priority]].append(seconds)
+            return {
+                'queue_depth': depth,
+                'wait_seconds': {name: summarize(seconds) for name, seconds in waits.items()},
+                **self.stats,
+            }
+
+
+def summarize(seconds: list) -> dict:
+    if not seconds:
+        return {'count': 0, 'mean': None, 'p95': None, 'max': None}
+    ordered = sorted(seconds)
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered), 3),
+        'p95': round(ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)], 3),
+        'max': round(ordered[-1], 3),
+    }
+
+
+_scheduler = Scheduler()
+
+
+def acquire(priority: int = INTERACTIVE) -> float:
+    return _scheduler.acquire(priority)
+
+
+def status() -> dict:
+    """ This process's queue, and the shared budget """
+    return dict(_scheduler.status(), budget=get_budget())
+
+
+def get_cache():
+    return caches[settings.MBTA_API_RATE_LIMIT_CACHE_ALIAS]
+
+
+def get_budget() -> dict:
+    """ The limit, remaining requests and reset time last reported by the API, or None """
+    return get_cache().get(BUDGET_KEY)
+
+
+def set_budget(budget: dict) -> None:
+    # Kept after the window resets, so the limit is still known for the next one
+    timeout = max(math.ceil(budget['reset'] - time.time()), 0) + REMEMBER_SECONDS
+    get_cache().set(BUDGET_KEY, budget, timeout=timeout)
+
+
+def take(priority: int) -> float:
+    """ Spend one request from the budget. Returns 0 if that was possible, otherwise
+        the number of seconds until the window resets. """
+    budget = get_budget()
+    if budget is None or not budget['limit']:
+        return 0  # nothing known yet
+    now = time.time()
+    if budget['reset'] <= now:
+        # A new window has started. When it ends isn't known until a response says so.
+        budget = {'limit': budget['limit'], 'remaining': budget['limit'],
+                  'reset': now + DEFAULT_RESET_SECONDS, 'provisional': True}
+    reserve = 0
+    if priority != INTERACTIVE:
+        reserve = math.ceil(budget['limit'] * settings.MBTA_API_RATE_LIMIT_RESERVE)
+    if budget['remaining'] > reserve:
+        budget['remaining'] -= 1
+        set_budget(budget)
+        return 0
+    return budget['reset'] - now
+
+
+def record(response: requests.Response, *args, **kwargs) -> None:
+    """ Response hook: updates the shared budget from the rate limit headers """
+    headers = response.headers
+    if response.status_code == 429:
+        with _scheduler.condition:
+            _scheduler.stats['rate_limited'] += 1
+    budget = get_budget()
+    try:
+        limit = int(headers['x-ratelimit-limit'])
+        remaining = int(headers['x-ratelimit-remaining'])
+        reset = float(headers['x-ratelimit-reset'])
+    except (KeyError, ValueError):
+        if response.status_code != 429:
+            return
+        limit = budget['limit'] if budget else 0
+        remaining = 0
+        reset = time.time() + retry_after(response)
+    if reset <= time.time():
+        return  # from a window which has already ended
+    if budget is not None and not budget.get('provisional') and reset < budget['reset']:
+        return
+    if budget is not None and (budget.get('provisional') or reset == budget['reset']):
+        # Requests still in flight aren't counted in the headers yet, and responses can
+        # arrive out of order: the count only goes down within a window
+        remaining = min(remaining, budget['remaining'])
+    set_budget({'limit': limit, 'remaining': remaining, 'reset': reset})
+
+
+def retry_after(response: requests.Response) -> float:
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return DEFAULT_RESET_SECONDS
+
+
+def _reset_after_fork() -> None:
+    global _scheduler
+    _scheduler = Scheduler()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
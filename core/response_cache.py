@@ -0,0 +1,93 @@
+"""
+Cross-worker cache for MBTA API responses.
+
+Entries are keyed by the normalized URL and query parameters, stored zlib-compressed
+in the 'upstream' cache, and kept for a while after they expire so that they can be
+revalidated with If-Modified-Since instead of being downloaded again.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlencode
+import hashlib
+import time
+import zlib
+import requests
+from . import ratelimit, upstream
+
+
+HIT = 'hit'
+MISS = 'miss'
+REVALIDATED = 'revalidated'
+
+STORED_HEADERS = ('Content-Type', 'Last-Modified', 'Date')
+
+
+def cache_key(url: str, params: dict = None) -> str:
+    """ Key for a request. Parameter order doesn't matter, and nothing from the headers
+        (such as the API key) is included. """
+    query_string = urlencode(sorted((params or {}).items()))
+    digest = hashlib.sha256(f'{url}?{query_string}'.encode()).hexdigest()
+    return f'mbta_response:{digest}'
+
+
+def get(url: str, params: dict = None, headers: dict = None, ttl: int = 0,
+        priority: int = ratelimit.INTERACTIVE):
+    """
+    Get a response from the MBTA API, using the shared cache when possible.
+    Cache misses are sent with the given priority (see core.ratelimit).
+    Returns the response and the outcome (HIT, MISS, or REVALIDATED).
+    Only successful responses are cached, and nothing is cached when ttl is 0.
+    """
+    cache = caches[settings.MBTA_API_CACHE_ALIAS]
+    key = cache_key(url, params)
+    entry = cache.get(key) if ttl > 0 else None
+
+    if entry is not None and entry['expires_at'] > time.time():
+        return build_response(entry), HIT
+
+    headers = dict(headers or {})
+    if entry is not None and entry['headers'].get('Last-Modified'):
+        headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+    response = upstream.get(url, params=params, headers=headers, priority=priority)
+
+    if entry is not None and response.status_code == 304:
+        entry['expires_at'] = time.time() + ttl
+        store(cache, key, entry, ttl)
+        revalidated = build_response(entry)
+        revalidated.timings = response.timings
+        return revalidated, REVALIDATED
+
+    if ttl > 0 and response.status_code == 200:
+        store(cache, key, build_entry(response, ttl), ttl)
+    return response, MISS
+
+
+def build_entry(response: requests.Response, ttl: int) -> dict:
+    return {
+        'url': response.url,
+        'status_code': response.status_code,
+        'reason': response.reason,
+        'headers': {h: response.headers[h] for h in STORED_HEADERS if h in response.headers},
+        'content': zlib.compress(response.content, settings.MBTA_API_CACHE_COMPRESSION_LEVEL),
+        'expires_at': time.time() + ttl,
+    }
+
+
+def store(cache, key: str, entry: dict, ttl: int) -> None:
+    """ Entries outlive their TTL by the stale window so they can still be revalidated """
+    cache.set(key, entry, timeout=ttl + settings.MBTA_API_CACHE_STALE_SECONDS)
+
+
+def build_response(entry: dict) -> requests.Response:
+    """ Rebuild a requests.Response from a cache entry """
+    response = requests.Response()
+    response.url = entry['url']
+    response.status_code = entry['status_code']
+    response.reason = entry['reason']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = zlib.decompress(entry['content'])
+    response._content_consumed = True
+    return response
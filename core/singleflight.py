@@ -0,0 +1,82 @@
+"""
+Single-flight execution: concurrent calls for the same key share one call's result.
+
+Within a process, callers wait for the thread which is already running the call. Across
+worker processes, the first caller takes a lock in the shared cache (with cache.add) and
+publishes its result there when it's done; callers in other workers poll for it. The
+result must therefore be small and picklable, e.g. a key to something stored elsewhere.
+
+The cross-worker lock is only as reliable as the cache's add(): atomic for memcached
+and redis, best effort for the file-based cache.
+"""
+from django.conf import settings
+from django.core.cache import caches
+import threading
+import time
+import uuid
+
+
+POLL_INTERVAL = 0.1
+
+_calls = {}
+_calls_lock = threading.Lock()
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def do(key: str, func):
+    """ Run func(), unless a call with the same key is already in flight, in which case
+        wait for it and return its result instead """
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = Call()
+    if not leader:
+        if call.done.wait(timeout=settings.SINGLEFLIGHT_TIMEOUT) and call.error is None:
+            return call.result
+        return func()  # the leader failed or is taking too long
+
+    try:
+        call.result = do_across_workers(key, func)
+        return call.result
+    except BaseException as error:
+        call.error = error
+        raise
+    finally:
+        with _calls_lock:
+            del _calls[key]
+        call.done.set()
+
+
+def do_across_workers(key: str, func):
+    cache = caches[settings.SINGLEFLIGHT_CACHE_ALIAS]
+    lock_key = f'singleflight:lock:{key}'
+    result_key = f'singleflight:result:{key}'
+    token = uuid.uuid4().hex
+
+    deadline = time.monotonic() + settings.SINGLEFLIGHT_TIMEOUT
+    while True:
+        published = cache.get(result_key)
+        if published is not None:
+            return published['result']
+        if cache.add(lock_key, token, timeout=settings.SINGLEFLIGHT_TIMEOUT):
+            break
+        # Another worker is running the call
+        if time.monotonic() > deadline:
+            return func()
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        result = func()
+        # Published just long enough for the workers which are polling to pick it up
+        cache.set(result_key, {'result': result}, timeout=settings.SINGLEFLIGHT_RESULT_SECONDS)
+        return result
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
@@ -1,3 +1,288 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+import io
+import threading
+import time
+import requests
+from . import fake_api, ratelimit, response_cache, singleflight, upstream
+from .management.commands import startup_report
 
-# Create your tests here.
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+    'upstream': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'upstream'},
+    'params': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'params'},
+}
+
+
+def make_response(status_code: int = 200, content: bytes = b'{"data": []}', headers: dict = None):
+    response = requests.Response()
+    response.url = 'https://api.example/stops'
+    response.status_code = status_code
+    response.reason = 'OK'
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    response._content = content
+    response.timings = {}
+    return response
+
+
+class FakeApiMixin:
+    """ Runs the fake MBTA API in a thread for the duration of the test case """
+    fixtures = None
+    behaviour = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = fake_api.make_server(port=0, count=5, fixtures=cls.fixtures, behaviour=cls.behaviour)
+        cls.server.RequestHandlerClass.log_message = lambda *args: None
+        cls.api_root = 'http://%s:%s' % cls.server.server_address
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UpstreamTests(FakeApiMixin, SimpleTestCase):
+
+    def test_connections_are_reused(self):
+        first = upstream.get(f'{self.api_root}/vehicles')
+        second = upstream.get(f'{self.api_root}/vehicles')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(second.json()['data']), 5)
+        self.assertTrue(second.connection_reused)
+        self.assertIs(upstream.get_session(), upstream.get_session())
+
+    def test_response_size_limit(self):
+        with self.assertRaises(upstream.ResponseTooLarge):
+            upstream.get(f'{self.api_root}/vehicles', max_bytes=100)
+
+    def test_parse_events(self):
+        lines = ['event: reset', 'data: [1,', 'data: 2]', '', ': keep-alive', '', 'data: x', '']
+        self.assertEqual(list(upstream.parse_events(lines)), [('reset', '[1,\n2]'), ('message', 'x')])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FakeApiTests(FakeApiMixin, SimpleTestCase):
+    fixtures = fake_api.Fixtures(specs={
+        '/facilities': {'type': 'facility', 'attributes': {'properties': ('array', ''), 'name': ('string', '')},
+                        'relationships': {'stop': 'stop'}},
+        '/stops': {'type': 'stop', 'attributes': {'name': ('string', '')}, 'relationships': {}},
+    }, count=20)
+    behaviour = fake_api.Behaviour(rate_limit=3, rate_window=60)
+
+    def setUp(self):
+        caches[settings.MBTA_API_RATE_LIMIT_CACHE_ALIAS].clear()
+        self.server.RequestHandlerClass.rate_window = fake_api.RateWindow(3, 60)
+
+    def test_properties(self):
+        document = requests.get(f'{self.api_root}/facilities?include=stop').json()
+        properties = [p for f in document['data'] for p in f['attributes']['properties'] or []]
+        self.assertTrue(properties)
+        self.assertTrue(all(set(p) == {'name', 'value'} for p in properties))
+        self.assertEqual({r['type'] for r in document['included']}, {'stop'})
+
+    def test_rate_limit_headers(self):
+        started = time.time()
+        response = upstream.get(f'{self.api_root}/stops')
+        self.assertEqual(response.headers['x-ratelimit-limit'], '3')
+        self.assertEqual(response.headers['x-ratelimit-remaining'], '2')
+        budget = ratelimit.get_budget()
+        self.assertEqual((budget['limit'], budget['remaining']), (3, 2))
+        self.assertAlmostEqual(budget['reset'], started + 60, delta=2)
+
+        for _ in range(2):
+            requests.get(f'{self.api_root}/stops')
+        response = requests.get(f'{self.api_root}/stops')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['x-ratelimit-remaining'], '0')
+        self.assertGreater(float(response.headers['Retry-After']), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        caches[settings.MBTA_API_CACHE_ALIAS].clear()
+        patcher = mock.patch.object(response_cache.upstream, 'get')
+        self.upstream_get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_key_ignores_parameter_order(self):
+        self.assertEqual(
+            response_cache.cache_key('/stops', {'a': '1', 'b': '2'}),
+            response_cache.cache_key('/stops', {'b': '2', 'a': '1'}))
+        self.assertNotEqual(
+            response_cache.cache_key('/stops', {'a': '1'}),
+            response_cache.cache_key('/stops', {'a': '2'}))
+
+    def test_fresh_entry_is_served_without_a_request(self):
+        self.upstream_get.return_value = make_response(headers={'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        first, outcome = response_cache.get('/stops', {'a': '1'}, ttl=60)
+        self.assertEqual(outcome, response_cache.MISS)
+
+        second, outcome = response_cache.get('/stops', {'a': '1'}, ttl=60)
+        self.assertEqual(outcome, response_cache.HIT)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(self.upstream_get.call_count, 1)
+
+    def test_nothing_is_cached_without_a_ttl(self):
+        self.upstream_get.return_value = make_response()
+        response_cache.get('/stops', ttl=0)
+        _, outcome = response_cache.get('/stops', ttl=0)
+        self.assertEqual(outcome, response_cache.MISS)
+        self.assertEqual(self.upstream_get.call_count, 2)
+
+    def test_errors_are_not_cached(self):
+        self.upstream_get.return_value = make_response(status_code=500)
+        response_cache.get('/stops', ttl=60)
+        _, outcome = response_cache.get('/stops', ttl=60)
+        self.assertEqual(outcome, response_cache.MISS)
+
+    def test_stale_entry_is_revalidated(self):
+        last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        self.upstream_get.return_value = make_response(content=b'cached', headers={'Last-Modified': last_modified})
+        with mock.patch.object(response_cache.time, 'time', return_value=time.time() - 120):
+            response_cache.get('/stops', ttl=60)
+
+        self.upstream_get.return_value = make_response(status_code=304, content=b'')
+        response, outcome = response_cache.get('/stops', ttl=60)
+        self.assertEqual(outcome, response_cache.REVALIDATED)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'cached')
+        self.assertEqual(self.upstream_get.call_args[1]['headers']['If-Modified-Since'], last_modified)
+
+        # Revalidation makes the entry fresh again
+        _, outcome = response_cache.get('/stops', ttl=60)
+        self.assertEqual(outcome, response_cache.HIT)
+        self.assertEqual(self.upstream_get.call_count, 2)
+
+    def test_stale_entry_is_replaced_when_modified(self):
+        self.upstream_get.return_value = make_response(content=b'old', headers={'Last-Modified': 'a'})
+        with mock.patch.object(response_cache.time, 'time', return_value=time.time() - 120):
+            response_cache.get('/stops', ttl=60)
+
+        self.upstream_get.return_value = make_response(content=b'new', headers={'Last-Modified': 'b'})
+        response, outcome = response_cache.get('/stops', ttl=60)
+        self.assertEqual(outcome, response_cache.MISS)
+        self.assertEqual(response.content, b'new')
+        response, outcome = response_cache.get('/stops', ttl=60)
+        self.assertEqual((response.content, outcome), (b'new', response_cache.HIT))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        caches[settings.SINGLEFLIGHT_CACHE_ALIAS].clear()
+
+    def test_concurrent_calls_share_a_result(self):
+        calls = []
+        release = threading.Event()
+
+        def func():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(singleflight.do('key', func))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(singleflight._calls, {})
+
+    def test_result_published_by_another_worker(self):
+        caches[settings.SINGLEFLIGHT_CACHE_ALIAS].set('singleflight:result:key', {'result': 'theirs'})
+        self.assertEqual(singleflight.do('key', lambda: 'ours'), 'theirs')
+
+    def test_errors_are_not_shared(self):
+        def fail():
+            raise ValueError
+        with self.assertRaises(ValueError):
+            singleflight.do('key', fail)
+        self.assertEqual(singleflight.do('key', lambda: 'result'), 'result')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, MBTA_API_RATE_LIMIT_RESERVE=0.2)
+class RateLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        caches[settings.MBTA_API_RATE_LIMIT_CACHE_ALIAS].clear()
+
+    def record(self, limit, remaining, reset, status_code=200):
+        ratelimit.record(make_response(status_code=status_code, headers={
+            'x-ratelimit-limit': str(limit), 'x-ratelimit-remaining': str(remaining),
+            'x-ratelimit-reset': str(reset)}))
+
+    def test_nothing_known(self):
+        self.assertEqual(ratelimit.take(ratelimit.BACKGROUND), 0)
+        self.assertIsNone(ratelimit.get_budget())
+
+    def test_record(self):
+        reset = int(time.time()) + 60
+        self.record(10, 8, reset)
+        self.assertEqual(ratelimit.get_budget(), {'limit': 10, 'remaining': 8, 'reset': reset})
+        self.record(10, 9, reset)  # out of order: the count only goes down within a window
+        self.assertEqual(ratelimit.get_budget()['remaining'], 8)
+        self.record(10, 10, reset - 120)  # from a window which has ended
+        self.assertEqual(ratelimit.get_budget()['remaining'], 8)
+        self.record(10, 10, reset + 60)
+        self.assertEqual(ratelimit.get_budget()['remaining'], 10)
+
+    def test_rate_limited_response(self):
+        response = make_response(status_code=429, headers={'Retry-After': '30'})
+        ratelimit.record(response)
+        budget = ratelimit.get_budget()
+        self.assertEqual(budget['remaining'], 0)
+        self.assertAlmostEqual(budget['reset'], time.time() + 30, delta=1)
+
+    def test_background_requests_leave_a_reserve(self):
+        reset = time.time() + 60
+        self.record(10, 3, reset)
+        self.assertEqual(ratelimit.take(ratelimit.BACKGROUND), 0)
+        self.assertAlmostEqual(ratelimit.take(ratelimit.BACKGROUND), 60, delta=1)  # 2 left, reserve of 2
+        self.assertEqual(ratelimit.take(ratelimit.INTERACTIVE), 0)
+        self.assertEqual(ratelimit.take(ratelimit.INTERACTIVE), 0)
+        self.assertGreater(ratelimit.take(ratelimit.INTERACTIVE), 0)
+
+    def test_new_window(self):
+        ratelimit.set_budget({'limit': 10, 'remaining': 0, 'reset': time.time() - 1})
+        self.assertEqual(ratelimit.take(ratelimit.INTERACTIVE), 0)
+        budget = ratelimit.get_budget()
+        self.assertEqual((budget['remaining'], budget['provisional']), (9, True))
+
+    @override_settings(MBTA_API_QUEUE_TIMEOUT=0.1)
+    def test_acquire_times_out(self):
+        self.record(10, 0, time.time() + 60)
+        scheduler = ratelimit.Scheduler()
+        self.assertGreaterEqual(scheduler.acquire(), 0.1)
+        self.assertEqual(scheduler.status()['timed_out'], 1)
+
+
+class StartupTests(SimpleTestCase):
+
+    def test_heavy_modules_are_not_imported_at_startup(self):
+        call_command('startup_report', budget=60, stdout=io.StringIO())
+
+    def test_parse_importtime(self):
+        output = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |   encodings.aliases\n'
+            'import time:      1500 |       1620 | pandas\n'
+        )
+        imports = startup_report.parse_importtime(output)
+        self.assertEqual(imports, [('encodings.aliases', 120, 1), ('pandas', 1620, 0)])
+        self.assertEqual(startup_report.import_chains(imports), {'encodings.aliases': ['pandas'], 'pandas': []})
@@ -0,0 +1,216 @@
+"""
+Shared HTTP client for all traffic to the MBTA API.
+
+Every worker process keeps a single pooled, keep-alive session, so repeated
+queries reuse TCP/TLS connections instead of paying a new handshake each time.
+Requests wait their turn to be sent within the API's rate limit (see core.ratelimit).
+Responses carry the time spent in each stage of getting them, as response.timings.
+"""
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import logging
+import os
+import threading
+import time
+import weakref
+import requests
+from . import ratelimit
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_session = None
+_stats = {'requests': 0, 'reused': 0}
+_requests_per_connection = weakref.WeakKeyDictionary()
+_timing = threading.local()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """ Notes how long it takes to connect (DNS lookup and TCP handshake) """
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect = getattr(_timing, 'connect', 0.0) + time.perf_counter() - started
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """ Notes how long it takes to connect, including the TLS handshake """
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect = getattr(_timing, 'connect', 0.0) + time.perf_counter() - started
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+def get_session() -> requests.Session:
+    """ Returns the process-wide session, creating it on first use """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def create_session() -> requests.Session:
+    adapter = HTTPAdapter(
+        pool_connections=settings.MBTA_API_POOL_CONNECTIONS,
+        pool_maxsize=settings.MBTA_API_POOL_MAXSIZE,
+        # Only failed connections are retried here: rate limited responses (even with a
+        # Retry-After header) are returned, and retried by get (see core.ratelimit)
+        max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2,
+                          respect_retry_after_header=False, raise_on_status=False),
+    )
+    adapter.poolmanager.pool_classes_by_scheme = {
+        'http': TimedHTTPConnectionPool,
+        'https': TimedHTTPSConnectionPool,
+    }
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept': 'application/vnd.api+json',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    session.hooks['response'].append(record_connection_reuse)
+    session.hooks['response'].append(ratelimit.record)
+    return session
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+def get(url: str, max_bytes: int = None, priority: int = ratelimit.INTERACTIVE, **kwargs) -> requests.Response:
+    """ Sends a GET request through the shared session, once the rate limit allows it.
+        A request which is rejected with a 429 anyway waits for the next window and is
+        retried, up to MBTA_API_RATE_LIMIT_RETRIES times.
+        The body is streamed in, and the download is abandoned once it exceeds max_bytes
+        (MBTA_API_MAX_RESPONSE_BYTES by default).
+        response.timings holds the seconds spent waiting for the rate limit ('queue'),
+        connecting, waiting for the response after connecting ('ttfb') and downloading. """
+    kwargs.setdefault('timeout', settings.MBTA_API_TIMEOUT)
+    queued = 0.0
+    for attempt in range(settings.MBTA_API_RATE_LIMIT_RETRIES + 1):
+        queued += ratelimit.acquire(priority)
+        _timing.connect = 0.0
+        response = get_session().get(url, stream=True, **kwargs)
+        if response.status_code != 429 or attempt == settings.MBTA_API_RATE_LIMIT_RETRIES:
+            break
+        response.close()
+    connect = _timing.connect
+    started = time.perf_counter()
+    read_body(response, max_bytes or settings.MBTA_API_MAX_RESPONSE_BYTES)
+    response.timings = {
+        'queue': queued,
+        'connect': connect,
+        'ttfb': max(response.elapsed.total_seconds() - connect, 0.0),
+        'download': time.perf_counter() - started,
+    }
+    return response
+
+
+def read_body(response: requests.Response, max_bytes: int) -> None:
+    """ Reads a streamed response body into response.content, enforcing a size limit.
+        The whole body ends up in memory (briefly twice, while it's copied into bytes),
+        so max_bytes is what bounds the memory used for a response. """
+    declared_size = int(response.headers.get('Content-Length') or 0)
+    if declared_size > max_bytes:
+        response.close()
+        raise ResponseTooLarge(f'response size ({declared_size} bytes) exceeds the limit of {max_bytes} bytes')
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        body += chunk
+        if len(body) > max_bytes:
+            response.close()
+            raise ResponseTooLarge(f'response size exceeds the limit of {max_bytes} bytes')
+    response._content = bytes(body)
+    response._content_consumed = True
+
+
+def stream(url: str, priority: int = ratelimit.INTERACTIVE, **kwargs):
+    """ Opens a server-sent events stream through the shared session and yields
+        (event, data) pairs as they arrive, until the server closes the stream.
+        The read timeout (MBTA_API_STREAM_READ_TIMEOUT) applies between events. """
+    headers = dict(kwargs.pop('headers', None) or {}, Accept='text/event-stream')
+    kwargs.setdefault('timeout', (settings.MBTA_API_TIMEOUT, settings.MBTA_API_STREAM_READ_TIMEOUT))
+    ratelimit.acquire(priority)
+    with get_session().get(url, stream=True, headers=headers, **kwargs) as response:
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        yield from parse_events(response.iter_lines(decode_unicode=True))
+
+
+def parse_events(lines):
+    """ Parses the lines of an event stream into (event, data) pairs """
+    event, data = 'message', []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event, data = 'message', []
+        elif line.startswith(':'):
+            continue  # comment, e.g. a keep-alive
+        else:
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'event':
+                event = value
+            elif field == 'data':
+                data.append(value)
+
+
+def record_connection_reuse(response: requests.Response, *args, **kwargs) -> None:
+    """ Response hook: notes whether the underlying connection had served a request before.
+        The result is also attached to the response as 'connection_reused'. """
+    connection = getattr(response.raw, '_connection', None)
+    with _lock:
+        if connection is None:
+            reused = False
+        else:
+            previous = _requests_per_connection.get(connection, 0)
+            _requests_per_connection[connection] = previous + 1
+            reused = previous > 0
+        _stats['requests'] += 1
+        _stats['reused'] += int(reused)
+    response.connection_reused = reused
+    logger.debug('%s %s (connection %s)', response.status_code, response.url,
+                 'reused' if reused else 'new')
+
+
+def connection_stats() -> dict:
+    """ Number of requests sent by this process, and how many of them reused a connection """
+    with _lock:
+        return dict(_stats)
+
+
+def _reset_after_fork() -> None:
+    """ Pooled sockets must never be shared between processes """
+    global _lock, _session
+    _lock = threading.Lock()
+    _session = None
+    _stats.update(requests=0, reused=0)
+    _requests_per_connection.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
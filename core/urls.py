@@ -5,4 +5,5 @@ from . import views
 urlpatterns = [
     path(route='', view=views.home, name='home'),
     path(route='about', view=views.about, name='about'),
+    path(route='status/upstream', view=views.upstream_status, name='upstream-status'),
 ]
@@ -1,4 +1,8 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
 from django.shortcuts import redirect, render
+import os
+from . import ratelimit, upstream
 
 
 def home(request):
@@ -7,3 +11,13 @@ def home(request):
 
 def about(request):
     return render(request, 'core/about.html', context={})
+
+
+@staff_member_required
+def upstream_status(request):
+    """ The rate limit budget, and this worker's request queue and connection stats, as JSON """
+    return JsonResponse({
+        'pid': os.getpid(),
+        'rate_limit': ratelimit.status(),
+        'connections': upstream.connection_stats(),
+    })
@@ -18,6 +18,9 @@ load_dotenv()
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Runtime data (caches, stored results) shared by all worker processes
+VAR_DIR = os.getenv('VAR_DIR', os.path.join(BASE_DIR, 'var'))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
@@ -90,6 +93,25 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'upstream': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(VAR_DIR, 'cache', 'upstream'),
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+    'params': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(VAR_DIR, 'cache', 'params'),
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -129,4 +151,89 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
-SESSION_SERIALIZER = 'django.contrib.sessions.serializers.PickleSerializer'
+# Sessions only hold small handles; query results live in the result store (see below)
+SESSION_SERIALIZER = 'django.contrib.sessions.serializers.JSONSerializer'
+
+# Worker cold starts are checked against this with 'manage.py startup_report'
+STARTUP_BUDGET_SECONDS = float(os.getenv('STARTUP_BUDGET_SECONDS', '2.0'))
+
+
+# MBTA API client
+# Each worker process keeps one pooled keep-alive session. POOL_MAXSIZE should be at
+# least the number of threads per worker, otherwise extra connections get discarded.
+
+MBTA_API_ROOT = os.getenv('MBTA_API_ROOT', 'https://api-v3.mbta.com')
+MBTA_API_POOL_CONNECTIONS = int(os.getenv('MBTA_API_POOL_CONNECTIONS', '2'))
+MBTA_API_POOL_MAXSIZE = int(os.getenv('MBTA_API_POOL_MAXSIZE', '10'))
+MBTA_API_TIMEOUT = float(os.getenv('MBTA_API_TIMEOUT', '30'))
+MBTA_API_MAX_RESPONSE_BYTES = int(os.getenv('MBTA_API_MAX_RESPONSE_BYTES', str(64 * 1024 * 1024)))
+
+# Optional paging: when MBTA_API_PAGE_SIZE is set, responses are fetched that many resources
+# at a time, with up to MBTA_API_PAGE_WORKERS pages downloading at once.
+MBTA_API_PAGE_SIZE = int(os.getenv('MBTA_API_PAGE_SIZE', '0'))
+MBTA_API_PAGE_WORKERS = int(os.getenv('MBTA_API_PAGE_WORKERS', '4'))
+
+# Live results: objects which can be streamed (as server-sent events), how long to wait
+# between upstream events before reconnecting, and how long an upstream stream is kept
+# open after its last subscriber leaves.
+LIVE_STREAM_OBJECTS = ('Vehicle', 'Prediction')
+MBTA_API_STREAM_READ_TIMEOUT = float(os.getenv('MBTA_API_STREAM_READ_TIMEOUT', '60'))
+LIVE_STREAM_IDLE_SECONDS = int(os.getenv('LIVE_STREAM_IDLE_SECONDS', '30'))
+LIVE_STREAM_HEARTBEAT_SECONDS = 15
+
+# Responses are cached for MbtaObject.cache_ttl seconds, then kept for the stale window
+# so they can be revalidated with If-Modified-Since.
+MBTA_API_CACHE_ALIAS = 'upstream'
+MBTA_API_CACHE_STALE_SECONDS = int(os.getenv('MBTA_API_CACHE_STALE_SECONDS', '86400'))
+MBTA_API_CACHE_COMPRESSION_LEVEL = 6
+
+# Identical requests which are in flight at the same time are only sent once (see
+# core.singleflight). Other workers wait up to SINGLEFLIGHT_TIMEOUT for the result.
+SINGLEFLIGHT_CACHE_ALIAS = MBTA_API_CACHE_ALIAS
+SINGLEFLIGHT_TIMEOUT = float(os.getenv('SINGLEFLIGHT_TIMEOUT', '60'))
+SINGLEFLIGHT_RESULT_SECONDS = 2
+
+# Requests are scheduled within the API key's rate limit, shared by all workers through
+# the cache (see core.ratelimit). Background requests leave MBTA_API_RATE_LIMIT_RESERVE of
+# the quota to interactive ones, and nothing waits longer than MBTA_API_QUEUE_TIMEOUT.
+MBTA_API_RATE_LIMIT_CACHE_ALIAS = MBTA_API_CACHE_ALIAS
+MBTA_API_RATE_LIMIT_RESERVE = float(os.getenv('MBTA_API_RATE_LIMIT_RESERVE', '0.2'))
+MBTA_API_RATE_LIMIT_RETRIES = int(os.getenv('MBTA_API_RATE_LIMIT_RETRIES', '1'))
+MBTA_API_QUEUE_TIMEOUT = float(os.getenv('MBTA_API_QUEUE_TIMEOUT', '30'))
+
+# The parameter catalog is rebuilt whenever the params tables change. Versioned catalog
+# URLs never change, so they can be cached for PARAMS_CATALOG_MAX_AGE.
+PARAMS_CATALOG_CACHE_ALIAS = 'params'
+PARAMS_CATALOG_MAX_AGE = 365 * 24 * 60 * 60
+
+# The parameters are synced from the API's swagger document (see params.sync), or from a
+# copy of it when MBTA_API_SWAGGER_FILE is set, e.g. to work offline.
+MBTA_API_SWAGGER_FILE = os.getenv('MBTA_API_SWAGGER_FILE', '')
+# Sync on every process start if the tables are empty (slow: prefer 'manage.py sync_params')
+PARAMS_SYNC_ON_STARTUP = os.getenv('PARAMS_SYNC_ON_STARTUP', '') == '1'
+
+
+# Query results
+# DataFrames are stored as memory-mapped Arrow files and removed after RESULT_STORE_MAX_AGE seconds.
+# Each worker looks for old results at most every RESULT_STORE_PRUNE_INTERVAL seconds when
+# saving; set it to 0 to only prune with 'manage.py prune_results' (e.g. from cron).
+
+RESULT_STORE_DIR = os.path.join(VAR_DIR, 'results')
+RESULT_STORE_MAX_AGE = int(os.getenv('RESULT_STORE_MAX_AGE', str(24 * 60 * 60)))
+RESULT_STORE_PRUNE_INTERVAL = int(os.getenv('RESULT_STORE_PRUNE_INTERVAL', '600'))
+RESULT_STORE_FRAMES_IN_MEMORY = int(os.getenv('RESULT_STORE_FRAMES_IN_MEMORY', '4'))
+
+# Rows serialized per chunk of a streamed export (and per Parquet row group)
+EXPORT_CHUNK_ROWS = 10000
+
+
+# Profile reports
+# Generated by background workers: REPORT_JOB_BACKEND is 'thread' (default) or 'process'.
+# Finished reports are cached in REPORT_DIR, least recently used first out past REPORT_CACHE_MAX_BYTES.
+
+REPORT_DIR = os.path.join(VAR_DIR, 'reports')
+REPORT_JOB_BACKEND = os.getenv('REPORT_JOB_BACKEND', 'thread')
+REPORT_JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', '2'))
+REPORT_JOBS_PER_USER = int(os.getenv('REPORT_JOBS_PER_USER', '1'))
+REPORT_JOB_TIMEOUT = int(os.getenv('REPORT_JOB_TIMEOUT', str(30 * 60)))
+REPORT_CACHE_MAX_BYTES = int(os.getenv('REPORT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
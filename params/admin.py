@@ -52,6 +52,6 @@ class AttributeInline(NoAddDeleteMixin, admin.StackedInline):
 
 @admin.register(MbtaObject)
 class MbtaObjectAdmin(NoAddDeleteMixin, admin.ModelAdmin):
-    list_display = ('name', 'active')
+    list_display = ('name', 'cache_ttl', 'active')
     readonly_fields = ('name', 'path', 'description', 'can_specify_id', 'requires_filters')
     inlines = [IncludeInline, FilterInline, AttributeInline]
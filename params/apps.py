@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 from django.db.migrations.executor import MigrationExecutor
 from django.db import connections, DEFAULT_DB_ALIAS
 
@@ -7,11 +8,15 @@ class ParamsConfig(AppConfig):
     name = 'params'
 
     def ready(self):
-        if unapplied_migrations_exist():
-            print('Can not initialize the DataBase until all migrations have been applied')
-        else:
-            from . import db_init
-            db_init.main()
+        from . import signals  # noqa: F401
+        # Normally the parameters are loaded with 'manage.py sync_params' when deploying.
+        # Checking for migrations and syncing slows down every process start, so it's opt-in.
+        if settings.PARAMS_SYNC_ON_STARTUP:
+            if unapplied_migrations_exist():
+                print('Can not initialize the DataBase until all migrations have been applied')
+            else:
+                from . import db_init
+                db_init.main()
 
 
 def unapplied_migrations_exist() -> bool:
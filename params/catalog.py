@@ -0,0 +1,54 @@
+"""
+The parameter catalog: every active object with its active includes, filters and attributes,
+in one JSON document for the query builder.
+
+The document is built with a fixed number of database queries, serialized and gzipped
+once, and kept in a shared cache until the params tables change (see params.signals).
+Its version is a hash of the content, so versioned URLs can be cached indefinitely.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Prefetch
+from collections import namedtuple
+import gzip
+import hashlib
+import json
+from .models import MbtaObject, MbtaInclude, MbtaFilter, MbtaAttribute
+from .serializers import MbtaObjectDetailSerializer
+
+
+CACHE_KEY = 'params_catalog'
+
+Catalog = namedtuple('Catalog', ['version', 'content', 'gzipped'])
+
+
+def get() -> Catalog:
+    cache = caches[settings.PARAMS_CATALOG_CACHE_ALIAS]
+    catalog = cache.get(CACHE_KEY)
+    if catalog is None:
+        catalog = build()
+        cache.set(CACHE_KEY, tuple(catalog), timeout=None)
+    return Catalog(*catalog)
+
+
+def build() -> Catalog:
+    """ Inactive includes, filters and attributes are left out, as they are by the query form """
+    objects = (
+        MbtaObject.objects
+        .filter(active=True)
+        .prefetch_related(
+            Prefetch('includes', queryset=MbtaInclude.objects.filter(active=True).prefetch_related('included_by')),
+            Prefetch('filters', queryset=MbtaFilter.objects.filter(active=True)),
+            Prefetch('attributes', queryset=MbtaAttribute.objects.filter(active=True)),
+        )
+    )
+    data = {
+        'objects': {str(o.pk): MbtaObjectDetailSerializer(o).data for o in objects},
+    }
+    content = json.dumps(data, separators=(',', ':')).encode()
+    version = hashlib.sha256(content).hexdigest()[:16]
+    return Catalog(version, content, gzip.compress(content, compresslevel=9))
+
+
+def invalidate() -> None:
+    caches[settings.PARAMS_CATALOG_CACHE_ALIAS].delete(CACHE_KEY)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+import json
+from params import sync
+
+
+class Command(BaseCommand):
+    help = "Sync the parameter tables with the MBTA API's swagger document"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='Read the swagger document from this file instead of the API')
+        parser.add_argument('--save', metavar='PATH',
+                            help='Also write the swagger document to this file (to vendor it)')
+
+    def handle(self, *args, **options):
+        api_doc = sync.load_spec(options['file'])
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(api_doc, f, indent=1, sort_keys=True)
+        stats = sync.sync(api_doc)
+        changes = [f'{count} {name}' for name, count in sorted(stats.items()) if count]
+        self.stdout.write(', '.join(changes) if changes else 'Already up to date')
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.5 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+# A snapshot of the TTLs in params.sync (STATIC_OBJECTS etc.) when this migration was
+# written. Migrations must not change after they're applied, so this copy is frozen on
+# purpose: changing the rule in params.sync only affects objects created afterwards.
+STATIC_OBJECTS = ('Line', 'Route', 'RoutePattern', 'Shape', 'Stop', 'Facility', 'Service', 'Trip', 'Schedule')
+REALTIME_OBJECTS = ('Vehicle', 'Prediction')
+STATIC_CACHE_TTL = 6 * 60 * 60
+REALTIME_CACHE_TTL = 10
+
+
+def set_cache_ttls(apps, schema_editor):
+    MbtaObject = apps.get_model('params', 'MbtaObject')
+    MbtaObject.objects.filter(name__in=STATIC_OBJECTS).update(cache_ttl=STATIC_CACHE_TTL)
+    MbtaObject.objects.filter(name__in=REALTIME_OBJECTS).update(cache_ttl=REALTIME_CACHE_TTL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('params', '0007_auto_20190921_1409'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mbtaobject',
+            name='cache_ttl',
+            field=models.PositiveIntegerField(default=60, help_text='Seconds for which API responses can be reused', verbose_name='cache TTL'),
+        ),
+        migrations.RunPython(set_cache_ttls, migrations.RunPython.noop),
+    ]
@@ -11,6 +11,8 @@ class MbtaObject(models.Model):
     description = models.TextField()
     can_specify_id = models.BooleanField(default=False)
     requires_filters = models.BooleanField(default=False)
+    cache_ttl = models.PositiveIntegerField(
+        'cache TTL', default=60, help_text='Seconds for which API responses can be reused')
     active = models.BooleanField(default=True)
 
     class Meta:
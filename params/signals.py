@@ -0,0 +1,30 @@
+"""
+Rebuild the parameter catalog whenever the parameters change.
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver, Signal
+from .models import MbtaObject, MbtaInclude, MbtaFilter, MbtaAttribute
+
+
+# Sent after params.sync has written to the tables in bulk (which doesn't send post_save)
+params_synced = Signal()
+
+
+@receiver(post_save, sender=MbtaObject)
+@receiver(post_delete, sender=MbtaObject)
+@receiver(post_save, sender=MbtaInclude)
+@receiver(post_delete, sender=MbtaInclude)
+@receiver(post_save, sender=MbtaFilter)
+@receiver(post_delete, sender=MbtaFilter)
+@receiver(post_save, sender=MbtaAttribute)
+@receiver(post_delete, sender=MbtaAttribute)
+@receiver(params_synced)
+def params_changed(sender, **kwargs):
+    from . import catalog
+    catalog.invalidate()
+
+
+@receiver(m2m_changed, sender=MbtaInclude.included_by.through)
+def includes_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        params_changed(sender)
@@ -0,0 +1,306 @@
+"""
+Synchronizes the parameter tables with the MBTA API's swagger document.
+
+The document is parsed once into plain dicts, associations are resolved in memory and
+the database is brought in line with bulk inserts and updates in a single transaction.
+Only rows which differ from the document are written. Rows which are no longer in the
+document are deactivated rather than deleted, since saved queries may refer to them, and
+are reactivated if they come back. To hide something which is still in the document,
+leave it out of the query form rather than deactivating it: the next sync would undo that.
+
+The document is downloaded from the API, unless a (vendored) swagger file is given or
+configured with MBTA_API_SWAGGER_FILE.
+"""
+from django.conf import settings
+from django.db import transaction
+from collections import Counter, OrderedDict
+import json
+import requests
+from core import ratelimit, upstream
+from .models import MbtaObject, MbtaInclude, MbtaFilter, MbtaAttribute
+from .signals import params_synced
+
+
+# Fields filled in from the swagger document. Other fields (active, cache_ttl, ...) can
+# be edited in the admin, so they are only set when a row is created.
+OBJECT_FIELDS = ['name', 'description', 'can_specify_id']
+INCLUDE_FIELDS = ['associated_object']
+FILTER_FIELDS = ['associated_object']
+ATTRIBUTE_FIELDS = [
+    'description', 'required', 'data_type', 'default', 'example', 'minimum', 'choices', 'data_format']
+
+# Cache TTLs for new objects (see object_cache_ttl). params/migrations/0008 set them on
+# the objects which existed then, from a snapshot of these values.
+STATIC_OBJECTS = ('Line', 'Route', 'RoutePattern', 'Shape', 'Stop', 'Facility', 'Service', 'Trip', 'Schedule')
+REALTIME_OBJECTS = ('Vehicle', 'Prediction')
+STATIC_CACHE_TTL = 6 * 60 * 60
+REALTIME_CACHE_TTL = 10
+DEFAULT_CACHE_TTL = 60
+
+
+def load_spec(path: str = None) -> dict:
+    """ Read the swagger document from a file, or download it """
+    path = path or settings.MBTA_API_SWAGGER_FILE
+    if path:
+        with open(path, 'rb') as f:
+            return json.load(f)
+    url = requests.compat.urljoin(settings.MBTA_API_ROOT, '/docs/swagger/swagger.json')
+    return upstream.get(url, priority=ratelimit.BACKGROUND).json()
+
+
+def parse_spec(api_doc: dict) -> dict:
+    """
+    Extract the parameters from the swagger document.
+    Objects are keyed by path and the other tables by name (and the name of the object
+    they belong to). Associated objects are referred to by name.
+    """
+    objects = OrderedDict()
+    includes = OrderedDict()
+    filters = OrderedDict()
+    attributes = OrderedDict()
+
+    paths = [p for p in api_doc['paths'].keys() if not p.endswith(r'{id}')]
+    for path in paths:
+        get = api_doc['paths'][path]['get']
+        name = get['tags'][0]
+        objects[path] = {
+            'name': name,
+            'description': get['description'],
+            'can_specify_id': (path + r'/{id}') in api_doc['paths'],
+            'requires_filters': object_requires_filters(name),
+            'cache_ttl': object_cache_ttl(name),
+        }
+    object_names = {o['name'] for o in objects.values()}
+
+    for path, o in objects.items():
+        for param in api_doc['paths'][path]['get']['parameters']:
+            if param['name'] == 'include':
+                for include in parse_include_names(param['description']):
+                    if include not in includes:
+                        includes[include] = {
+                            'associated_object': associated_object_name(include, object_names),
+                            'included_by': [],
+                        }
+                    includes[include]['included_by'].append(o['name'])
+            elif param['name'].startswith('filter['):
+                name = param['name'][len('filter['):-1]
+                if name == 'id':
+                    associated_object = o['name']
+                else:
+                    associated_object = associated_object_name(name, object_names)
+                filters[(o['name'], name)] = {'associated_object': associated_object}
+
+        resource_definition = api_doc['definitions'][o['name'] + 'Resource']
+        for name, properties in resource_definition['properties']['attributes']['properties'].items():
+            attributes[(o['name'], name)] = attribute_fields(properties)
+
+    return {'objects': objects, 'includes': includes, 'filters': filters, 'attributes': attributes}
+
+
+def parse_include_names(description: str) -> list:
+    """ The include options are listed in the description of the "include" parameter """
+    bulleted_list = description.split('\n\n')[1]
+    return [x.strip(' *`') for x in bulleted_list.split('\n*')]
+
+
+def attribute_fields(properties: dict) -> dict:
+    return {
+        'description': properties.get('description', ''),
+        'required': properties.get('required', False),
+        'data_type': properties.get('type', ''),
+        'default': properties.get('default', ''),
+        'example': properties.get('x-example', ''),
+        'minimum': properties.get('minimum', None),
+        'choices': properties.get('enum', ''),
+        'data_format': properties.get('format', ''),
+    }
+
+
+def object_requires_filters(name):
+    if name in ('LiveFacility', 'Prediction', 'Schedule', 'Service', 'Shape', 'Trip'):
+        return True
+    else:
+        return False
+
+
+def object_cache_ttl(name):
+    """
+    How long (in seconds) API responses for an object can be reused.
+    Static GTFS data only changes with new feed versions, real-time data goes stale quickly.
+    """
+    if name in STATIC_OBJECTS:
+        return STATIC_CACHE_TTL
+    elif name in REALTIME_OBJECTS:
+        return REALTIME_CACHE_TTL
+    else:
+        return DEFAULT_CACHE_TTL
+
+
+def associated_object_name(identifier: str, object_names) -> str:
+    """
+    Takes an identifier and determines what MbtaObject it represents (if any).
+    For example, 'stop', 'child_stops', and 'parent_station' will all result
+    in the 'Stop' MbtaObject being returned.
+    """
+    def not_describing_hierarchy(word: str) -> bool:
+        return word not in ('parent', 'child')
+
+    def replace_synonyms(word: str) -> str:
+        synonyms = {'station': 'stop'}
+        return word if word not in synonyms else synonyms[word]
+
+    def make_singular(word: str) -> str:
+        if word.endswith('ies'):
+            return word[:-3] + 'y'
+        elif word.endswith('s'):
+            return word[:-1]
+        else:
+            return word
+
+    words = identifier.split('_')
+    words = filter(not_describing_hierarchy, words)
+    words = map(replace_synonyms, words)
+    name = ''.join([word.capitalize() for word in words])
+    name = make_singular(name)
+    return name if name in object_names else None
+
+
+def sync(api_doc: dict) -> Counter:
+    """ Bring the parameter tables in line with the swagger document.
+        Returns the number of rows created, updated and deactivated in each table. """
+    spec = parse_spec(api_doc)
+    stats = Counter()
+    with transaction.atomic():
+        objects = sync_objects(spec['objects'], stats)
+        objects_by_name = {o.name: o for o in objects.values()}
+        sync_includes(spec['includes'], objects_by_name, stats)
+        sync_filters(spec['filters'], objects_by_name, stats)
+        sync_attributes(spec['attributes'], objects_by_name, stats)
+        transaction.on_commit(lambda: params_synced.send(sender=MbtaObject))
+    return stats
+
+
+def apply_diff(model, existing: dict, wanted: dict, fields: list, build, stats: Counter) -> None:
+    """
+    Create the rows in `wanted` which don't exist yet, update the fields of those which
+    differ, reactivate those which are wanted again and deactivate those which are no
+    longer wanted. Both dicts map the same kind of key to model instances (existing) or
+    field values (wanted).
+    """
+    to_create = []
+    to_update = []
+    to_reactivate = []
+    for key, values in wanted.items():
+        row = existing.get(key)
+        if row is None:
+            to_create.append(build(key, values))
+            continue
+        changed = [f for f in fields if getattr(row, field_attname(model, f)) != values[f]]
+        for f in changed:
+            setattr(row, field_attname(model, f), values[f])
+        if changed:
+            to_update.append(row)
+        if not row.active:
+            to_reactivate.append(row.pk)
+    to_deactivate = [row.pk for key, row in existing.items() if key not in wanted and row.active]
+
+    model.objects.bulk_create(to_create)
+    if to_update:
+        model.objects.bulk_update(to_update, [field_attname(model, f) for f in fields])
+    if to_reactivate:
+        model.objects.filter(pk__in=to_reactivate).update(active=True)
+    if to_deactivate:
+        model.objects.filter(pk__in=to_deactivate).update(active=False)
+    name = model._meta.model_name
+    stats[f'{name} created'] += len(to_create)
+    stats[f'{name} updated'] += len(to_update)
+    stats[f'{name} reactivated'] += len(to_reactivate)
+    stats[f'{name} deactivated'] += len(to_deactivate)
+
+
+def field_attname(model, field: str) -> str:
+    """ Foreign keys are compared and set by id """
+    return model._meta.get_field(field).attname
+
+
+def object_id(objects_by_name: dict, name: str) -> int:
+    return objects_by_name[name].pk if name in objects_by_name else None
+
+
+def sync_objects(spec_objects: dict, stats: Counter) -> dict:
+    existing = {o.path: o for o in MbtaObject.objects.all()}
+    apply_diff(
+        MbtaObject, existing, spec_objects, OBJECT_FIELDS,
+        lambda path, values: MbtaObject(path=path, **values),
+        stats,
+    )
+    # bulk_create doesn't set primary keys on every database, so read the objects back
+    return {o.path: o for o in MbtaObject.objects.all()}
+
+
+def sync_includes(spec_includes: dict, objects_by_name: dict, stats: Counter) -> None:
+    wanted = OrderedDict(
+        (name, {'associated_object': object_id(objects_by_name, include['associated_object'])})
+        for name, include in spec_includes.items()
+    )
+    existing = {i.name: i for i in MbtaInclude.objects.all()}
+    apply_diff(
+        MbtaInclude, existing, wanted, INCLUDE_FIELDS,
+        lambda name, values: MbtaInclude(name=name, associated_object_id=values['associated_object']),
+        stats,
+    )
+
+    includes = {i.name: i.pk for i in MbtaInclude.objects.all()}
+    Through = MbtaInclude.included_by.through
+    wanted_links = {
+        (includes[name], objects_by_name[object_name].pk)
+        for name, include in spec_includes.items()
+        for object_name in include['included_by']
+    }
+    existing_links = set(Through.objects.values_list('mbtainclude_id', 'mbtaobject_id'))
+    Through.objects.bulk_create([
+        Through(mbtainclude_id=include_id, mbtaobject_id=object_pk)
+        for include_id, object_pk in wanted_links - existing_links
+    ])
+    for include_id, object_pk in existing_links - wanted_links:
+        Through.objects.filter(mbtainclude_id=include_id, mbtaobject_id=object_pk).delete()
+    stats['include links created'] += len(wanted_links - existing_links)
+    stats['include links deleted'] += len(existing_links - wanted_links)
+
+
+def sync_filters(spec_filters: dict, objects_by_name: dict, stats: Counter) -> None:
+    wanted = OrderedDict(
+        ((objects_by_name[object_name].pk, name),
+         {'associated_object': object_id(objects_by_name, f['associated_object'])})
+        for (object_name, name), f in spec_filters.items()
+    )
+    existing = {(f.for_object_id, f.name): f for f in MbtaFilter.objects.all()}
+    apply_diff(
+        MbtaFilter, existing, wanted, FILTER_FIELDS,
+        lambda key, values: MbtaFilter(
+            for_object_id=key[0], name=key[1], associated_object_id=values['associated_object']),
+        stats,
+    )
+
+
+def sync_attributes(spec_attributes: dict, objects_by_name: dict, stats: Counter) -> None:
+    wanted = OrderedDict(
+        ((objects_by_name[object_name].pk, name), normalize_attribute(values))
+        for (object_name, name), values in spec_attributes.items()
+    )
+    existing = {(a.for_object_id, a.name): a for a in MbtaAttribute.objects.all()}
+    apply_diff(
+        MbtaAttribute, existing, wanted, ATTRIBUTE_FIELDS,
+        lambda key, values: MbtaAttribute(for_object_id=key[0], name=key[1], **values),
+        stats,
+    )
+
+
+def normalize_attribute(values: dict) -> dict:
+    """ Convert the values the way the database stores them, so that unchanged
+        attributes compare equal to what was read back """
+    values = dict(values)
+    for field in ('description', 'data_type', 'default', 'example', 'choices', 'data_format'):
+        values[field] = '' if values[field] is None else str(values[field])
+    values['required'] = bool(values['required'])
+    return values
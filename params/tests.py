@@ -1,3 +1,161 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.urls import reverse
+import copy
+import gzip
+import json
+from . import catalog, sync
+from .models import MbtaAttribute, MbtaFilter, MbtaInclude, MbtaObject
 
-# Create your tests here.
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+    'upstream': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'upstream'},
+    'params': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'params'},
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogTests(TestCase):
+
+    def setUp(self):
+        catalog.invalidate()
+        self.vehicle = MbtaObject.objects.create(name='Vehicle', path='/vehicles', description='')
+        self.route = MbtaObject.objects.create(name='Route', path='/routes', description='')
+        MbtaObject.objects.create(name='Shape', path='/shapes', description='', active=False)
+        for name, active in (('label', True), ('speed', False)):
+            MbtaAttribute.objects.create(for_object=self.vehicle, name=name, required=False,
+                                         data_type='string', active=active)
+        for name, active in (('route', True), ('trip', False)):
+            MbtaFilter.objects.create(for_object=self.vehicle, name=name, active=active)
+        for name, active in (('route', True), ('stop', False)):
+            MbtaInclude.objects.create(name=name, active=active).included_by.add(self.vehicle)
+
+    def objects(self) -> dict:
+        return json.loads(catalog.get().content)['objects']
+
+    def test_only_active_params(self):
+        objects = self.objects()
+        self.assertEqual(sorted(o['name'] for o in objects.values()), ['Route', 'Vehicle'])
+        vehicle = objects[str(self.vehicle.pk)]
+        self.assertEqual([a['name'] for a in vehicle['attributes']], ['label'])
+        self.assertEqual([f['name'] for f in vehicle['filters']], ['route'])
+        self.assertEqual([i['name'] for i in vehicle['includes']], ['route'])
+
+    def test_built_with_a_fixed_number_of_queries(self):
+        with self.assertNumQueries(5):
+            catalog.build()
+        trip = MbtaObject.objects.create(name='Trip', path='/trips', description='')
+        MbtaInclude.objects.create(name='shape').included_by.add(self.vehicle, trip)
+        with self.assertNumQueries(5):
+            catalog.build()
+
+    def test_rebuilt_when_params_change(self):
+        version = catalog.get().version
+        with self.assertNumQueries(0):
+            self.assertEqual(catalog.get().version, version)
+        MbtaAttribute.objects.filter(name='speed').update(active=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(catalog.get().version, version)  # not through a signal
+        MbtaAttribute.objects.get(name='speed').save()
+        self.assertNotEqual(catalog.get().version, version)
+
+        version = catalog.get().version
+        MbtaInclude.objects.get(name='route').included_by.add(self.route)
+        self.assertNotEqual(catalog.get().version, version)
+
+    def test_versioned_urls(self):
+        current = catalog.get()
+        response = self.client.get(reverse('params:catalog-version', kwargs={'version': current.version}))
+        self.assertEqual(response.content, current.content)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.client.get(reverse('params:catalog-version', kwargs={'version': 'outdated'}))
+        self.assertRedirects(response, reverse('params:catalog-version', kwargs={'version': current.version}))
+
+        response = self.client.get(reverse('params:catalog'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(gzip.decompress(response.content), current.content)
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(reverse('params:catalog'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+def swagger(objects: dict) -> dict:
+    """ A minimal swagger document. objects maps names to (path, includes, filters, attributes). """
+    api_doc = {'paths': {}, 'definitions': {}}
+    for name, (path, includes, filters, attributes) in objects.items():
+        parameters = [{'name': f'filter[{f}]'} for f in filters]
+        if includes:
+            bullets = '\n'.join(f'* `{i}`' for i in includes)
+            parameters.append({'name': 'include', 'description': f'Relationships to include.\n\n{bullets}\n\nMore.'})
+        api_doc['paths'][path] = {'get': {'tags': [name], 'description': f'{name}s', 'parameters': parameters}}
+        api_doc['paths'][f'{path}/{{id}}'] = {'get': {}}
+        api_doc['definitions'][f'{name}Resource'] = {'properties': {'attributes': {'properties': {
+            attribute: {'type': 'string', 'description': attribute} for attribute in attributes
+        }}}}
+    return api_doc
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SyncTests(TestCase):
+
+    def setUp(self):
+        self.api_doc = swagger({
+            'Vehicle': ('/vehicles', ['route', 'trip'], ['route', 'label'], ['label', 'bearing']),
+            'Route': ('/routes', ['line'], ['type'], ['long_name']),
+            'Trip': ('/trips', [], ['route'], ['headsign']),
+        })
+        self.stats = sync.sync(self.api_doc)
+
+    def changed(self, change) -> dict:
+        api_doc = copy.deepcopy(self.api_doc)
+        change(api_doc)
+        return {name: count for name, count in sync.sync(api_doc).items() if count}
+
+    def test_initial_sync(self):
+        self.assertEqual(self.stats['mbtaobject created'], 3)
+        self.assertEqual(self.stats['mbtainclude created'], 3)
+        self.assertEqual(self.stats['mbtafilter created'], 4)
+        self.assertEqual(self.stats['mbtaattribute created'], 4)
+        vehicle = MbtaObject.objects.get(name='Vehicle')
+        self.assertEqual((vehicle.path, vehicle.cache_ttl, vehicle.can_specify_id), ('/vehicles', 10, True))
+        self.assertTrue(MbtaObject.objects.get(name='Trip').requires_filters)
+        self.assertEqual(MbtaObject.objects.get(name='Route').cache_ttl, sync.STATIC_CACHE_TTL)
+        self.assertEqual(sync.object_cache_ttl('Alert'), sync.DEFAULT_CACHE_TTL)
+        self.assertEqual(MbtaInclude.objects.get(name='trip').associated_object.name, 'Trip')
+        self.assertIsNone(MbtaInclude.objects.get(name='line').associated_object)
+        self.assertEqual(MbtaFilter.objects.get(for_object=vehicle, name='route').associated_object.name, 'Route')
+        self.assertEqual(sorted(vehicle.includes.values_list('name', flat=True)), ['route', 'trip'])
+
+    def test_unchanged(self):
+        with self.assertNumQueries(9):
+            self.assertEqual(self.changed(lambda api_doc: None), {})
+
+    def test_changed_rows_are_updated(self):
+        def change(api_doc):
+            api_doc['definitions']['VehicleResource']['properties']['attributes']['properties']['label'] = {
+                'type': 'string', 'description': 'The label', 'x-example': '1234'}
+        self.assertEqual(self.changed(change), {'mbtaattribute updated': 1})
+        label = MbtaAttribute.objects.get(name='label')
+        self.assertEqual((label.description, label.example), ('The label', '1234'))
+
+    def test_removed_rows_are_deactivated_and_reactivated(self):
+        def remove(api_doc):
+            del api_doc['definitions']['VehicleResource']['properties']['attributes']['properties']['bearing']
+            api_doc['paths']['/vehicles']['get']['parameters'] = [
+                p for p in api_doc['paths']['/vehicles']['get']['parameters'] if p['name'] != 'filter[label]']
+        self.assertEqual(self.changed(remove), {'mbtaattribute deactivated': 1, 'mbtafilter deactivated': 1})
+        self.assertFalse(MbtaAttribute.objects.get(name='bearing').active)
+        self.assertFalse(MbtaFilter.objects.get(name='label').active)
+
+        self.assertEqual(self.changed(lambda api_doc: None), {'mbtaattribute reactivated': 1, 'mbtafilter reactivated': 1})
+        self.assertTrue(MbtaAttribute.objects.get(name='bearing').active)
+        self.assertTrue(MbtaFilter.objects.get(name='label').active)
+
+    def test_include_links(self):
+        def change(api_doc):
+            parameters = api_doc['paths']['/trips']['get']['parameters']
+            parameters.append({'name': 'include', 'description': 'Relationships.\n\n* `route`'})
+        self.assertEqual(self.changed(change), {'include links created': 1})
+        self.assertEqual(list(MbtaObject.objects.get(name='Trip').includes.values_list('name', flat=True)), ['route'])
+        self.assertEqual(self.changed(lambda api_doc: None), {'include links deleted': 1})
+        self.assertFalse(MbtaObject.objects.get(name='Trip').includes.exists())
@@ -7,4 +7,6 @@ urlpatterns = [
     path('objects/', views.ObjectList.as_view(), name='objects'),
     path('objects/<int:pk>/', views.ObjectDetail.as_view(), name='object-detail'),
     path('includes/', views.IncludeList.as_view(), name='includes'),
+    path('catalog/', views.catalog, name='catalog'),
+    path('catalog/<str:version>/', views.catalog, name='catalog-version'),
 ]
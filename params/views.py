@@ -1,6 +1,11 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from rest_framework import generics
 from .models import MbtaObject, MbtaInclude
 from .serializers import MbtaObjectSerializer, MbtaObjectDetailSerializer, MbtaIncludeSerializer
+from . import catalog as params_catalog
 
 
 class ObjectList(generics.ListAPIView):
@@ -9,10 +14,35 @@ class ObjectList(generics.ListAPIView):
 
 
 class ObjectDetail(generics.RetrieveAPIView):
-    queryset = MbtaObject.objects.all()
+    queryset = MbtaObject.objects.prefetch_related('includes', 'filters', 'attributes')
     serializer_class = MbtaObjectDetailSerializer
 
 
 class IncludeList(generics.ListAPIView):
     queryset = MbtaInclude.objects.all()
     serializer_class = MbtaIncludeSerializer
+
+
+def catalog(request, version=None):
+    """ The parameter catalog, for the query builder.
+        A versioned URL always returns the same document, so it can be cached for a long
+        time; an outdated version redirects to the current one. The unversioned URL
+        must be revalidated, using the version as an ETag. """
+    current = params_catalog.get()
+    if version is not None and version != current.version:
+        return redirect('params:catalog-version', version=current.version)
+    etag = f'"{current.version}"'
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    elif 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(current.gzipped, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(current.content, content_type='application/json')
+    response['ETag'] = etag
+    if version is None:
+        patch_cache_control(response, public=True, no_cache=True)
+    else:
+        patch_cache_control(response, public=True, immutable=True, max_age=settings.PARAMS_CATALOG_MAX_AGE)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
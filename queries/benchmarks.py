@@ -0,0 +1,383 @@
+"""
+Helpers for benchmarking the results pipeline offline.
+
+Synthetic payloads are shaped like real MBTA API resources, so no API key or network
+access is needed. Used by the 'benchmark' management command.
+
+Each scenario generates a JSON:API document of a given number of primary resources,
+along with the schema the query plan would carry for it (see queries.schema):
+
+- vehicle: vehicles including their routes, stops and trips
+- schedule: schedules with datetimes and to-one relationships
+- stop: stops including their facilities, whose attributes include 'properties'
+- alert: alerts with nested active periods and informed entities
+
+Payloads are generated from a seeded random number generator, so runs are comparable.
+"""
+from collections import OrderedDict
+import json
+import platform
+import random
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from . import schema
+
+
+def synthetic_vehicles(n: int, seed: int = 0) -> list:
+    """ Vehicle resources with to-one relationships to routes, stops and trips """
+    rng = random.Random(seed)
+    statuses = ['IN_TRANSIT_TO', 'STOPPED_AT', 'INCOMING_AT']
+    return [
+        {
+            'type': 'vehicle',
+            'id': f'y{i:06d}',
+            'links': {'self': f'/vehicles/y{i:06d}'},
+            'attributes': {
+                'bearing': rng.randrange(360),
+                'current_status': rng.choice(statuses),
+                'current_stop_sequence': rng.randrange(1, 40),
+                'direction_id': rng.randrange(2),
+                'label': str(rng.randrange(1000, 4000)),
+                'latitude': 42.36 + rng.uniform(-0.2, 0.2),
+                'longitude': -71.06 + rng.uniform(-0.2, 0.2),
+                'speed': None if rng.random() < 0.5 else rng.uniform(0, 20),
+                'updated_at': '2019-09-24T14:%02d:%02d-04:00' % (rng.randrange(60), rng.randrange(60)),
+            },
+            'relationships': {
+                'route': {'data': {'type': 'route', 'id': str(rng.randrange(1, 120))}},
+                'stop': {'data': {'type': 'stop', 'id': str(rng.randrange(1, 9000))}},
+                'trip': {'data': {'type': 'trip', 'id': f'4{i:07d}'}},
+            },
+        }
+        for i in range(n)
+    ]
+
+
+def synthetic_routes(ids, rng: random.Random) -> list:
+    return [
+        {
+            'type': 'route',
+            'id': route_id,
+            'attributes': {
+                'color': rng.choice(['DA291C', '00843D', 'ED8B00', 'FFC72C']),
+                'description': rng.choice(['Local Bus', 'Key Bus', 'Rapid Transit']),
+                'direction_names': ['Outbound', 'Inbound'],
+                'long_name': f'Route {route_id}',
+                'short_name': route_id,
+                'sort_order': int(route_id) * 10,
+                'type': 3,
+            },
+            'relationships': {'line': {'data': {'type': 'line', 'id': f'line-{route_id}'}}},
+        }
+        for route_id in ids
+    ]
+
+
+def synthetic_stops(ids, rng: random.Random, facilities: int = 0) -> list:
+    """ Stops, each with a parent station and up to 'facilities' facilities """
+    stops = []
+    for stop_id in ids:
+        facility_ids = [f'{stop_id}-f{j}' for j in range(rng.randrange(facilities + 1))]
+        stops.append({
+            'type': 'stop',
+            'id': stop_id,
+            'attributes': {
+                'address': None,
+                'at_street': rng.choice([None, 'Main Street', 'Broadway']),
+                'description': None,
+                'latitude': 42.36 + rng.uniform(-0.2, 0.2),
+                'location_type': rng.choice([0, 0, 0, 1]),
+                'longitude': -71.06 + rng.uniform(-0.2, 0.2),
+                'municipality': rng.choice(['Boston', 'Cambridge', 'Somerville', 'Quincy']),
+                'name': f'Stop {stop_id}',
+                'on_street': rng.choice([None, 'Massachusetts Avenue', 'Washington Street']),
+                'platform_code': None,
+                'platform_name': None,
+                'vehicle_type': 3,
+                'wheelchair_boarding': rng.randrange(3),
+            },
+            'relationships': {
+                'facilities': {'data': [{'type': 'facility', 'id': f} for f in facility_ids]},
+                'parent_station': {'data': {'type': 'stop', 'id': f'place-{int(stop_id) % 200}'}},
+                'zone': {'data': {'type': 'zone', 'id': f'CR-zone-{int(stop_id) % 10}'}},
+            },
+        })
+    return stops
+
+
+def synthetic_facilities(stops: list, rng: random.Random) -> list:
+    facilities = []
+    for stop in stops:
+        for ref in stop['relationships']['facilities']['data']:
+            facilities.append({
+                'type': 'facility',
+                'id': ref['id'],
+                'attributes': {
+                    'latitude': stop['attributes']['latitude'],
+                    'long_name': f'{stop["attributes"]["name"]} {ref["id"]}',
+                    'longitude': stop['attributes']['longitude'],
+                    'properties': [
+                        {'name': 'enclosed', 'value': rng.randrange(2)},
+                        {'name': 'excludes-stop', 'value': stop['id']},
+                        {'name': 'operator', 'value': rng.choice(['MBTA', 'Massport'])},
+                    ],
+                    'short_name': ref['id'],
+                    'type': rng.choice(['ELEVATOR', 'ESCALATOR', 'BIKE_STORAGE', 'PARKING_AREA']),
+                },
+                'relationships': {'stop': {'data': {'type': 'stop', 'id': stop['id']}}},
+            })
+    return facilities
+
+
+def synthetic_trips(ids, rng: random.Random) -> list:
+    return [
+        {
+            'type': 'trip',
+            'id': trip_id,
+            'attributes': {
+                'block_id': f'B{rng.randrange(1000)}',
+                'direction_id': rng.randrange(2),
+                'headsign': rng.choice(['Harvard', 'Dudley', 'Ashmont', 'Alewife']),
+                'name': '',
+                'wheelchair_accessible': 1,
+            },
+            'relationships': {
+                'route': {'data': {'type': 'route', 'id': str(rng.randrange(1, 120))}},
+                'service': {'data': {'type': 'service', 'id': f'FallWeekday-{rng.randrange(5)}'}},
+                'shape': {'data': {'type': 'shape', 'id': f'shape-{rng.randrange(400)}'}},
+            },
+        }
+        for trip_id in ids
+    ]
+
+
+def vehicle_scenario(n: int, rng: random.Random):
+    """ /vehicles?include=route,stop,trip """
+    data = synthetic_vehicles(n, seed=rng.randrange(1 << 30))
+    related = {name: sorted({v['relationships'][name]['data']['id'] for v in data}) for name in ('route', 'stop', 'trip')}
+    included = (synthetic_routes(related['route'], rng) + synthetic_stops(related['stop'], rng)
+                + synthetic_trips(related['trip'], rng))
+    return data, included
+
+
+def schedule_scenario(n: int, rng: random.Random):
+    """ /schedules """
+    data = []
+    for i in range(n):
+        arrival = None if i % 40 == 0 else '2019-09-24T%02d:%02d:00-04:00' % (5 + i % 19, rng.randrange(60))
+        data.append({
+            'type': 'schedule',
+            'id': f'schedule-{40000000 + i}-{i % 40}',
+            'attributes': {
+                'arrival_time': arrival,
+                'departure_time': arrival,
+                'direction_id': rng.randrange(2),
+                'drop_off_type': rng.choice([0, 0, 1]),
+                'pickup_type': rng.choice([0, 0, 1]),
+                'stop_sequence': i % 40 + 1,
+                'timepoint': rng.random() < 0.3,
+            },
+            'relationships': {
+                'prediction': {'data': None},
+                'route': {'data': {'type': 'route', 'id': str(rng.randrange(1, 120))}},
+                'stop': {'data': {'type': 'stop', 'id': str(rng.randrange(1, 9000))}},
+                'trip': {'data': {'type': 'trip', 'id': str(40000000 + i // 40)}},
+            },
+        })
+    return data, []
+
+
+def stop_scenario(n: int, rng: random.Random):
+    """ /stops?include=facilities """
+    data = synthetic_stops([str(i) for i in range(1, n + 1)], rng, facilities=3)
+    return data, synthetic_facilities(data, rng)
+
+
+def alert_scenario(n: int, rng: random.Random):
+    """ /alerts """
+    data = []
+    for i in range(n):
+        routes = sorted({str(rng.randrange(1, 120)) for _ in range(rng.randrange(1, 4))})
+        data.append({
+            'type': 'alert',
+            'id': str(300000 + i),
+            'attributes': {
+                'active_period': [
+                    {'start': '2019-09-%02dT04:30:00-04:00' % d, 'end': '2019-09-%02dT01:30:00-04:00' % (d + 1)}
+                    for d in range(1, rng.randrange(2, 6))
+                ],
+                'banner': None,
+                'cause': rng.choice(['CONSTRUCTION', 'MAINTENANCE', 'UNKNOWN_CAUSE', 'TRAFFIC']),
+                'created_at': '2019-09-%02dT10:%02d:00-04:00' % (rng.randrange(1, 24), rng.randrange(60)),
+                'description': 'Buses are running on a detour. ' * rng.randrange(1, 6),
+                'effect': rng.choice(['DETOUR', 'DELAY', 'STOP_CLOSURE', 'SHUTTLE']),
+                'header': f'Route {routes[0]} detoured due to construction',
+                'informed_entity': [
+                    {'activities': ['BOARD', 'EXIT', 'RIDE'], 'route': route, 'route_type': 3}
+                    for route in routes
+                ],
+                'lifecycle': rng.choice(['NEW', 'ONGOING', 'ONGOING_UPCOMING']),
+                'service_effect': f'Route {routes[0]} detour',
+                'severity': rng.randrange(1, 10),
+                'short_header': f'Route {routes[0]} detoured',
+                'timeframe': None,
+                'updated_at': '2019-09-24T%02d:%02d:00-04:00' % (rng.randrange(24), rng.randrange(60)),
+                'url': None,
+            },
+        })
+    return data, []
+
+
+SCENARIOS = OrderedDict([
+    ('vehicle', vehicle_scenario),
+    ('schedule', schedule_scenario),
+    ('stop', stop_scenario),
+    ('alert', alert_scenario),
+])
+
+# What Query.compile_plan would put in the plan's schema for these resources
+SCHEMAS = {
+    'vehicle': dict(
+        bearing=schema.INTEGER, current_status=schema.STRING, current_stop_sequence=schema.INTEGER,
+        direction_id=schema.INTEGER, label=schema.STRING, latitude=schema.NUMBER, longitude=schema.NUMBER,
+        speed=schema.NUMBER, updated_at=schema.DATETIME),
+    'route': dict(
+        color=schema.STRING, description=schema.STRING, direction_names=schema.OBJECT, long_name=schema.STRING,
+        short_name=schema.STRING, sort_order=schema.INTEGER, type=schema.INTEGER),
+    'stop': dict(
+        address=schema.STRING, at_street=schema.STRING, description=schema.STRING, latitude=schema.NUMBER,
+        location_type=schema.INTEGER, longitude=schema.NUMBER, municipality=schema.STRING, name=schema.STRING,
+        on_street=schema.STRING, platform_code=schema.STRING, platform_name=schema.STRING,
+        vehicle_type=schema.INTEGER, wheelchair_boarding=schema.INTEGER),
+    'trip': dict(
+        block_id=schema.STRING, direction_id=schema.INTEGER, headsign=schema.STRING, name=schema.STRING,
+        wheelchair_accessible=schema.INTEGER),
+    'facility': dict(
+        latitude=schema.NUMBER, long_name=schema.STRING, longitude=schema.NUMBER, properties=schema.OBJECT,
+        short_name=schema.STRING, type=schema.STRING),
+    'schedule': dict(
+        arrival_time=schema.DATETIME, departure_time=schema.DATETIME, direction_id=schema.INTEGER,
+        drop_off_type=schema.INTEGER, pickup_type=schema.INTEGER, stop_sequence=schema.INTEGER,
+        timepoint=schema.BOOLEAN),
+    'alert': dict(
+        active_period=schema.OBJECT, banner=schema.STRING, cause=schema.STRING, created_at=schema.DATETIME,
+        description=schema.STRING, effect=schema.STRING, header=schema.STRING, informed_entity=schema.OBJECT,
+        lifecycle=schema.STRING, service_effect=schema.STRING, severity=schema.INTEGER,
+        short_header=schema.STRING, timeframe=schema.STRING, updated_at=schema.DATETIME, url=schema.STRING),
+}
+
+
+def synthetic_document(scenario: str, n: int, seed: int = 0) -> bytes:
+    """ An encoded JSON:API document of n primary resources """
+    data, included = SCENARIOS[scenario](n, random.Random(seed))
+    document = {'data': data, 'jsonapi': {'version': '1.0'}}
+    if included:
+        document['included'] = included
+    return json.dumps(document).encode()
+
+
+def measure(func, setup=None, repeat: int = 3) -> dict:
+    """ The fastest of several runs, in seconds, and the peak memory allocated by one more
+        run (which is traced separately, since tracing slows everything down).
+        setup() returns the arguments for each run, and isn't measured. """
+    setup = setup or tuple
+    timings = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    args = setup()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(timings), 'peak_bytes': peak}
+
+
+def environment() -> dict:
+    """ What a baseline was measured with. Baselines are only comparable on the same. """
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+    }
+
+
+def best_time(func, *args, repeat: int = 3) -> float:
+    """ Fastest of several runs, in seconds """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def legacy_clean_DataFrame(df: pd.DataFrame) -> pd.DataFrame:
+    """ The original row-by-row flattening, kept as the baseline for the flatten benchmark """
+
+    def expand_columns(df, columns) -> pd.DataFrame:
+        columns = [c for c in columns if c in df.columns]
+        if any(columns):
+            new_dfs = [convert_column_to_dataframe(df, c) for c in columns]
+            return df.drop(columns=columns).join(new_dfs)
+        else:
+            return df
+
+    def convert_column_to_dataframe(df, column) -> pd.DataFrame:
+        if column == 'attributes':
+            return df['attributes'].apply(pd.Series)
+
+        elif column == 'relationships':
+            def get_data_id(x):
+                if isinstance(x, pd.Series):
+                    return x.apply(get_data_id)
+                else:
+                    try:
+                        return x['data']['id']
+                    except (TypeError, KeyError):
+                        return None
+            return df['relationships'].apply(pd.Series).apply(get_data_id)
+
+        elif column == 'properties':
+            def props_list_to_dict(props_list):
+                return {prop['name']: prop['value'] for prop in props_list}
+            return df['properties'].map(props_list_to_dict).apply(pd.Series)
+
+    def convert_datetime_columns(df):
+        for column in df.columns:
+            if column.endswith(('created_at', 'updated_at')):
+                df[column] = pd.to_datetime(df[column])
+
+    df = df.drop(columns=[c for c in ('links', 'type') if c in df.columns])
+    df = expand_columns(df, columns=['attributes', 'relationships'])
+    df = expand_columns(df, columns=['properties'])
+    convert_datetime_columns(df)
+    return df
+
+
+def legacy_create_DataFrame(document: dict) -> pd.DataFrame:
+    """ The original create_DataFrame, which merged each included type onto the primary
+        resources, kept as the baseline for the layout of joined frames """
+    main_df = pd.DataFrame(document['data'])
+    main_type = main_df['type'].unique()[0]
+    main_df = legacy_clean_DataFrame(main_df)
+
+    if 'included' in document:
+        main_df.rename(lambda col: f'{main_type}_{col}', axis='columns', inplace=True)
+
+        for inc_type, inc_df in pd.DataFrame(document['included']).groupby('type'):
+            inc_df = legacy_clean_DataFrame(inc_df)
+            inc_df.rename(lambda col: f'{inc_type}_{col}', axis='columns', inplace=True)
+
+            main_id_col = f'{main_type}_{inc_type}'
+            main_df = main_df.merge(inc_df, how='left', left_on=main_id_col, right_on=f'{inc_type}_id')
+            main_df.drop(columns=[main_id_col], inplace=True)
+
+    return main_df
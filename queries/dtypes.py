@@ -0,0 +1,175 @@
+"""
+Shrinks the DataFrames built from API responses, which make up most of what a worker
+keeps in memory.
+
+- Integers are downcast. Object columns of integers (which is what None values leave
+  them as) become integer columns, or nullable integer ones (Int8 to Int64) if they
+  have nulls. Object columns of booleans become bool columns if they have no nulls,
+  since pandas 0.25 has no nullable boolean dtype.
+- Floats become float32 only where that loses nothing.
+- Id columns (id, *_id and relationships such as route, stop and trip) are
+  dictionary-encoded. Columns referring to the same kind of resource share one set of
+  categories, with the ids interned, so equal ids are stored once however many columns,
+  frames or cached results they appear in.
+- Other string columns are encoded when their values repeat. Mostly unique columns are
+  recognized from a sample and left alone, without hashing the whole column.
+- Lists, dicts, mixed values and datetimes are left as they are.
+"""
+from collections import OrderedDict
+import sys
+import numpy as np
+import pandas as pd
+
+
+# Resource types which relationship columns refer to, by the last word of their name
+ID_KINDS = {
+    'alert', 'facility', 'line', 'pattern', 'prediction', 'route', 'schedule', 'service',
+    'shape', 'station', 'stop', 'stops', 'trip', 'vehicle',
+}
+SAMPLE_SIZE = 1000
+# String columns are encoded if they have at most this many distinct values per row
+MAX_UNIQUE_RATIO = 0.5
+# Integer columns with nulls are held in the smallest of these which fits their values
+NULLABLE_INTEGERS = ['Int8', 'Int16', 'Int32', 'Int64']
+
+
+def optimize(df: pd.DataFrame) -> dict:
+    """ Convert the DataFrame's columns in place. Returns a report of the memory used
+        by each column before and after (see memory_report). """
+    before = df.memory_usage(index=False, deep=True)
+    dtypes_before = df.dtypes.astype(str)
+
+    id_columns = OrderedDict()
+    for column in df.columns:
+        if id_kind(column) is not None and is_strings(df[column]):
+            id_columns.setdefault(id_kind(column), []).append(column)
+            continue
+        converted = optimize_column(df[column])
+        if converted is not None:
+            df[column] = converted
+    for columns in id_columns.values():
+        encode_ids(df, columns)
+
+    return memory_report(before, dtypes_before, df)
+
+
+def optimize_column(series: pd.Series) -> pd.Series:
+    """ The series with a smaller dtype, or None if it should be left as it is """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(dtype):
+        return None
+    if pd.api.types.is_datetime64_any_dtype(dtype) or pd.api.types.is_timedelta64_dtype(dtype):
+        return None
+    if pd.api.types.is_integer_dtype(dtype):
+        if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+            return downcast_nullable_integers(series)
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(dtype):
+        return downcast_floats(series)
+
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    has_nulls = series.isna().any()
+    if kind == 'boolean':
+        return None if has_nulls else series.astype(bool)
+    if kind == 'integer':
+        try:
+            if not has_nulls:
+                return pd.to_numeric(series.astype(np.int64), downcast='integer')
+            return downcast_nullable_integers(series.astype('Int64'))
+        except OverflowError:
+            return None  # beyond int64
+    if kind in ('floating', 'mixed-integer-float'):
+        return downcast_floats(series.astype('float64'))
+    if kind == 'string' and repeats(series):
+        return series.astype('category')
+    return None
+
+
+def downcast_nullable_integers(series: pd.Series) -> pd.Series:
+    """ pd.to_numeric doesn't downcast nullable integers (as of pandas 0.25) """
+    values = series.dropna()
+    low, high = (values.min(), values.max()) if len(values) else (0, 0)
+    for name in NULLABLE_INTEGERS:
+        info = np.iinfo(name.lower())
+        if info.min <= low and high <= info.max:
+            return series.astype(name)
+    return None
+
+
+def downcast_floats(series: pd.Series) -> pd.Series:
+    values = series.to_numpy()
+    narrow = values.astype(np.float32)
+    nan = np.isnan(values)
+    widened = narrow.astype(np.float64)
+    if np.array_equal(np.isnan(widened), nan) and np.array_equal(widened[~nan], values[~nan]):
+        return pd.Series(narrow, index=series.index, name=series.name)
+    return None
+
+
+def id_kind(column: str) -> str:
+    """ The kind of resource a column holds ids of, e.g. 'route' for 'vehicle_route' and
+        'route_id', or None if it doesn't look like an id column """
+    name = column[:-len('_id')] if column.endswith('_id') else column
+    if name == 'id':
+        return 'id'
+    kind = name.rsplit('_', 1)[-1]
+    if kind in ID_KINDS or column.endswith('_id'):
+        return kind
+    return None
+
+
+def is_strings(series: pd.Series) -> bool:
+    """ Whether a column holds strings, including ones which are already encoded """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return pd.api.types.infer_dtype(series.cat.categories, skipna=True) in ('string', 'empty')
+    return pd.api.types.infer_dtype(series, skipna=True) == 'string'
+
+
+def repeats(series: pd.Series) -> bool:
+    """ Whether the column has few enough distinct values to be worth encoding.
+        A sample rules out mostly unique columns before the whole column is hashed. """
+    values = series.dropna()
+    if len(values) == 0:
+        return False
+    sample = values.iloc[:SAMPLE_SIZE]
+    if len(sample) == SAMPLE_SIZE and sample.nunique() > MAX_UNIQUE_RATIO * len(sample):
+        return False
+    return values.nunique() <= MAX_UNIQUE_RATIO * len(values)
+
+
+def encode_ids(df: pd.DataFrame, columns: list) -> None:
+    """ Encode id columns with one shared, interned set of categories, so that they can be
+        compared and joined without decoding. Unique columns (such as the primary id) are
+        left as strings unless another column of the same kind refers to them. """
+    if len(columns) == 1 and not repeats(df[columns[0]]):
+        return
+    categories = pd.unique(np.concatenate([distinct_values(df[c]) for c in columns]))
+    dtype = pd.CategoricalDtype(sorted(sys.intern(str(c)) for c in categories))
+    for column in columns:
+        df[column] = df[column].astype(dtype)
+
+
+def distinct_values(series: pd.Series) -> np.ndarray:
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.categories.to_numpy(dtype=object)
+    return series.dropna().unique().astype(object)
+
+
+def memory_report(before: pd.Series, dtypes_before: pd.Series, df: pd.DataFrame) -> dict:
+    """ Bytes used by each column (memory_usage(deep=True)) before and after, and its dtypes """
+    after = df.memory_usage(index=False, deep=True)
+    dtypes_after = df.dtypes.astype(str)
+    return {
+        'before': int(before.sum()),
+        'after': int(after.sum()),
+        'columns': [
+            {
+                'column': str(column),
+                'dtype_before': dtypes_before[column],
+                'dtype': dtypes_after[column],
+                'before': int(before[column]),
+                'after': int(after[column]),
+            }
+            for column in df.columns
+        ],
+    }
@@ -0,0 +1,105 @@
+"""
+Streamed exports of query results.
+
+Text formats (CSV, JSON Lines) are serialized a chunk of rows at a time as the response
+is sent. Binary formats (Feather, Parquet) are served from files, read from the
+memory-mapped Arrow data in the result store rather than from the DataFrame.
+"""
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from . import result_store
+
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'feather': 'application/vnd.apache.arrow.file',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def export(results, fmt: str, filename: str):
+    """ Returns a response which streams the results in the given format """
+    if fmt == 'csv':
+        response = StreamingHttpResponse(csv_chunks(results.df), content_type=CONTENT_TYPES[fmt])
+    elif fmt == 'jsonl':
+        response = StreamingHttpResponse(jsonl_chunks(results.df), content_type=CONTENT_TYPES[fmt])
+    elif fmt == 'feather':
+        response = FileResponse(open(feather_path(results), 'rb'), content_type=CONTENT_TYPES[fmt])
+    elif fmt == 'parquet':
+        response = FileResponse(open(parquet_path(results), 'rb'), content_type=CONTENT_TYPES[fmt])
+    else:
+        raise ValueError(f'unknown export format: {fmt}')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
+
+
+def chunks(df: pd.DataFrame):
+    size = settings.EXPORT_CHUNK_ROWS
+    for start in range(0, len(df), size):
+        yield start, df.iloc[start:start + size]
+
+
+def csv_chunks(df: pd.DataFrame):
+    if df.empty:
+        yield df.to_csv(index=False)
+    for start, chunk in chunks(df):
+        yield chunk.to_csv(index=False, header=(start == 0))
+
+
+def jsonl_chunks(df: pd.DataFrame):
+    for _, chunk in chunks(df):
+        yield chunk.to_json(orient='records', lines=True, date_format='iso').rstrip('\n') + '\n'
+
+
+def feather_path(results) -> str:
+    """ Results are already stored as Feather (Arrow IPC) files, so normally that file is
+        sent as-is. Otherwise a copy is written once next to it. """
+    path = result_store.arrow_path(results.key)
+    if path is None:
+        path = result_store.path(results.key, 'feather')
+        if not os.path.exists(path):
+            write_atomic(path, lambda f: write_feather(arrow_table(results), f))
+    return path
+
+
+def parquet_path(results) -> str:
+    """ Parquet files are written once per result, one row group at a time """
+    path = result_store.path(results.key, 'parquet')
+    if not os.path.exists(path):
+        write_atomic(path, lambda f: pq.write_table(
+            arrow_table(results), f, row_group_size=settings.EXPORT_CHUNK_ROWS))
+    return path
+
+
+def write_atomic(path: str, write) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def write_feather(table: pa.Table, f) -> None:
+    with pa.ipc.new_file(f, table.schema) as writer:
+        writer.write_table(table)
+
+
+def arrow_table(results) -> pa.Table:
+    """ The results as an Arrow table, memory-mapped from the result store when possible.
+        Columns Arrow can't represent (e.g. mixed lists and scalars) are exported as text. """
+    path = result_store.arrow_path(results.key)
+    if path is not None:
+        return result_store.read_table(path)
+    df = results.df.copy()
+    for column in df.columns:
+        if result_store.is_nullable_integer(df[column].dtype):
+            continue
+        try:
+            pa.array(df[column], from_pandas=True)
+        except result_store.ARROW_ERRORS:
+            df[column] = df[column].map(lambda v: None if v is None else str(v))
+    return result_store.to_table(df.reset_index(drop=True))
@@ -0,0 +1,35 @@
+"""
+Canonical fingerprints for queries.
+
+Two queries with the same object, includes, attributes and filter values ask the API for
+the same thing, however they were put together, so they get the same fingerprint. It's
+stored on Query (unique among the queries which have one), and submitting a query which
+already exists reuses the existing row along with everything cached for it.
+"""
+import hashlib
+import json
+
+
+def fingerprint(primary_object_id: int, include_ids, attribute_ids, filters) -> str:
+    """ filters maps MbtaFilter ids to their values, as a list or a comma-separated string.
+        It can also be a list of (id, values) pairs, since a query can filter on the same
+        attribute more than once; every pair is kept. """
+    if isinstance(filters, dict):
+        filters = filters.items()
+    canonical = {
+        'object': int(primary_object_id),
+        'includes': sorted(int(pk) for pk in include_ids),
+        'attributes': sorted(int(pk) for pk in attribute_ids),
+        'filters': sorted(
+            [int(pk), normalize_values(values)] for pk, values in filters
+            if normalize_values(values)
+        ),
+    }
+    return hashlib.sha256(json.dumps(canonical, separators=(',', ':')).encode()).hexdigest()
+
+
+def normalize_values(values) -> list:
+    """ Filter values are alternatives, so their order and duplicates don't matter """
+    if isinstance(values, str):
+        values = values.split(',')
+    return sorted({str(v).strip() for v in values if str(v).strip()})
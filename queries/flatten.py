@@ -0,0 +1,140 @@
+"""
+Flattens JSON:API resources into DataFrames.
+
+Resources are walked once and their values appended straight into per-column lists,
+so no intermediate Series or DataFrame is built per row. The resulting layout is:
+id, then one column per attribute, then one per relationship (holding the related id,
+or a list of ids for to-many relationships), and finally one per entry of a 'properties'
+attribute (as used by facilities).
+"""
+from collections import OrderedDict
+from typing import Iterable
+import pandas as pd
+from . import schema
+
+
+class ResourceTable:
+    """
+    Accumulates resources of a single type as columns.
+    Values which are missing from a resource are filled with None.
+    """
+
+    def __init__(self):
+        self.length = 0
+        self.ids = []
+        self.attributes = OrderedDict()
+        self.relationships = OrderedDict()
+        self.related_types = {}
+        self.properties = OrderedDict()
+
+    def append(self, resource: dict) -> None:
+        row = self.length
+        self.ids.append(resource.get('id'))
+        for name, value in (resource.get('attributes') or {}).items():
+            if name == 'properties' and isinstance(value, list):
+                for prop in value:
+                    if isinstance(prop, dict) and 'name' in prop:
+                        set_value(self.properties, prop['name'], row, prop.get('value'))
+            else:
+                set_value(self.attributes, name, row, value)
+        for name, relationship in (resource.get('relationships') or {}).items():
+            set_value(self.relationships, name, row, related_id(relationship))
+            if name not in self.related_types:
+                resource_type = related_type(relationship)
+                if resource_type is not None:
+                    self.related_types[name] = resource_type
+        self.length += 1
+
+    def extend(self, resources: Iterable[dict]) -> None:
+        for resource in resources:
+            self.append(resource)
+
+    def columns(self) -> OrderedDict:
+        """ All columns in display order, padded to the full length """
+        columns = OrderedDict(id=self.ids)
+        for group in (self.attributes, self.relationships, self.properties):
+            for name, values in group.items():
+                if name not in columns:
+                    pad(values, self.length)
+                    columns[name] = values
+        return columns
+
+    def to_frame(self, types: dict = None) -> pd.DataFrame:
+        """ types maps attribute names to their kinds (see queries.schema). Those columns,
+            the id and the relationships are built with their dtypes; the rest are inferred. """
+        if types is None:
+            df = pd.DataFrame(self.columns())
+            convert_datetime_columns(df)
+            return df
+        columns = OrderedDict()
+        inferred = []
+        for name, values in self.columns().items():
+            kind = schema.STRING if name == 'id' or name in self.relationships else types.get(name)
+            column = schema.typed_column(values, kind) if kind is not None else None
+            if column is None:
+                column = values
+                inferred.append(name)
+            columns[name] = column
+        df = pd.DataFrame(columns)
+        convert_datetime_columns(df, inferred)
+        return df
+
+
+def set_value(columns: OrderedDict, name: str, row: int, value) -> None:
+    values = columns.get(name)
+    if values is None:
+        values = columns[name] = []
+    if len(values) < row:
+        pad(values, row)
+    values.append(value)
+
+
+def pad(values: list, length: int) -> None:
+    if len(values) < length:
+        values.extend([None] * (length - len(values)))
+
+
+def related_id(relationship):
+    """ The id of the related resource, or a list of ids for a to-many relationship.
+        None if the relationship has no data. """
+    try:
+        data = relationship['data']
+        if isinstance(data, list):
+            return [item['id'] for item in data]
+        return data['id']
+    except (TypeError, KeyError):
+        return None
+
+
+def related_type(relationship) -> str:
+    """ The type of resource a relationship refers to, if it says """
+    try:
+        data = relationship['data']
+        if isinstance(data, list):
+            data = data[0]
+        return data['type']
+    except (TypeError, KeyError, IndexError):
+        return None
+
+
+def tables_by_type(resources: Iterable[dict]) -> OrderedDict:
+    """ Flattens resources into one ResourceTable per type, in order of first appearance """
+    tables = OrderedDict()
+    for resource in resources:
+        append_resource(tables, resource)
+    return tables
+
+
+def append_resource(tables: OrderedDict, resource: dict) -> None:
+    """ Append a resource to the table of its type in tables, adding one if needed """
+    table = tables.get(resource['type'])
+    if table is None:
+        table = tables[resource['type']] = ResourceTable()
+    table.append(resource)
+
+
+def convert_datetime_columns(df: pd.DataFrame, columns=None) -> None:
+    """ Convert datetime columns from ISO8601 to pandas datetime format"""
+    for column in (df.columns if columns is None else columns):
+        if column.endswith(('created_at', 'updated_at')):
+            df[column] = pd.to_datetime(df[column])
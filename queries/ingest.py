@@ -0,0 +1,69 @@
+"""
+Single-pass decoding of MBTA API (JSON:API) documents.
+
+The body is read as a stream of parser events. Each resource in 'data' and 'included'
+is assembled on its own and appended straight into column tables, so the document as
+a whole is never held as Python objects.
+
+The raw body itself is held in memory, though: responses are decoded from
+response.content, which the response cache and the raw results download need anyway.
+Its size is capped by MBTA_API_MAX_RESPONSE_BYTES (see core.upstream.read_body), which
+is what bounds a worker's memory for one response, not the streaming.
+"""
+from collections import OrderedDict
+import io
+import ijson
+from ijson.common import ObjectBuilder
+from .flatten import append_resource
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class Document:
+    """ The decoded contents of a JSON:API document """
+
+    def __init__(self):
+        self.data = OrderedDict()
+        self.included = OrderedDict()
+        self.has_included = False
+        self.errors = []
+        self.links = {}
+
+
+def decode(content) -> Document:
+    """ Decode a document from bytes or a binary file object (which is read incrementally) """
+    source = io.BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+    try:
+        return decode_events(ijson.parse(source, use_float=True))
+    except ijson.JSONError as error:
+        raise DecodeError(f'response is not valid JSON: {error}') from error
+
+
+def decode_events(events) -> Document:
+    document = Document()
+    sinks = {
+        'data.item': lambda value: append_resource(document.data, value),
+        'data': lambda value: append_resource(document.data, value),
+        'included.item': lambda value: append_resource(document.included, value),
+        'errors.item': document.errors.append,
+        'links': document.links.update,
+    }
+    builder = None
+    builder_prefix = None
+
+    for prefix, event, value in events:
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builder_prefix and event == 'end_map':
+                sinks[builder_prefix](builder.value)
+                builder = None
+        elif event == 'start_map' and prefix in sinks:
+            builder = ObjectBuilder()
+            builder_prefix = prefix
+            builder.event(event, value)
+        elif prefix == '' and event == 'map_key' and value == 'included':
+            document.has_included = True
+
+    return document
@@ -0,0 +1,148 @@
+"""
+Background workers for profile reports.
+
+Jobs are recorded as ReportJob rows, so any web worker can answer status polls, and are
+run by a local executor: a thread pool by default, or a process pool when
+REPORT_JOB_BACKEND is 'process'. Web workers only enqueue jobs and stay free for
+interactive traffic.
+
+Finished reports go into the report cache, so a job for a report which already exists
+is done as soon as it's created.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+import logging
+import threading
+from . import report_cache
+from .models import ReportJob, Results
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+_futures = {}
+
+
+class TooManyJobs(Exception):
+    pass
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            if settings.REPORT_JOB_BACKEND == 'process':
+                _executor = ProcessPoolExecutor(
+                    max_workers=settings.REPORT_JOB_WORKERS, initializer=init_worker_process)
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.REPORT_JOB_WORKERS, thread_name_prefix='report-job')
+        return _executor
+
+
+def init_worker_process() -> None:
+    """ Worker processes must not share the parent's database connections """
+    import django
+    django.setup()
+    connections.close_all()
+
+
+def submit(query, results, correlations, user=None, session_key='') -> ReportJob:
+    """ Create a job for a report and queue it, unless the report is already cached.
+        Raises TooManyJobs if the user (or anonymous session) already has
+        REPORT_JOBS_PER_USER jobs queued or running. """
+    job_fields = {
+        'query': query,
+        'user': user,
+        'session_key': session_key,
+        'results_key': results.key,
+        'correlations': ','.join(sorted(correlations or [])),
+    }
+    cached_path = report_cache.get(results.report_key(correlations))
+    if cached_path is not None:
+        now = timezone.now()
+        return ReportJob.objects.create(
+            **job_fields, status=ReportJob.DONE, progress=100, report_path=cached_path,
+            started=now, finished=now)
+
+    # The count and the insert happen under a lock on the user's active jobs, so that
+    # concurrent requests can't both see room under the cap
+    with transaction.atomic():
+        active_jobs = ReportJob.objects.select_for_update().filter(status__in=ReportJob.ACTIVE_STATUSES)
+        if user is not None:
+            active_jobs = active_jobs.filter(user=user)
+        else:
+            active_jobs = active_jobs.filter(session_key=session_key)
+        for job in active_jobs:
+            expire_if_stale(job)
+        if active_jobs.count() >= settings.REPORT_JOBS_PER_USER:
+            raise TooManyJobs(
+                f'Reports are already being generated (limit: {settings.REPORT_JOBS_PER_USER} at a time)')
+        job = ReportJob.objects.create(**job_fields)
+
+    future = get_executor().submit(run, job.pk)
+    with _lock:
+        _futures[job.pk] = future
+    future.add_done_callback(lambda f: forget(job.pk))
+    return job
+
+
+def forget(job_id: int) -> None:
+    with _lock:
+        _futures.pop(job_id, None)
+
+
+def cancel(job: ReportJob) -> bool:
+    """ Cancel a queued or running job. A report which is already being generated can't be
+        interrupted, but its output is discarded. Returns False if the job had already ended. """
+    cancelled = ReportJob.objects.filter(pk=job.pk, status__in=ReportJob.ACTIVE_STATUSES).update(
+        status=ReportJob.CANCELLED, finished=timezone.now())
+    with _lock:
+        future = _futures.get(job.pk)
+    if future is not None:
+        future.cancel()
+    job.refresh_from_db()
+    return bool(cancelled)
+
+
+def expire_if_stale(job: ReportJob) -> None:
+    """ Jobs are lost if the process running them restarts, so active jobs older than
+        REPORT_JOB_TIMEOUT are marked as failed. """
+    cutoff = timezone.now() - timedelta(seconds=settings.REPORT_JOB_TIMEOUT)
+    if job.is_active() and job.created < cutoff:
+        ReportJob.objects.filter(pk=job.pk, status__in=ReportJob.ACTIVE_STATUSES).update(
+            status=ReportJob.FAILED, error='Timed out', finished=timezone.now())
+        job.refresh_from_db()
+
+
+def run(job_id: int) -> None:
+    """ Generate the report for a job. Runs in a background thread or process. """
+    try:
+        started = ReportJob.objects.filter(pk=job_id, status=ReportJob.QUEUED).update(
+            status=ReportJob.RUNNING, started=timezone.now(), progress=10)
+        if not started:
+            return  # cancelled while queued
+        job = ReportJob.objects.select_related('query__primary_object').get(pk=job_id)
+        results = Results.load(job.query, job.results_key)
+        if results is None or results.df is None:
+            raise ValueError('The results for this query have expired, please reload the page')
+        ReportJob.objects.filter(pk=job_id).update(progress=30)
+
+        key = results.report_key(job.correlation_list())
+        path = report_cache.get(key)  # another job may have built it in the meantime
+        if path is None:
+            html = results.generate_report_html(correlations=job.correlation_list())
+            path = report_cache.put(key, html)
+        # If the job was cancelled while running, the report stays cached for next time
+        ReportJob.objects.filter(pk=job_id, status=ReportJob.RUNNING).update(
+            status=ReportJob.DONE, progress=100, report_path=path, finished=timezone.now())
+    except Exception as e:
+        logger.exception(f'Error creating profile report: {e}')
+        ReportJob.objects.filter(pk=job_id, status__in=ReportJob.ACTIVE_STATUSES).update(
+            status=ReportJob.FAILED, error=str(e), finished=timezone.now())
+    finally:
+        connection.close()
@@ -0,0 +1,157 @@
+"""
+Joins included resources onto the primary resources.
+
+Each relationship column is joined with the included resources of the type it refers to,
+as recorded by ResourceTable while flattening, so relationships whose names don't match
+their type (representative_trip, parent_station) need no special cases. Each included
+type gets an id index, built once, and every relationship is resolved by looking its ids
+up in that index. The joined columns are taken by position, so their dtypes (categories,
+timezones) are kept. The frame is assembled once at the end instead of being copied by a
+merge per type.
+
+- To-one relationships add a '<relationship>_<column>' column per included column, with
+  '<relationship>_id' holding the related id, dictionary-encoded.
+- To-many relationships (lists of ids) are aggregated rather than exploded, so there is
+  still one row per primary resource: their columns hold a list of values per row.
+- Included resources' own relationships (e.g. include=trip.shape) are joined the same way
+  and prefixed with the path to them ('trip_shape_polyline'). Only the relationships on
+  the query's include paths are joined: with include=route,trip, a trip's route stays an
+  id, even though routes are included. A type is never joined onto itself.
+"""
+from collections import OrderedDict, namedtuple
+import numpy as np
+import pandas as pd
+
+
+Included = namedtuple('Included', ['df', 'related_types'])
+
+
+class Joiner:
+
+    def __init__(self, included: dict, includes=None):
+        """ included maps resource types to Included(df, related_types), where
+            related_types maps the frame's relationship columns to the types they refer to.
+            includes are the query's include paths (e.g. 'trip.shape'); if None, every
+            relationship to an included type is joined. """
+        # A resource can only be included once, but a page boundary could repeat one
+        self.included = {
+            resource_type: inc._replace(df=inc.df.drop_duplicates('id').reset_index(drop=True))
+            if not inc.df['id'].is_unique else inc
+            for resource_type, inc in included.items()
+        }
+        self.paths = None
+        if includes is not None:
+            # Including trip.shape includes the trips too
+            parts = [path.split('.') for path in includes if path]
+            self.paths = {'.'.join(p[:i]) for p in parts for i in range(1, len(p) + 1)}
+        self.indexes = {}
+        self.expanded = {}
+
+    def index(self, resource_type: str) -> pd.Index:
+        if resource_type not in self.indexes:
+            self.indexes[resource_type] = pd.Index(self.included[resource_type].df['id'])
+        return self.indexes[resource_type]
+
+    def join(self, df: pd.DataFrame, related_types: dict, prefix: str = '', path=frozenset(),
+             include_path: str = '') -> pd.DataFrame:
+        """ df with its relationship columns replaced by the resources they refer to.
+            prefix is prepended to the names of df's own columns. path holds the types
+            joined so far, and include_path the relationships which led to df. """
+        columns = OrderedDict()
+        joined = OrderedDict()
+        for column in df.columns:
+            resource_type = related_types.get(column)
+            column_path = f'{include_path}.{column}' if include_path else column
+            if resource_type in self.included and resource_type not in path and self.requested(column_path):
+                joined[column] = (resource_type, column_path)
+            else:
+                columns[f'{prefix}{column}'] = df[column]
+
+        for relationship, (resource_type, column_path) in joined.items():
+            related = self.expand(resource_type, path | {resource_type}, column_path)
+            keys = df[relationship]
+            if is_to_many(keys):
+                columns[f'{relationship}_id'] = keys
+                columns.update(self.aggregate(relationship, keys, related, self.index(resource_type)))
+            else:
+                keys = encode(keys)
+                columns[f'{relationship}_id'] = keys
+                positions = lookup(self.index(resource_type), keys)
+                for column in related.columns:
+                    if column != 'id':
+                        columns[f'{relationship}_{column}'] = take(related[column], positions)
+
+        return pd.DataFrame(columns, index=df.index)
+
+    def requested(self, include_path: str) -> bool:
+        return self.paths is None or include_path in self.paths
+
+    def expand(self, resource_type: str, path: frozenset, include_path: str) -> pd.DataFrame:
+        """ An included type's frame, with its own relationships on the include paths joined """
+        # Without include paths, the frame is the same whichever relationship led to it
+        key = (resource_type, path, include_path if self.paths is not None else None)
+        if key not in self.expanded:
+            included = self.included[resource_type]
+            self.expanded[key] = self.join(
+                included.df, included.related_types, path=path, include_path=include_path)
+        return self.expanded[key]
+
+    def aggregate(self, name: str, keys: pd.Series, related: pd.DataFrame, index: pd.Index) -> OrderedDict:
+        """ Columns of lists, one per column of the related frame """
+        lists = [ids if isinstance(ids, list) else [] for ids in keys]
+        lengths = np.fromiter((len(ids) for ids in lists), dtype=np.int64, count=len(lists))
+        flat_ids = [i for ids in lists for i in ids]
+        positions = index.get_indexer(flat_ids) if flat_ids else np.empty(0, dtype=np.intp)
+        bounds = np.cumsum(lengths)[:-1]
+        columns = OrderedDict()
+        for column in related.columns:
+            if column == 'id':
+                continue
+            values = np.asarray(take(related[column], positions).astype(object))
+            chunks = np.split(values, bounds) if len(lists) else []
+            columns[f'{name}_{column}'] = pd.Series(
+                [[None if is_missing(v) else v for v in chunk] for chunk in chunks], index=keys.index, dtype=object)
+        return columns
+
+
+def join_includes(df: pd.DataFrame, related_types: dict, included: dict, prefix: str,
+                  includes=None) -> pd.DataFrame:
+    """ See Joiner. The primary frame's columns are prefixed with prefix. """
+    return Joiner(included, includes).join(df, related_types, prefix=prefix)
+
+
+def is_to_many(keys: pd.Series) -> bool:
+    if keys.dtype != object:
+        return False
+    first = keys.dropna().iloc[:1]
+    return len(first) > 0 and isinstance(first.iloc[0], list)
+
+
+def encode(keys: pd.Series) -> pd.Series:
+    """ Dictionary-encode ids, unless they already are """
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        return keys
+    codes, uniques = pd.factorize(keys)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=uniques), index=keys.index, name=keys.name)
+
+
+def lookup(index: pd.Index, keys: pd.Series) -> np.ndarray:
+    """ The position of each (dictionary-encoded) key in the index, or -1.
+        Each distinct id is only looked up once. """
+    category_positions = index.get_indexer(keys.cat.categories)
+    codes = keys.cat.codes.to_numpy()
+    return np.where(codes >= 0, category_positions[codes], -1)
+
+
+def take(series: pd.Series, positions: np.ndarray):
+    """ Values of a column by position, with missing values where the position is -1.
+        Extension arrays keep their dtype; numpy integers become floats if any are missing. """
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        values = series.array
+    else:
+        values = series.to_numpy()
+    return pd.api.extensions.take(values, positions, allow_fill=True)
+
+
+def is_missing(value) -> bool:
+    return value is None or (pd.api.types.is_scalar(value) and pd.isna(value))
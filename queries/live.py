@@ -0,0 +1,228 @@
+"""
+Live results, streamed from the MBTA API as server-sent events.
+
+Each distinct request (URL and parameters) has at most one upstream stream per process,
+shared by every browser watching it. The API's reset/add/update/remove events are applied
+to an id-indexed DataFrame as they arrive, and subscribers are only sent what changed.
+Only resources of the query's primary type are tracked; included resources are ignored.
+"""
+from django.conf import settings
+from collections import deque
+import datetime
+import json
+import logging
+import math
+import threading
+import time
+import pandas as pd
+import requests
+from core import response_cache, upstream
+from .flatten import ResourceTable
+from .schema import resource_type
+
+
+logger = logging.getLogger(__name__)
+
+# Subscribers further behind than this many changes are sent a new snapshot instead
+CHANGE_LOG_SIZE = 1000
+RECONNECT_MAX_DELAY = 30
+
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+class LiveStream:
+    """ One upstream event stream, and the DataFrame it keeps up to date """
+
+    def __init__(self, key: str, url: str, params: dict, headers: dict, resource_type: str):
+        self.key = key
+        self.url = url
+        self.params = params
+        self.headers = headers
+        self.resource_type = resource_type
+        self.df = None
+        self.version = 0
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE)
+        self.error = None
+        self.subscribers = 0
+        self.idle_since = time.monotonic()
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=f'live-{key[-8:]}', daemon=True)
+
+    def run(self) -> None:
+        delay = 1
+        try:
+            while not self.should_stop():
+                try:
+                    for event, data in upstream.stream(self.url, params=self.params, headers=self.headers):
+                        self.apply(event, json.loads(data))
+                        delay = 1
+                        if self.should_stop():
+                            return
+                except (requests.RequestException, ValueError) as error:
+                    logger.warning(f'Live stream for {self.url} failed: {error}')
+                    with self.condition:
+                        self.error = str(error)
+                        self.condition.notify_all()
+                if not self.should_stop():
+                    time.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        finally:
+            with _streams_lock:
+                self.stopped = True
+                if _streams.get(self.key) is self:
+                    del _streams[self.key]
+            with self.condition:
+                self.condition.notify_all()
+
+    def should_stop(self) -> bool:
+        with self.condition:
+            idle_for = time.monotonic() - self.idle_since
+            return self.subscribers == 0 and idle_for > settings.LIVE_STREAM_IDLE_SECONDS
+
+    def apply(self, event: str, payload) -> None:
+        """ Apply an event from the API to the DataFrame and log the change """
+        with self.condition:
+            if event == 'reset':
+                resources = [r for r in payload if r.get('type') == self.resource_type]
+                self.df = build_frame(resources)
+                change = None  # subscribers need a new snapshot
+            elif payload.get('type') != self.resource_type:
+                return
+            elif event in ('add', 'update'):
+                row = build_row(payload)
+                self.upsert(payload['id'], row)
+                change = {'op': 'upsert', 'id': payload['id'], 'row': json_row(row)}
+            elif event == 'remove':
+                if self.df is not None and payload['id'] in self.df.index:
+                    self.df = self.df.drop(index=payload['id'])
+                change = {'op': 'remove', 'id': payload['id']}
+            else:
+                return
+            self.version += 1
+            self.changes.append((self.version, change))
+            self.error = None
+            self.condition.notify_all()
+
+    def upsert(self, resource_id: str, row: dict) -> None:
+        if self.df is None:
+            self.df = build_frame([])
+        for column in row:
+            if column not in self.df.columns:
+                self.df[column] = None
+        if resource_id in self.df.index:
+            for column, value in row.items():
+                self.df.at[resource_id, column] = value
+        else:
+            self.df.loc[resource_id] = pd.Series(row, dtype=object)
+
+    def changes_since(self, version: int) -> list:
+        """ The changes after a version, or None if a snapshot is needed instead.
+            Must be called while holding the condition. """
+        if version < 0 or self.df is None:
+            return None
+        if version == self.version:
+            return []
+        if not self.changes or self.changes[0][0] > version + 1:
+            return None
+        changes = [change for v, change in self.changes if v > version]
+        return None if None in changes else changes
+
+    def snapshot(self) -> dict:
+        """ Must be called while holding the condition """
+        df = self.df if self.df is not None else build_frame([])
+        return {
+            'columns': [str(c) for c in df.columns],
+            'rows': [json_row(row) for row in df.to_dict('records')],
+        }
+
+    def subscribe(self):
+        """
+        Yields the stream as server-sent events for one browser: a 'snapshot' of the
+        whole frame, then a 'delta' with the changes each time it's updated. A comment is
+        sent when nothing has changed for LIVE_STREAM_HEARTBEAT_SECONDS, so that dropped
+        connections are noticed. The subscriber is counted until the generator is closed.
+        """
+        version = -1  # the last version sent
+        seen = None  # the last version looked at
+        try:
+            with self.condition:
+                self.subscribers += 1
+            while not self.stopped:
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: self.version != seen or self.stopped,
+                        timeout=settings.LIVE_STREAM_HEARTBEAT_SECONDS,
+                    )
+                    seen = self.version
+                    changes = self.changes_since(version)
+                    snapshot = self.snapshot() if changes is None and self.df is not None else None
+                    error = self.error
+                    if changes is not None or snapshot is not None:
+                        version = self.version
+                if snapshot is not None:
+                    yield sse('snapshot', snapshot)
+                elif changes:
+                    yield sse('delta', changes)
+                elif error:
+                    yield sse('status', {'error': error})
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            self.unsubscribe()
+
+    def unsubscribe(self) -> None:
+        with self.condition:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.idle_since = time.monotonic()
+
+
+def get_stream(api_request) -> LiveStream:
+    """ The live stream for a request (see queries.models.Request), started if there isn't
+        one already. It stops once it has had no subscribers for LIVE_STREAM_IDLE_SECONDS. """
+    url = api_request.url()
+    params = api_request.params()
+    key = response_cache.cache_key(url, params)
+    with _streams_lock:
+        stream = _streams.get(key)
+        if stream is None:
+            stream = _streams[key] = LiveStream(
+                key, url, params, api_request.headers(), resource_type(api_request.query.primary_object.name))
+            stream.thread.start()
+    return stream
+
+
+def build_frame(resources: list) -> pd.DataFrame:
+    """ Object dtype throughout, so updates never have to convert a column """
+    table = ResourceTable()
+    table.extend(resources)
+    df = table.to_frame().astype(object)
+    df.index = df['id']
+    df.index.name = None
+    return df
+
+
+def build_row(resource: dict) -> dict:
+    table = ResourceTable()
+    table.append(resource)
+    return table.to_frame().to_dict('records')[0]
+
+
+def json_row(row: dict) -> dict:
+    return {str(column): json_value(value) for column, value in row.items()}
+
+
+def json_value(value):
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        return None if pd.isnull(value) else value.isoformat()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if value is pd.NaT:
+        return None
+    return value
+
+
+def sse(event: str, data) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
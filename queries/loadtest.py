@@ -0,0 +1,228 @@
+"""
+An end-to-end load test of the site, used by the 'loadtest' management command.
+
+Virtual users, each with their own session, repeatedly create a query, view its results,
+export them as CSV and generate a report, for a fixed time. Run it against a deployment
+whose MBTA_API_ROOT points at the fake API (see core.fake_api and 'run_fake_api'), so
+no API quota is used.
+
+Identical queries are deduplicated (see queries.fingerprint), so most iterations reuse
+cached results. A fraction of them can be made 'cold' instead, with a filter value no
+other query has, so they go through the whole pipeline.
+
+Worker memory is sampled from /proc (so only on Linux), for the given process ids and
+their children, e.g. a gunicorn master and its workers.
+"""
+from collections import namedtuple, OrderedDict
+from django.urls import reverse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+import numpy as np
+import requests
+from params.models import MbtaObject
+from .timings import PERCENTILES
+
+
+ENDPOINTS = ['create', 'results', 'csv', 'report']
+REPORT_POLL_SECONDS = 0.5
+# After a query can't be created, users wait this long (doubling, up to the maximum, with
+# jitter so they don't all retry at once) before trying again
+CREATE_BACKOFF_SECONDS = 0.1
+CREATE_BACKOFF_MAX_SECONDS = 5.0
+
+Sample = namedtuple('Sample', ['endpoint', 'status', 'seconds'])
+
+
+def query_forms(object_names=None) -> list:
+    """ Form data for creating a query of each object: all its attributes, and the
+        includes which refer to other objects, so that the results have joins """
+    objects = MbtaObject.objects.filter(active=True, requires_filters=False)
+    if object_names:
+        objects = objects.filter(name__in=object_names)
+    forms = []
+    for obj in objects.prefetch_related('attributes', 'includes', 'filters'):
+        forms.append({
+            'primary_object': obj.pk,
+            'attributes': [a.pk for a in obj.attributes.all() if a.active],
+            'includes': [i.pk for i in obj.includes.all() if i.active and i.associated_object_id],
+            'filter_ids': [f.pk for f in obj.filters.all() if f.active],
+        })
+    return forms
+
+
+class VirtualUser:
+    """ One user's session, going through the endpoints in turn until the deadline """
+
+    def __init__(self, base_url: str, forms: list, endpoints: list, samples: list,
+                 cold_fraction: float = 0.0, report_timeout: float = 120, seed: int = 0):
+        self.base_url = base_url.rstrip('/')
+        self.forms = forms
+        self.endpoints = endpoints
+        self.samples = samples
+        self.cold_fraction = cold_fraction
+        self.report_timeout = report_timeout
+        self.random = random.Random(seed)
+        self.session = requests.Session()
+        self.results_url = None
+        self.failures = 0  # queries which couldn't be created
+
+    def run(self, deadline: float) -> None:
+        failures = 0  # in a row
+        while time.monotonic() < deadline:
+            results_url = self.create_query()
+            if results_url is None:
+                # Don't hammer a site which is failing, or spin when it can't be reached
+                self.failures += 1
+                failures += 1
+                delay = min(CREATE_BACKOFF_SECONDS * 2 ** (failures - 1), CREATE_BACKOFF_MAX_SECONDS)
+                time.sleep(min(delay * self.random.uniform(0.5, 1.0), max(deadline - time.monotonic(), 0)))
+                continue
+            failures = 0
+            if 'results' in self.endpoints:
+                self.request('results', 'get', results_url)
+            if 'csv' in self.endpoints:
+                self.request('csv', 'get', f'{results_url}csv/', stream=True)
+            if 'report' in self.endpoints:
+                self.generate_report(results_url)
+
+    def create_query(self) -> str:
+        """ The URL of the results of a query, created through the form.
+            Without the 'create' endpoint, the query is only created once. """
+        if 'create' not in self.endpoints and self.results_url is not None:
+            return self.results_url
+        form = self.random.choice(self.forms)
+        filters = {}
+        if form['filter_ids'] and self.random.random() < self.cold_fraction:
+            filters[form['filter_ids'][0]] = f'loadtest-{uuid.uuid4().hex[:12]}'
+        create_url = self.base_url + reverse('queries:create')
+        if 'csrftoken' not in self.session.cookies:
+            self.session.get(create_url)
+        response = self.request('create', 'post', create_url, allow_redirects=False, data={
+            'csrfmiddlewaretoken': self.session.cookies.get('csrftoken', ''),
+            'primary_object': form['primary_object'],
+            'attributes': form['attributes'],
+            'includes': form['includes'],
+            'filters': json.dumps(filters),
+        }, headers={'Referer': create_url})
+        if response is None or not re.search(r'/results/\d+/$', response.headers.get('Location', '')):
+            return None
+        self.results_url = requests.compat.urljoin(create_url, response.headers['Location'])
+        return self.results_url
+
+    def generate_report(self, results_url: str) -> None:
+        """ Queue a report and poll until it's done. 'report' is the time to queue it,
+            'report_ready' the time until it was done. """
+        started = time.perf_counter()
+        response = self.request('report', 'post', f'{results_url}report/', data={
+            'csrfmiddlewaretoken': self.session.cookies.get('csrftoken', ''),
+        }, headers={'Referer': results_url})
+        if response is None:
+            return
+        job = response.json()
+        while job['status'] in ('queued', 'running'):
+            if time.perf_counter() - started > self.report_timeout:
+                self.samples.append(Sample('report_ready', 0, time.perf_counter() - started))
+                return
+            time.sleep(REPORT_POLL_SECONDS)
+            try:
+                job = self.session.get(self.base_url + job['status_url']).json()
+            except (requests.RequestException, ValueError):
+                job = {'status': 'failed'}
+        status = 200 if job['status'] == 'done' else 500
+        self.samples.append(Sample('report_ready', status, time.perf_counter() - started))
+
+    def request(self, endpoint: str, method: str, url: str, stream: bool = False, **kwargs):
+        """ Send a request and record how long it took, including reading the body.
+            Returns the response, or None if it failed. """
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, stream=stream, **kwargs)
+            for _ in response.iter_content(64 * 1024):
+                pass
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        self.samples.append(Sample(endpoint, status, time.perf_counter() - started))
+        return response if status and status < 400 else None
+
+
+class MemorySampler(threading.Thread):
+    """ Samples the resident memory of some processes and their children """
+
+    def __init__(self, pids: list, interval: float = 1.0):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.rss = OrderedDict()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while True:
+            self.sample()
+            if self.stopped.wait(self.interval):
+                break
+        self.sample()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def sample(self) -> None:
+        for pid in self.processes():
+            rss = resident_bytes(pid)
+            if rss is not None:
+                self.rss.setdefault(pid, []).append(rss)
+
+    def processes(self) -> list:
+        pids = list(self.pids)
+        for pid in self.pids:
+            pids.extend(child_pids(pid))
+        return pids
+
+
+def resident_bytes(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def child_pids(pid: int) -> list:
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def summarize(samples: list, seconds: float) -> list:
+    """ Requests, errors, throughput and latency percentiles per endpoint """
+    by_endpoint = OrderedDict((endpoint, []) for endpoint in ENDPOINTS + ['report_ready'])
+    for sample in samples:
+        by_endpoint.setdefault(sample.endpoint, []).append(sample)
+    summary = []
+    for endpoint, endpoint_samples in by_endpoint.items():
+        if not endpoint_samples:
+            continue
+        latencies = [s.seconds for s in endpoint_samples]
+        summary.append(dict(
+            endpoint=endpoint,
+            requests=len(endpoint_samples),
+            errors=sum(1 for s in endpoint_samples if not s.status or s.status >= 400),
+            throughput=len(endpoint_samples) / seconds,
+            max=max(latencies),
+            **{f'p{p}': v for p, v in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))},
+        ))
+    return summary
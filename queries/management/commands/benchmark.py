@@ -0,0 +1,162 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import json
+import os
+import pandas as pd
+from queries import benchmarks, dtypes, exports, flatten, ingest
+from queries.models import Results, build_location_plots, create_DataFrame
+
+
+SIZES = [1000, 10000]
+LEGACY_SIZES = [1000, 10000, 100000]
+STAGES = ['decode', 'create_DataFrame', 'optimize', 'location_plots', 'report_html', 'csv']
+# Changes smaller than these are noise, whatever the threshold
+MIN_REGRESSION_SECONDS = 0.002
+MIN_REGRESSION_BYTES = 64 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark stages of the results pipeline using synthetic MBTA API payloads. '
+        'Runs offline: no API key or network access is needed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=list(benchmarks.SCENARIOS),
+                            default=list(benchmarks.SCENARIOS), help='Kinds of payload to generate')
+        parser.add_argument('--sizes', nargs='+', type=int, default=None,
+                            help='Numbers of resources to generate (1000 and 10000 by default, '
+                                 'and also 100000 with --legacy)')
+        parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                            help='Stages of the pipeline to measure')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per measurement (the fastest is reported)')
+        parser.add_argument('--report-max-rows', type=int, default=2000,
+                            help='Skip the (slow) report stage for larger payloads')
+        parser.add_argument('--baseline', default=os.path.join(settings.VAR_DIR, 'benchmark_baseline.json'),
+                            help='File the baseline is read from and saved to')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Save these measurements as the baseline instead of comparing with it')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Flag stages which are slower or use more memory than the baseline by this fraction')
+        parser.add_argument('--legacy', action='store_true',
+                            help='Instead, compare row-by-row flattening with the columnar ResourceTable')
+
+    def handle(self, *args, **options):
+        if options['legacy']:
+            self.benchmark_flatten(options['sizes'] or LEGACY_SIZES, options['repeat'])
+            return
+        options['sizes'] = options['sizes'] or SIZES
+
+        baseline = None if options['save_baseline'] else self.load_baseline(options['baseline'])
+        measurements = {}
+        regressions = []
+        self.stdout.write(
+            f'{"scenario":<10} {"resources":>9} {"stage":<17} {"seconds":>9} {"peak MiB":>9} {"vs baseline":>22}')
+        for scenario in options['scenarios']:
+            for size in options['sizes']:
+                for stage, measurement in self.benchmark_pipeline(scenario, size, options):
+                    key = f'{scenario}/{size}/{stage}'
+                    measurements[key] = measurement
+                    comparison, regressed = compare(measurement, (baseline or {}).get(key), options['threshold'])
+                    if regressed:
+                        regressions.append(key)
+                    self.stdout.write(
+                        f'{scenario:<10} {size:>9} {stage:<17} {measurement["seconds"]:>9.4f} '
+                        f'{measurement["peak_bytes"] / 2 ** 20:>9.1f} {comparison:>22}')
+
+        if options['save_baseline']:
+            self.save_baseline(options['baseline'], measurements)
+        if regressions:
+            raise CommandError(
+                f'{len(regressions)} regression(s) over {options["threshold"]:.0%}: {", ".join(regressions)}')
+
+    def benchmark_pipeline(self, scenario, size, options):
+        """ Yields (stage, measurement) for each stage, feeding each stage's output to the next """
+        repeat = options['repeat']
+        stages = options['stages']
+        content = benchmarks.synthetic_document(scenario, size)
+        document = ingest.decode(content)
+        if 'decode' in stages:
+            yield 'decode', benchmarks.measure(ingest.decode, lambda: (content,), repeat)
+
+        df = create_DataFrame(document, benchmarks.SCHEMAS)
+        if 'create_DataFrame' in stages:
+            yield 'create_DataFrame', benchmarks.measure(
+                create_DataFrame, lambda: (document, benchmarks.SCHEMAS), repeat)
+
+        if 'optimize' in stages:
+            yield 'optimize', benchmarks.measure(dtypes.optimize, lambda: (df.copy(),), repeat)
+        dtypes.optimize(df)
+
+        has_locations = any(c.endswith('latitude') for c in df.columns)
+        if 'location_plots' in stages and has_locations:
+            yield 'location_plots', benchmarks.measure(
+                build_location_plots, lambda: (df, scenario.title()), repeat)
+
+        if 'report_html' in stages and size <= options['report_max_rows']:
+            results = Results(None)
+            results.df = df
+            yield 'report_html', benchmarks.measure(results.generate_report_html, repeat=repeat)
+
+        if 'csv' in stages:
+            yield 'csv', benchmarks.measure(
+                lambda frame: sum(len(chunk) for chunk in exports.csv_chunks(frame)), lambda: (df,), repeat)
+
+    def load_baseline(self, path):
+        if not os.path.exists(path):
+            self.stdout.write(f'No baseline at {path}; run with --save-baseline to create one')
+            return None
+        with open(path) as f:
+            saved = json.load(f)
+        if saved['environment'] != benchmarks.environment():
+            self.stderr.write(
+                f'The baseline was measured with {saved["environment"]}, '
+                f'not {benchmarks.environment()}; comparisons may not be meaningful')
+        return saved['measurements']
+
+    def save_baseline(self, path, measurements):
+        """ Measurements of stages which weren't run this time are kept """
+        saved = {'environment': benchmarks.environment(), 'measurements': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                previous = json.load(f)
+            if previous['environment'] == saved['environment']:
+                saved['measurements'] = previous['measurements']
+        saved['measurements'].update(measurements)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        self.stdout.write(f'Saved the baseline to {path}')
+
+    def benchmark_flatten(self, sizes, repeat):
+        """ Compare row-by-row flattening with the columnar ResourceTable """
+        def legacy(resources):
+            return benchmarks.legacy_clean_DataFrame(pd.DataFrame(resources))
+
+        def columnar(resources):
+            return flatten.tables_by_type(resources)['vehicle'].to_frame()
+
+        self.stdout.write(f'{"resources":>10} {"legacy (s)":>12} {"columnar (s)":>13} {"speedup":>8}')
+        for size in sizes:
+            resources = benchmarks.synthetic_vehicles(size)
+            if list(legacy(resources[:100]).columns) != list(columnar(resources[:100]).columns):
+                self.stderr.write('Column layouts differ')
+            legacy_time = benchmarks.best_time(legacy, resources, repeat=repeat)
+            columnar_time = benchmarks.best_time(columnar, resources, repeat=repeat)
+            self.stdout.write(
+                f'{size:>10} {legacy_time:>12.3f} {columnar_time:>13.3f} {legacy_time / columnar_time:>7.1f}x')
+
+
+def compare(measurement: dict, baseline: dict, threshold: float):
+    """ A description of the change from the baseline, and whether it's a regression """
+    if baseline is None:
+        return '-', False
+    time_change = measurement['seconds'] / baseline['seconds'] - 1 if baseline['seconds'] else 0.0
+    memory_change = measurement['peak_bytes'] / baseline['peak_bytes'] - 1 if baseline['peak_bytes'] else 0.0
+    slower = (time_change > threshold
+              and measurement['seconds'] - baseline['seconds'] > MIN_REGRESSION_SECONDS)
+    bigger = (memory_change > threshold
+              and measurement['peak_bytes'] - baseline['peak_bytes'] > MIN_REGRESSION_BYTES)
+    flag = ' REGRESSION' if slower or bigger else ''
+    return f'{time_change:+.0%} time {memory_change:+.0%} mem{flag}', slower or bigger
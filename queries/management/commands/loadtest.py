@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand, CommandError
+from concurrent.futures import ThreadPoolExecutor
+import time
+from queries import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test a running site: virtual users create queries and fetch their results, '
+        'CSV exports and reports. Point the site at the fake API (run_fake_api) first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+                            help='Where the site is running')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Number of virtual users')
+        parser.add_argument('--duration', type=float, default=60,
+                            help='Seconds to run for')
+        parser.add_argument('--objects', nargs='+', default=None,
+                            help='Names of the objects to query (all active ones by default)')
+        parser.add_argument('--endpoints', nargs='+', choices=loadtest.ENDPOINTS, default=loadtest.ENDPOINTS,
+                            help='Endpoints to exercise')
+        parser.add_argument('--cold-fraction', type=float, default=0.0,
+                            help='Fraction of queries made unique, so their results are not cached')
+        parser.add_argument('--report-timeout', type=float, default=120,
+                            help='Seconds to wait for a report to be generated')
+        parser.add_argument('--pid', type=int, action='append', default=[],
+                            help='Process to sample the memory of, along with its children (repeatable)')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        forms = loadtest.query_forms(options['objects'])
+        if not forms:
+            raise CommandError('There are no objects to query; sync the params tables first')
+
+        samples = []
+        users = [
+            loadtest.VirtualUser(
+                options['url'], forms, options['endpoints'], samples,
+                cold_fraction=options['cold_fraction'],
+                report_timeout=options['report_timeout'],
+                seed=options['seed'] + i,
+            )
+            for i in range(options['concurrency'])
+        ]
+        sampler = loadtest.MemorySampler(options['pid'])
+        sampler.start()
+        self.stdout.write(
+            f'Running {len(users)} virtual users against {options["url"]} for {options["duration"]:g}s')
+        started = time.monotonic()
+        deadline = started + options['duration']
+        with ThreadPoolExecutor(max_workers=len(users)) as executor:
+            for future in [executor.submit(user.run, deadline) for user in users]:
+                future.result()
+        elapsed = time.monotonic() - started
+        sampler.stop()
+
+        self.write_latencies(loadtest.summarize(samples, elapsed), len(samples) / elapsed)
+        failures = sum(user.failures for user in users)
+        if failures:
+            self.stdout.write(f'{failures} queries could not be created; users backed off after each')
+        self.write_memory(sampler.rss)
+
+    def write_latencies(self, summary, throughput):
+        self.stdout.write(
+            f'\n{"endpoint":<13} {"requests":>8} {"errors":>6} {"req/s":>7} '
+            f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+        for row in summary:
+            self.stdout.write(
+                f'{row["endpoint"]:<13} {row["requests"]:>8} {row["errors"]:>6} {row["throughput"]:>7.1f} '
+                f'{row["p50"] * 1000:>8.0f} {row["p95"] * 1000:>8.0f} {row["p99"] * 1000:>8.0f} '
+                f'{row["max"] * 1000:>8.0f}')
+        self.stdout.write(f'Total throughput: {throughput:.1f} requests/s')
+
+    def write_memory(self, rss):
+        if not rss:
+            self.stdout.write('Pass --pid to sample worker memory')
+            return
+        self.stdout.write(f'\n{"pid":>8} {"start MiB":>10} {"peak MiB":>10} {"end MiB":>10}')
+        for pid, samples in rss.items():
+            self.stdout.write(
+                f'{pid:>8} {samples[0] / 2 ** 20:>10.1f} {max(samples) / 2 ** 20:>10.1f} '
+                f'{samples[-1] / 2 ** 20:>10.1f}')
+        self.stdout.write(f'Peak total: {sum(max(s) for s in rss.values()) / 2 ** 20:.1f} MiB')
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import os
+from queries import result_store
+
+
+class Command(BaseCommand):
+    help = 'Remove stored query results older than RESULT_STORE_MAX_AGE'
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(settings.RESULT_STORE_DIR):
+            return
+        before = len(os.listdir(settings.RESULT_STORE_DIR))
+        result_store.prune()
+        removed = before - len(os.listdir(settings.RESULT_STORE_DIR))
+        self.stdout.write(f'Removed {removed} file(s) from {settings.RESULT_STORE_DIR}')
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.5 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0003_auto_20190924_1400'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='cache_hits',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='request',
+            name='cache_misses',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='request',
+            name='cache_revalidations',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
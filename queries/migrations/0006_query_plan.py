@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2019-10-02 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0005_reportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='plan',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.5 on 2019-10-03 12:00
+
+from django.db import migrations, models
+from queries.fingerprint import fingerprint
+
+
+def backfill_fingerprints(apps, schema_editor):
+    Query = apps.get_model('queries', 'Query')
+    queries = list(Query.objects.prefetch_related('includes', 'attributes', 'filters'))
+    for query in queries:
+        query.fingerprint = fingerprint(
+            query.primary_object_id,
+            [i.pk for i in query.includes.all()],
+            [a.pk for a in query.attributes.all()],
+            [(f.on_attribute_id, f.values) for f in query.filters.all()],
+        )
+    Query.objects.bulk_update(queries, ['fingerprint'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0006_query_plan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.RunPython(backfill_fingerprints, migrations.RunPython.noop),
+    ]
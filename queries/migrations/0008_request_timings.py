@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2019-10-03 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0007_query_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='timings',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
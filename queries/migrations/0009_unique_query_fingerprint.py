@@ -0,0 +1,40 @@
+# Generated by Django 2.2.5 on 2019-10-04 12:00
+
+from django.db import migrations, models
+from queries.fingerprint import fingerprint
+
+
+def recompute_fingerprints(apps, schema_editor):
+    """ Fingerprints from 0007 dropped repeated filters on the same attribute. Only the
+        first of each set of identical queries keeps its fingerprint, so it can be unique. """
+    Query = apps.get_model('queries', 'Query')
+    queries = list(Query.objects.order_by('pk').prefetch_related('includes', 'attributes', 'filters'))
+    seen = set()
+    for query in queries:
+        query.fingerprint = fingerprint(
+            query.primary_object_id,
+            [i.pk for i in query.includes.all()],
+            [a.pk for a in query.attributes.all()],
+            [(f.on_attribute_id, f.values) for f in query.filters.all()],
+        )
+        if query.fingerprint in seen:
+            query.fingerprint = ''
+        seen.add(query.fingerprint)
+    Query.objects.bulk_update(queries, ['fingerprint'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0008_request_timings'),
+    ]
+
+    operations = [
+        migrations.RunPython(recompute_fingerprints, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='query',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(_negated=True, fingerprint=''), fields=('fingerprint',),
+                name='unique_query_fingerprint'),
+        ),
+    ]
@@ -1,21 +1,21 @@
 from django.db import models
 from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
 from django.utils.formats import date_format
 from typing import List
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from urllib.parse import parse_qs, urlsplit
 import json
 import requests
+import numpy as np
 import pandas as pd
-import pandas_profiling
-import matplotlib
-matplotlib.use('Agg')
-from bokeh.plotting import figure
-from bokeh.models import ColumnDataSource, HoverTool
-from bokeh.embed import json_item
-from bokeh.tile_providers import get_provider, Vendors
-from pyproj import Proj, transform
 from params.models import MbtaObject, MbtaInclude, MbtaAttribute, MbtaFilter
+from core import response_cache, singleflight, upstream
+from . import dtypes, fingerprint as query_fingerprint, ingest, joins, report_cache, result_store, schema
+from .timings import Timings
 
 
 class Query(models.Model):
@@ -42,33 +42,198 @@ class Query(models.Model):
         related_name='included_in_queries',
     )
     url = models.CharField(max_length=500, default='')
+    plan = models.TextField(blank=True, default='')
+    fingerprint = models.CharField(max_length=64, blank=True, default='', db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['fingerprint'], condition=~models.Q(fingerprint=''), name='unique_query_fingerprint'),
+        ]
 
     def __str__(self):
         return self.url
 
     def all_objects(self) -> List[MbtaObject]:
         objects = [self.primary_object]
-        for include in self.includes.filter(associated_object__isnull=False):
-            objects.append(include.associated_object)
+        for include in self.includes.all():
+            if include.associated_object is not None:
+                objects.append(include.associated_object)
         return objects
 
-    def get_response(self, request) -> requests.Response:
-        user = request.user if request.user.is_authenticated else None
-        response = Request(query=self, user=user).get()
-        self.url = response.url
-        self.save()
+    def get_plan(self) -> dict:
+        """ The request this query compiles to: the object's path, its cache TTL and the
+            request parameters. Compiled once and stored on the query; it's cleared when
+            the query's includes, attributes or filters change (see queries.signals). """
+        if self.plan:
+            plan = json.loads(self.plan)
+            if plan['primary_object_id'] == self.primary_object_id and 'schema' in plan:
+                return plan
+        plan = self.compile_plan()
+        self.plan = json.dumps(plan)
+        Query.objects.filter(pk=self.pk).update(plan=self.plan)
+        return plan
+
+    def compile_plan(self) -> dict:
+        """ Builds the plan with a fixed number of database queries, however many
+            includes, attributes and filters the query has """
+        models.prefetch_related_objects(
+            [self],
+            'primary_object',
+            'includes__associated_object',
+            'filters__on_attribute',
+            'attributes',
+        )
+        params = OrderedDict()
+        # Included objects
+        includes = list(self.includes.all())
+        if includes:
+            params['include'] = ','.join(x.name for x in includes)
+        # Filters
+        for f in self.filters.all():
+            params[f'filter[{f.on_attribute.name}]'] = f.values
+        # Fields/attributes (parameter is only added/needed if some attributes will be excluded)
+        objects = self.all_objects()
+        attribute_counts = dict(
+            MbtaAttribute.objects
+            .filter(for_object__in=objects)
+            .order_by()
+            .values_list('for_object')
+            .annotate(count=models.Count('id'))
+        )
+        for o in objects:
+            attributes = [a.name for a in self.attributes.all() if a.for_object_id == o.pk]
+            if len(attributes) < attribute_counts.get(o.pk, 0):
+                params[f'fields[{o.name.lower()}]'] = ','.join(attributes)
+
+        return {
+            'primary_object_id': self.primary_object_id,
+            'path': self.primary_object.path,
+            'cache_ttl': self.primary_object.cache_ttl,
+            'params': list(params.items()),
+            'schema': schema.compile_schema(objects),
+        }
+
+    def clear_plan(self) -> None:
+        self.plan = ''
+        Query.objects.filter(pk=self.pk).update(plan='')
+
+    def compute_fingerprint(self) -> str:
+        """ See queries.fingerprint """
+        return query_fingerprint.fingerprint(
+            self.primary_object_id,
+            self.includes.values_list('pk', flat=True),
+            self.attributes.values_list('pk', flat=True),
+            self.filters.values_list('on_attribute_id', 'values'),
+        )
+
+    def canonical(self):
+        """ The first query with the same fingerprint, which may be this one """
+        if not self.fingerprint:
+            return self
+        return Query.objects.filter(fingerprint=self.fingerprint).order_by('pk').first() or self
+
+    def get_response(self, api_request) -> requests.Response:
+        response = api_request.get()
+        if self.url != response.url:
+            self.url = response.url
+            self.save(update_fields=['url'])
         return response
 
+    def get_paged_results(self, api_request):
+        """ Get results from a response which is fetched in pages (see Results.read_pages) """
+        results = Results(self)
+        try:
+            results.read_pages(api_request)
+        finally:
+            api_request.save()
+        if results.url and self.url != results.url:
+            self.url = results.url
+            self.save(update_fields=['url'])
+        return results
+
     def get_results(self, request, get_from_cache=False):
-        """ Get results. Use the session cache to store them for quick access later."""
+        """ Get results. They are kept in the server-side result store, and the session
+            only holds the key needed to load them again for quick access later.
+            Identical requests which are in flight at the same time (from any user or worker)
+            are only sent once, and the stored results are shared (see core.singleflight),
+            so they're left for result_store.prune to clean up rather than deleted here.
+            Results are also shared for the object's cache TTL, so anyone asking for the
+            same query within that time gets them without another request to the API.
+            Those hits are still recorded as Requests (see load_shared_results). """
         key = f'query_{self.id}_results'
+        results = None
         if get_from_cache and (key in request.session):
-            results = request.session[key]
-        else:
-            results = Results(self, self.get_response(request))
-            request.session[key] = results
+            results = Results.load(self, request.session[key])
+        if results is None:
+            results = self.get_shared_results(request)
+        if results is None:
+            fetched = {}
+
+            def fetch() -> str:
+                fetched['results'] = self.fetch_results(request)
+                store_key = fetched['results'].save()
+                if fetched['results'].error is None:
+                    self.share_results(store_key)
+                return store_key
+
+            store_key = singleflight.do(self.request_key(), fetch)
+            results = fetched.get('results') or self.load_shared_results(request, store_key)
+            if results is None:
+                results = self.fetch_results(request)
+                store_key = results.save()
+            request.session[key] = store_key
+        return results
+
+    def fetch_results(self, request):
+        """ Get results from the API. The time spent on each stage is stored on the Request
+            (see queries.timings). """
+        user = request.user if request.user.is_authenticated else None
+        api_request = Request(query=self, user=user)
+        try:
+            if settings.MBTA_API_PAGE_SIZE:
+                results = self.get_paged_results(api_request)
+            else:
+                results = Results(self, self.get_response(api_request))
+        except upstream.ResponseTooLarge as error:
+            results = Results(self)
+            results.error = 'Response too large'
+            results.error_details = str(error)
+        results.api_request = api_request
+        results.record_timings()
+        return results
+
+    def shared_results_key(self) -> str:
+        return f'query_results:{self.fingerprint or self.request_key()}'
+
+    def get_shared_results(self, request):
+        store_key = caches[settings.MBTA_API_CACHE_ALIAS].get(self.shared_results_key())
+        return self.load_shared_results(request, store_key) if store_key else None
+
+    def load_shared_results(self, request, store_key: str):
+        """ Load results which were fetched for someone else. The hit is recorded as a
+            Request served from the cache, with the time spent loading the results. """
+        results_timings = Timings()
+        with results_timings.stage('load'):
+            results = Results.load(self, store_key)
+        if results is not None:
+            user = request.user if request.user.is_authenticated else None
+            results.api_request = Request.objects.create(
+                query=self, user=user, cache_hits=1, response_size_bytes=results.response_size_bytes,
+                timings=json.dumps(results_timings.rounded()))
+            results.timings = results_timings
         return results
 
+    def share_results(self, store_key: str) -> None:
+        ttl = self.get_plan()['cache_ttl']
+        if ttl > 0:
+            caches[settings.MBTA_API_CACHE_ALIAS].set(self.shared_results_key(), store_key, timeout=ttl)
+
+    def request_key(self) -> str:
+        """ Identifies the request this query compiles to """
+        api_request = Request(query=self)
+        return response_cache.cache_key(api_request.url(), api_request.params())
+
 
 class QueryFilter(models.Model):
     """
@@ -118,6 +283,10 @@ class Request(models.Model):
     response_status_code = models.PositiveSmallIntegerField(
         'status code', blank=True, null=True)
     response_size_bytes = models.IntegerField('response size', blank=True, null=True)
+    cache_hits = models.PositiveSmallIntegerField(default=0)
+    cache_misses = models.PositiveSmallIntegerField(default=0)
+    cache_revalidations = models.PositiveSmallIntegerField(default=0)
+    timings = models.TextField(blank=True, default='')
 
     class Meta:
         ordering = ['-datetime']
@@ -125,37 +294,140 @@ class Request(models.Model):
     def __str__(self):
         return f'{self.query} -> {self.response_status_code}'
 
+    def get_timings(self) -> OrderedDict:
+        """ Seconds spent in each stage (see queries.timings) """
+        return json.loads(self.timings, object_pairs_hook=OrderedDict) if self.timings else OrderedDict()
+
     def url(self) -> str:
-        return requests.compat.urljoin('https://api-v3.mbta.com', self.query.primary_object.path)
+        return requests.compat.urljoin(settings.MBTA_API_ROOT, self.query.get_plan()['path'])
 
     def headers(self) -> dict:
         return {'X-API-Key': settings.MBTA_API_KEY}
 
     def params(self) -> OrderedDict:
-        params = OrderedDict()
-        # Included objects
-        if self.query.includes.all().exists():
-            params['include'] = ','.join((x.name for x in self.query.includes.all()))
-        # Filters
-        for f in self.query.filters.all():
-            params[f'filter[{f.on_attribute.name}]'] = f.values
-        # Fields/attributes (parameter is only added/needed if some attributes will be excluded)
-        for o in self.query.all_objects():
-            attributes = [a.name for a in self.query.attributes.filter(for_object=o)]
-            if len(attributes) < len(o.attributes.all()):
-                params[f'fields[{o.name.lower()}]'] = ','.join(attributes)
-
-        return params
+        return OrderedDict(self.query.get_plan()['params'])
 
     def get(self) -> requests.Response:
-        """ Converts a query into a request and then gets the response """
-        response = requests.get(self.url(), headers=self.headers(), params=self.params())
+        """ Converts a query into a request and then gets the response.
+            Responses are shared between users through the upstream response cache. """
+        try:
+            response, outcome = response_cache.get(
+                self.url(),
+                headers=self.headers(),
+                params=self.params(),
+                ttl=self.query.get_plan()['cache_ttl'],
+            )
+        except upstream.ResponseTooLarge:
+            self.datetime = timezone.now()
+            self.save()
+            raise
+        self.record_cache_outcome(outcome)
         self.datetime = timezone.now()
         self.response_status_code = response.status_code
         self.response_size_bytes = len(response.content)
         self.save()
         return response
 
+    def get_page(self, offset: int):
+        """ Gets one page (of MBTA_API_PAGE_SIZE resources) of the response.
+            Safe to call from other threads: it returns the response and the cache outcome,
+            which the calling thread records with record_page. """
+        params = self.params()
+        params['page[offset]'] = offset
+        params['page[limit]'] = settings.MBTA_API_PAGE_SIZE
+        return response_cache.get(
+            self.url(),
+            headers=self.headers(),
+            params=params,
+            ttl=self.query.get_plan()['cache_ttl'],
+        )
+
+    def get_pages(self, offsets):
+        """ Gets pages concurrently, using up to MBTA_API_PAGE_WORKERS threads.
+            Yields (offset, response, outcome) in the order the pages arrive. """
+        self.query.get_plan()  # compiled once, before the threads need it
+        executor = ThreadPoolExecutor(
+            max_workers=settings.MBTA_API_PAGE_WORKERS, thread_name_prefix='mbta-page')
+        futures = {executor.submit(self.get_page, offset): offset for offset in offsets}
+        try:
+            for future in as_completed(futures):
+                response, outcome = future.result()
+                yield futures[future], response, outcome
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def record_page(self, response: requests.Response, outcome: str) -> None:
+        self.record_cache_outcome(outcome)
+        self.datetime = timezone.now()
+        if self.response_status_code is None or not response.ok:
+            self.response_status_code = response.status_code
+        self.response_size_bytes = (self.response_size_bytes or 0) + len(response.content)
+
+    def record_cache_outcome(self, outcome: str) -> None:
+        if outcome == response_cache.HIT:
+            self.cache_hits += 1
+        elif outcome == response_cache.REVALIDATED:
+            self.cache_revalidations += 1
+        else:
+            self.cache_misses += 1
+
+
+class ReportJob(models.Model):
+    """
+    A request to generate a profile report for a query's results.
+    Reports are slow to generate, so they are built by background workers (see queries.jobs)
+    while the page polls for the job's status.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+    ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+    query = models.ForeignKey(
+        Query,
+        on_delete=models.CASCADE,
+        related_name='report_jobs',
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        default=None,
+    )
+    session_key = models.CharField(max_length=40, blank=True)
+    results_key = models.CharField(max_length=32)
+    correlations = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    report_path = models.CharField(max_length=500, blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return f'Report for {self.query} ({self.status})'
+
+    def correlation_list(self) -> List[str]:
+        return [c for c in self.correlations.split(',') if c]
+
+    def is_active(self) -> bool:
+        return self.status in self.ACTIVE_STATUSES
+
 
 class Results:
     """
@@ -169,211 +441,336 @@ class Results:
     the results of their queries.
     """
 
-    def __init__(self, query: Query, response: requests.Response):
+    def __init__(self, query: Query, response: requests.Response = None):
         self.query = query
-        self.response = response
-        if response.ok:
+        self.key = None
+        self.url = ''
+        self.df = None
+        self.error = None
+        self.error_details = None
+        self.response_size_bytes = None
+        self.memory = None
+        self.timings = Timings()
+        self.api_request = None
+        self._content = None
+        self._location_plots = None
+        self._frame_hash = None
+        if response is not None:
+            self.read_response(response)
+
+    def read_response(self, response: requests.Response) -> None:
+        self.url = response.url
+        self.response_size_bytes = len(response.content)
+        self._content = response.content
+        self.timings.add(getattr(response, 'timings', None))
+        document = self.decode(response)
+        if document is not None:
             try:
-                self.df = create_DataFrame(response)
-                reduce_DataFrame_memory_usage(self.df)
-                self.error = None
-                self.error_details = None
-                self.response_size_bytes = len(response.content)
+                plan = self.query.get_plan()
+                self.df = create_DataFrame(document, plan['schema'], self.timings, plan_includes(plan))
+                with self.timings.stage('optimize'):
+                    self.memory = dtypes.optimize(self.df)
             except AssertionError as error:
-                self.df = None
-                self.error = error
-                self.error_detail = ''
-        else:
-            self.df = None
+                self.error = str(error)
+                self.error_details = ''
+
+    def read_pages(self, api_request: Request) -> None:
+        """
+        Read a response which is fetched in pages. The first page links to the last one;
+        the remaining pages are then fetched concurrently, and each is made into a
+        DataFrame as soon as it arrives, while the others are still downloading.
+        The raw content is kept as a JSON array of the pages.
+        """
+        response, outcome = api_request.get_page(0)
+        api_request.record_page(response, outcome)
+        self.url = response.url
+        contents = {0: response.content}
+        self.timings.add(getattr(response, 'timings', None))
+        document = self.decode(response)
+        try:
+            if document is not None:
+                plan = self.query.get_plan()
+                types, includes = plan['schema'], plan_includes(plan)
+                chunks = {0: create_DataFrame(document, types, self.timings, includes)}
+                offsets = page_offsets(document.links, settings.MBTA_API_PAGE_SIZE)
+                for offset, response, outcome in api_request.get_pages(offsets):
+                    api_request.record_page(response, outcome)
+                    contents[offset] = response.content
+                    self.timings.add(getattr(response, 'timings', None))
+                    document = self.decode(response)
+                    if document is None:
+                        break
+                    chunks[offset] = create_DataFrame(document, types, self.timings, includes)
+                else:
+                    with self.timings.stage('flatten'):
+                        self.df = pd.concat([chunks[k] for k in sorted(chunks)], ignore_index=True, sort=False)
+                    with self.timings.stage('optimize'):
+                        self.memory = dtypes.optimize(self.df)
+        except AssertionError as error:
+            self.error = str(error)
+            self.error_details = ''
+        self._content = b'[' + b','.join(contents[k] for k in sorted(contents)) + b']'
+        self.response_size_bytes = len(self._content)
+
+    def decode(self, response: requests.Response) -> ingest.Document:
+        """ Decode a response, from its content in memory (see queries.ingest).
+            If it can't be decoded or it's an error response, the error is recorded and
+            None is returned. """
+        try:
+            with self.timings.stage('decode'):
+                document = ingest.decode(response.content)
+        except ingest.DecodeError as error:
+            self.error = f'{response.status_code} {response.reason}'
+            self.error_details = str(error)
+            return None
+        if not response.ok:
             self.error = f'{response.status_code} {response.reason}'
-            self.error_details = get_error_details(response)
+            self.error_details = get_error_details(document)
+            return None
+        return document
+
+    def save(self) -> str:
+        """ Write these results to the result store and return their key """
+        meta = {
+            'url': self.url,
+            'error': self.error,
+            'error_details': self.error_details,
+            'response_size_bytes': self.response_size_bytes,
+            'memory': self.memory,
+        }
+        self.key = result_store.save(self.df, meta, self._content)
+        return self.key
+
+    def record_timings(self) -> None:
+        """ Store the stage timings on the Request which fetched these results, if any """
+        if self.api_request is not None and self.api_request.pk is not None:
+            self.api_request.timings = json.dumps(self.timings.rounded())
+            Request.objects.filter(pk=self.api_request.pk).update(timings=self.api_request.timings)
+
+    @classmethod
+    def load(cls, query: Query, key: str):
+        """ Load results from the result store. Returns None if they have expired. """
+        stored = result_store.load(key)
+        if stored is None:
+            return None
+        results = cls(query)
+        results.key = key
+        results.df = stored.df
+        results.url = stored.meta['url']
+        results.error = stored.meta['error']
+        results.error_details = stored.meta['error_details']
+        results.response_size_bytes = stored.meta['response_size_bytes']
+        results.memory = stored.meta.get('memory')
+        results._location_plots = stored.meta.get('location_plots')
+        results._frame_hash = stored.meta.get('frame_hash')
+        return results
 
     @property
-    def data_frame(self) -> pd.DataFrame:
-        return self.df
+    def content(self) -> bytes:
+        """ The raw response content. Loaded from the result store only when needed. """
+        if self._content is None and self.key is not None:
+            self._content = result_store.load_content(self.key)
+        return self._content
 
     @property
-    def data_frame_rows(self):
-        class data_frame_cell:
-            def __init__(self, row, col, df):
-                self.row_id = row
-                self.col_id = col
-                self.value = df.at[row, col]
+    def data_frame(self) -> pd.DataFrame:
+        return self.df
 
-        class data_frame_row:
-            def __init__(self, row, df):
-                self.id = row
-                self.cells = [data_frame_cell(row, col, df)
-                              for col in df.columns]
+    def rows(self, offset=0, limit=100, sort=None, descending=False, search='', filters=None) -> dict:
+        """ A window of rows for the results table, after filtering and sorting.
+            'search' is matched against every column, 'filters' maps columns to values.
+            Both are case-insensitive substring matches. Only the window gets serialized. """
+        df = self.df
+        mask = None
+        if search:
+            mask = np.logical_or.reduce([column_contains(df[c], search) for c in df.columns])
+        for column, value in (filters or {}).items():
+            if column in df.columns and value:
+                column_mask = column_contains(df[column], value)
+                mask = column_mask if mask is None else (mask & column_mask)
+        if mask is not None:
+            df = df[mask]
+
+        if sort in df.columns:
+            keys = df[sort]
+            try:
+                order = keys.sort_values(ascending=not descending, kind='mergesort').index
+            except TypeError:
+                order = keys.astype(str).sort_values(ascending=not descending, kind='mergesort').index
+            window = df.loc[order[offset:offset + limit]]
+        else:
+            window = df.iloc[offset:offset + limit]
 
-        return [data_frame_row(row, self.df) for row in self.df.index]
-
-    @property
-    def pretty_json(self) -> str:
-        return json.dumps(self.response.json(), sort_keys=True, indent=2)
+        return {
+            'total': len(self.df),
+            'filtered': len(df),
+            'offset': offset,
+            'columns': list(window.columns),
+            'rows': json.loads(window.to_json(orient='values', date_format='iso')),
+        }
 
     @property
     def column_dtypes(self) -> dict:
         return {col: self.df[col].dtype.name for col in self.df.columns}
 
     def generate_report_html(self, correlations=None) -> str:
-        """ Produce a report using the pandas-profiling module """
-        df = self.df.applymap(lambda v: tuple(v) if type(v) == list else v)
+        """ Produce a report using the pandas-profiling module.
+            It's slow to import, so it's only loaded once a report is requested. """
+        import matplotlib
+        matplotlib.use('Agg')
+        import pandas_profiling  # noqa: F401 (adds DataFrame.profile_report)
+        df = self.df.copy(deep=False)
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = df[column].map(lambda v: tuple(v) if isinstance(v, list) else v)
         correlations = [] if correlations is None else correlations
         corr_options = ['pearson', 'spearman', 'kendall', 'phi_k', 'cramers', 'recoded']
         corrs = {k: True if k in correlations else False for k in corr_options}
         return df.profile_report(correlations=corrs).to_html()
 
-    def location_plots(self):
+    def report_key(self, correlations=None) -> str:
+        """ The key of the report on these results in the report cache. The DataFrame's
+            fingerprint is computed once per result and kept in the result store. """
+        if self._frame_hash is None:
+            self._frame_hash = report_cache.frame_fingerprint(self.df)
+            if self.key is not None:
+                result_store.update_meta(self.key, frame_hash=self._frame_hash)
+        return report_cache.fingerprint(self._frame_hash, correlations)
+
+    @property
+    def location_plots(self) -> list:
         """ If there are latitude/longitude columns, use them to build bokeh geographical plots.
             The JSON data built here will be consumed by a script in the page and used to embed
-            interactive plots."""
-
-        def coord_transform_func(lat_col, lon_col):
-            """ creates and returns a function for transforming lat & lon columns into web mercator"""
-            latlon_proj = Proj(init='epsg:4326')
-            webmercator_proj = Proj(init='epsg:3857')
-
-            def transform_func(data):
-                x, y = transform(latlon_proj, webmercator_proj, data[lon_col], data[lat_col])
-                return pd.Series({'x': x, 'y': y})
-
-            return transform_func
-
-        lat_columns = [c for c in self.df.columns if c.endswith('latitude')]
-        lon_columns = [c for c in self.df.columns if c.endswith('longitude')]
-        plots = []
-
-        for lat_col in lat_columns:
-            col_pfx = lat_col[:-len('latitude')]
-            lon_col = f'{col_pfx}longitude'
-
-            if lon_col in lon_columns:
-                coords = self.df.apply(coord_transform_func(lat_col, lon_col), axis=1)
-                timestamp = date_format(timezone.localtime(timezone.now()), 'DATETIME_FORMAT')
-                object_name = self.query.primary_object.name if not col_pfx else col_pfx.rstrip('_').title()
-                title = f'{object_name} locations as of {timestamp}'
-                source = ColumnDataSource(data=dict(
-                    x=coords.x.tolist(),
-                    y=coords.y.tolist(),
-                    id=self.df[f'{col_pfx}id'].tolist(),
-                    latitude=self.df[lat_col].tolist(),
-                    longitude=self.df[lon_col].tolist()
-                ))
-                hover = HoverTool(tooltips=[
-                    ('id', '@id'),
-                    ('latitude', '@latitude'),
-                    ('longitude', '@longitude')
-                ])
-                plot = figure(
-                    x_range=(coords.x.min(), coords.x.max()),
-                    y_range=(coords.y.min(), coords.y.max()),
-                    x_axis_type='mercator',
-                    y_axis_type='mercator',
-                    title=title,
-                    plot_width=600,
-                    plot_height=600,
-                    sizing_mode='scale_both',
-                )
-                plot.add_tools(hover)
-                plot.add_tile(get_provider(Vendors.CARTODBPOSITRON_RETINA))
-                plot.circle(x='x', y='y', size=8, fill_color='blue', fill_alpha=0.8, source=source)
-                plots.append(json_item(plot, 'id_location_plots'))
-
-        return plots
-
-
-def create_DataFrame(response: requests.Response) -> pd.DataFrame:
-    """ Creates a pandas DataFrame from the MBTA API response """
-    assert response.json()['data'], 'response contained no data'
-    main_df = pd.DataFrame(response.json()['data'])
-    assert main_df['type'].nunique() == 1, 'more than one type'
-    main_type = main_df['type'].unique()[0]
-    main_df = clean_DataFrame(main_df)
-
-    if 'included' in response.json():
-        main_df.rename(lambda col: f'{main_type}_{col}', axis='columns', inplace=True)
-
-        for inc_type, inc_df in pd.DataFrame(response.json()['included']).groupby('type'):
-
-            if inc_type == 'trip' and main_type == 'route_pattern':
-                inc_type = 'representative_trip'
-
-            inc_df = clean_DataFrame(inc_df)
-            inc_df.rename(lambda col: f'{inc_type}_{col}', axis='columns', inplace=True)
-
-            main_id_col = f'{main_type}_{inc_type}'
-            if main_id_col == 'line_route':
-                main_id_col = 'line_routes'
-            inc_id_col = f'{inc_type}_id'
-
-            main_df = main_df.merge(inc_df, how='left', left_on=main_id_col, right_on=inc_id_col)
-            main_df.drop(columns=[main_id_col], inplace=True)
+            interactive plots. They are built once per result and kept in the result store."""
+        if self._location_plots is None:
+            with self.timings.stage('plots'):
+                self._location_plots = build_location_plots(self.df, self.query.primary_object.name)
+            if self.key is not None:
+                result_store.update_meta(self.key, location_plots=self._location_plots)
+        return self._location_plots
+
+
+@lru_cache(maxsize=None)
+def web_mercator_transformer() -> 'Transformer':
+    """ Transforms (longitude, latitude) into web mercator. Built once per process. """
+    from pyproj import Transformer
+    return Transformer.from_crs('epsg:4326', 'epsg:3857', always_xy=True)
+
+
+def build_location_plots(df: pd.DataFrame, object_name: str) -> list:
+    """ One plot for each pair of latitude/longitude columns. Coordinates are projected
+        a whole column at a time. Bokeh is only imported if there is something to plot.
+        Columns of lists (from to-many relationships, see queries.joins) aren't plotted. """
+    def is_coordinates(column):
+        return pd.api.types.is_numeric_dtype(df[column].dtype)
+
+    lat_columns = [c for c in df.columns if c.endswith('latitude') and is_coordinates(c)]
+    lon_columns = [c for c in df.columns if c.endswith('longitude') and is_coordinates(c)]
+    plots = []
+
+    for lat_col in lat_columns:
+        col_pfx = lat_col[:-len('latitude')]
+        lon_col = f'{col_pfx}longitude'
+
+        if lon_col in lon_columns:
+            from bokeh.plotting import figure
+            from bokeh.models import ColumnDataSource, HoverTool
+            from bokeh.embed import json_item
+            from bokeh.tile_providers import get_provider, Vendors
+            latitudes = df[lat_col].astype('float64').to_numpy()
+            longitudes = df[lon_col].astype('float64').to_numpy()
+            x, y = web_mercator_transformer().transform(longitudes, latitudes)
+            timestamp = date_format(timezone.localtime(timezone.now()), 'DATETIME_FORMAT')
+            name = object_name if not col_pfx else col_pfx.rstrip('_').title()
+            title = f'{name} locations as of {timestamp}'
+            source = ColumnDataSource(data=dict(
+                x=x.tolist(),
+                y=y.tolist(),
+                id=df[f'{col_pfx}id'].tolist(),
+                latitude=latitudes.tolist(),
+                longitude=longitudes.tolist()
+            ))
+            hover = HoverTool(tooltips=[
+                ('id', '@id'),
+                ('latitude', '@latitude'),
+                ('longitude', '@longitude')
+            ])
+            plot = figure(
+                x_range=(np.nanmin(x), np.nanmax(x)),
+                y_range=(np.nanmin(y), np.nanmax(y)),
+                x_axis_type='mercator',
+                y_axis_type='mercator',
+                title=title,
+                plot_width=600,
+                plot_height=600,
+                sizing_mode='scale_both',
+            )
+            plot.add_tools(hover)
+            plot.add_tile(get_provider(Vendors.CARTODBPOSITRON_RETINA))
+            plot.circle(x='x', y='y', size=8, fill_color='blue', fill_alpha=0.8, source=source)
+            plots.append(json_item(plot, 'id_location_plots'))
+
+    return plots
+
+
+def page_offsets(links: dict, page_size: int) -> range:
+    """ Offsets of the pages after the first, up to the one the 'last' link points to """
+    if 'last' not in links:
+        return range(0)
+    query = parse_qs(urlsplit(links['last']).query)
+    last_offset = int(query.get('page[offset]', ['0'])[0])
+    return range(page_size, last_offset + 1, page_size)
+
+
+def create_DataFrame(document: ingest.Document, types: dict = None, timings: Timings = None,
+                     includes: list = None) -> pd.DataFrame:
+    """ Creates a pandas DataFrame from the decoded MBTA API response.
+        types is the schema of the query's objects (see queries.schema), if known, and
+        includes its include paths (see queries.joins); by default everything is joined.
+        The time spent flattening and joining is added to timings, if given. """
+    types = types or {}
+    timings = Timings() if timings is None else timings
+    assert document.data, 'response contained no data'
+    assert len(document.data) == 1, 'more than one type'
+    main_type, main_table = next(iter(document.data.items()))
+    with timings.stage('flatten'):
+        main_df = main_table.to_frame(types.get(main_type))
+
+    if document.has_included:
+        with timings.stage('flatten'):
+            included = {
+                inc_type: joins.Included(inc_table.to_frame(types.get(inc_type)), inc_table.related_types)
+                for inc_type, inc_table in document.included.items()
+            }
+        with timings.stage('joins'):
+            main_df = joins.join_includes(
+                main_df, main_table.related_types, included, prefix=f'{main_type}_', includes=includes)
 
     return main_df
 
 
-def clean_DataFrame(df: pd.DataFrame) -> pd.DataFrame:
-    """ Drop useless columns, expand others that contain nested data """
-
-    def expand_columns(df, columns) -> pd.DataFrame:
-        """ Expands a column containing nested data into separate columns"""
-        columns = [c for c in columns if c in df.columns]
-        if any(columns):
-            new_dfs = [convert_column_to_dataframe(df, c) for c in columns]
-            return df.drop(columns=columns).join(new_dfs)
-        else:
-            return df
-
-    def convert_column_to_dataframe(df, column) -> pd.DataFrame:
-        """ Converts a column of data into its own dataframe,
-            which will ultimately be joined to the main dataframe."""
-        if column == 'attributes':
-            return df['attributes'].apply(pd.Series)
-
-        elif column == 'relationships':
-            def get_data_id(x):
-                if isinstance(x, pd.Series):
-                    return x.apply(get_data_id)
-                else:
-                    try:
-                        return x['data']['id']
-                    except (TypeError, KeyError):
-                        return None
-            return df['relationships'].apply(pd.Series).apply(get_data_id)
-
-        elif column == 'properties':
-            def props_list_to_dict(props_list):
-                return {prop['name']: prop['value'] for prop in props_list}
-            return df['properties'].map(props_list_to_dict).apply(pd.Series)
-
-    def convert_datetime_columns(df):
-        """ Convert datetime columns from ISO8601 to pandas datetime format"""
-        for column in df.columns:
-            if column.endswith(('created_at', 'updated_at')):
-                df[column] = pd.to_datetime(df[column])
+def plan_includes(plan: dict) -> list:
+    """ The include paths requested by a plan (see Query.compile_plan) """
+    include = dict(plan['params']).get('include', '')
+    return [path for path in include.split(',') if path]
 
-    df = df.drop(columns=[c for c in ('links', 'type') if c in df.columns])
-    df = expand_columns(df, columns=['attributes', 'relationships'])
-    df = expand_columns(df, columns=['properties'])
-    convert_datetime_columns(df)
-    return df
 
-
-def reduce_DataFrame_memory_usage(df: pd.DataFrame) -> None:
-    """ Reduce memory usage by converting columns to categorical type """
-    for column in df.columns:
-        try:
-            if df[column].nunique() < (df[column].size // 5):
-                df[column] = df[column].astype('category')
-        except TypeError:
-            pass
+def column_contains(series: pd.Series, value: str) -> np.ndarray:
+    """ Case-insensitive substring match. Categorical columns only check their categories. """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        if len(categories) == 0:
+            return np.zeros(len(series), dtype=bool)
+        matches = np.asarray(categories.astype(str).str.contains(value, case=False, regex=False), dtype=bool)
+        codes = series.cat.codes.to_numpy()
+        return np.where(codes >= 0, matches[codes], False)
+    return series.astype(str).str.contains(value, case=False, regex=False).to_numpy(dtype=bool)
 
 
-def get_error_details(response: requests.Response) -> str:
+def get_error_details(document: ingest.Document) -> str:
     """ Returns a string with details describing the request error(s) """
     try:
-        details = [error['detail'] for error in response.json()['errors']]
+        details = [error['detail'] for error in document.errors]
         return '\n'.join(details)
     except KeyError:
         return ''
@@ -0,0 +1,85 @@
+"""
+Content-addressed storage for generated profile reports.
+
+A report depends only on the results' data and the correlations chosen, so it is stored
+gzipped under a fingerprint of both and shared by every job (and user) asking for the
+same thing. The least recently used reports are evicted to keep the cache under
+REPORT_CACHE_MAX_BYTES.
+"""
+from django.conf import settings
+import gzip
+import hashlib
+import os
+import threading
+import pandas as pd
+
+
+_evict_lock = threading.Lock()
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """ A hash of the DataFrame's contents, column names and dtypes """
+    digest = hashlib.sha256()
+    digest.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode())
+    hashable = df.copy(deep=False)
+    for column in hashable.columns:
+        if hashable[column].dtype == object:
+            hashable[column] = hashable[column].map(
+                lambda v: repr(v) if isinstance(v, (list, tuple, dict)) else v)
+    digest.update(pd.util.hash_pandas_object(hashable, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def fingerprint(frame_hash: str, correlations) -> str:
+    """ The cache key for a report on a frame (see frame_fingerprint) with some correlations """
+    key = f'{frame_hash}|{",".join(sorted(correlations or []))}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def path(key: str) -> str:
+    return os.path.join(settings.REPORT_DIR, f'{key}.html.gz')
+
+
+def get(key: str) -> str:
+    """ Path to the cached report, or None if there isn't one. Marks the report as used. """
+    file_path = path(key)
+    try:
+        os.utime(file_path)
+    except FileNotFoundError:
+        return None
+    return file_path
+
+
+def put(key: str, html: str) -> str:
+    """ Store a report and return its path """
+    os.makedirs(settings.REPORT_DIR, exist_ok=True)
+    file_path = path(key)
+    tmp_path = f'{file_path}.{threading.get_ident()}.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+        f.write(html.encode())
+    os.replace(tmp_path, file_path)
+    evict()
+    return file_path
+
+
+def evict() -> None:
+    """ Remove the least recently used reports until the cache fits in REPORT_CACHE_MAX_BYTES """
+    with _evict_lock:
+        entries = []
+        with os.scandir(settings.REPORT_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.html.gz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total <= settings.REPORT_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total -= size
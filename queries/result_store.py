@@ -0,0 +1,243 @@
+"""
+Server-side storage for query results.
+
+DataFrames are written once as uncompressed Arrow IPC (Feather v2) files, which are
+memory-mapped when they are read back. Only the key returned by save() needs to be
+kept in the session.
+
+pyarrow 0.17 can't convert pandas 0.25's nullable integer columns (Int8 to Int64) either
+way, so they're converted here, and their dtypes are kept in the schema metadata.
+"""
+from django.conf import settings
+from collections import namedtuple, OrderedDict
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+
+StoredResults = namedtuple('StoredResults', ['df', 'meta'])
+
+ARROW_ERRORS = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError)
+# Schema metadata holding {column: dtype} for nullable integer columns
+NULLABLE_INTEGERS_KEY = b'nullable_integers'
+
+# Recently loaded frames, so that paging through a result doesn't re-read it every time.
+_frames = OrderedDict()
+_frames_lock = threading.Lock()
+# When this process last pruned the store (see prune_if_due)
+_last_pruned = 0.0
+_prune_lock = threading.Lock()
+
+
+def path(key: str, suffix: str) -> str:
+    return os.path.join(settings.RESULT_STORE_DIR, f'{key}.{suffix}')
+
+
+def save(df: pd.DataFrame, meta: dict, content: bytes = None) -> str:
+    """
+    Store a DataFrame, a JSON-serializable dict of metadata and (optionally) the raw
+    response content. Returns the key needed to load them again.
+    """
+    os.makedirs(settings.RESULT_STORE_DIR, exist_ok=True)
+    prune_if_due()
+    key = uuid.uuid4().hex
+    meta = dict(meta, format=None)
+    if df is not None:
+        meta['format'] = write_frame(df, key)
+    if content is not None:
+        with gzip.open(path(key, 'json.gz'), 'wb', compresslevel=1) as f:
+            f.write(content)
+    write_atomic(path(key, 'meta.json'), json.dumps(meta).encode())
+    return key
+
+
+def update_meta(key: str, **values) -> None:
+    """ Merge additional values (computed after the initial save) into the metadata """
+    meta = read_meta(key)
+    if meta is not None:
+        meta.update(values)
+        write_atomic(path(key, 'meta.json'), json.dumps(meta).encode())
+
+
+def write_frame(df: pd.DataFrame, key: str) -> str:
+    """ Arrow can't represent every object column (e.g. mixed lists and scalars),
+        so those frames are pickled instead. Returns the format used. """
+    tmp_path = path(key, 'tmp')
+    try:
+        feather.write_feather(to_table(df.reset_index(drop=True)), tmp_path, compression='uncompressed')
+        fmt = 'arrow'
+    except ARROW_ERRORS:
+        df.to_pickle(tmp_path)
+        fmt = 'pickle'
+    os.replace(tmp_path, path(key, fmt))
+    return fmt
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    """ The frame as an Arrow table, with nullable integer columns converted by hand """
+    nullable = OrderedDict(
+        (column, df[column].dtype.name) for column in df.columns if is_nullable_integer(df[column].dtype))
+    table = pa.Table.from_pandas(df.drop(columns=list(nullable)), preserve_index=False)
+    for column in nullable:
+        series = df[column]
+        values = series.fillna(0).to_numpy(dtype=series.dtype.numpy_dtype)
+        array = pa.array(values, mask=series.isna().to_numpy())
+        table = table.add_column(df.columns.get_loc(column), pa.field(column, array.type), [array])
+    metadata = dict(table.schema.metadata or {})
+    metadata[NULLABLE_INTEGERS_KEY] = json.dumps(nullable).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def is_nullable_integer(dtype) -> bool:
+    return pd.api.types.is_integer_dtype(dtype) and isinstance(dtype, pd.api.extensions.ExtensionDtype)
+
+
+def write_atomic(file_path: str, data: bytes) -> None:
+    tmp_path = f'{file_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def read_meta(key: str) -> dict:
+    try:
+        with open(path(key, 'meta.json'), 'rb') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load(key: str) -> StoredResults:
+    """ Returns the stored DataFrame and metadata, or None if they no longer exist """
+    meta = read_meta(key)
+    if meta is None:
+        return None
+    try:
+        df = read_frame(key, meta['format'])
+    except FileNotFoundError:
+        return None
+    return StoredResults(df, meta)
+
+
+def read_frame(key: str, fmt: str) -> pd.DataFrame:
+    """ Frames are immutable once stored, so the most recently used ones are kept in memory """
+    with _frames_lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            return _frames[key]
+    if fmt == 'arrow':
+        df = read_arrow(path(key, 'arrow'))
+    elif fmt == 'pickle':
+        df = pd.read_pickle(path(key, 'pickle'))
+    else:
+        return None
+    with _frames_lock:
+        _frames[key] = df
+        while len(_frames) > settings.RESULT_STORE_FRAMES_IN_MEMORY:
+            _frames.popitem(last=False)
+    return df
+
+
+def read_table(file_path: str) -> pa.Table:
+    """ Memory-map the file, so the table's buffers are backed by the file itself """
+    with pa.memory_map(file_path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_arrow(file_path: str) -> pd.DataFrame:
+    """ Numeric columns of the memory-mapped table are not copied when converted.
+        List columns come back from arrow as numpy arrays, so restore them as lists. """
+    table = read_table(file_path)
+    metadata = table.schema.metadata or {}
+    nullable = json.loads(metadata.get(NULLABLE_INTEGERS_KEY, b'{}'))
+    df = table.to_pandas(split_blocks=True)
+    for field in table.schema:
+        if pa.types.is_list(field.type):
+            df[field.name] = table.column(field.name).to_pylist()
+        elif field.name in nullable:
+            df[field.name] = integer_array(table.column(field.name), nullable[field.name])
+    return df
+
+
+def integer_array(column: pa.ChunkedArray, dtype: str) -> pd.arrays.IntegerArray:
+    """ A nullable integer array from the column's data and validity buffers, rather than
+        from the floats it converts to (which aren't exact for large integers) """
+    values, mask = [], []
+    for chunk in column.chunks:
+        if not len(chunk):
+            continue
+        validity, data = chunk.buffers()[:2]
+        start, stop = chunk.offset, chunk.offset + len(chunk)
+        values.append(np.frombuffer(data, dtype=dtype.lower())[start:stop])
+        if validity is None:
+            mask.append(np.zeros(len(chunk), dtype=bool))
+        else:
+            bits = np.unpackbits(np.frombuffer(validity, dtype=np.uint8), bitorder='little')
+            mask.append(bits[start:stop] == 0)
+    if not values:
+        return pd.array([], dtype=dtype)
+    return pd.arrays.IntegerArray(np.concatenate(values), np.concatenate(mask))
+
+
+def arrow_path(key: str) -> str:
+    """ Path to the Arrow IPC file for a key, or None if the frame isn't stored as arrow """
+    file_path = path(key, 'arrow')
+    return file_path if os.path.exists(file_path) else None
+
+
+def content_path(key: str) -> str:
+    """ Path to the gzipped response content for a key, or None if there isn't any """
+    file_path = path(key, 'json.gz')
+    return file_path if os.path.exists(file_path) else None
+
+
+def load_content(key: str) -> bytes:
+    try:
+        with gzip.open(path(key, 'json.gz'), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def delete(key: str) -> None:
+    with _frames_lock:
+        _frames.pop(key, None)
+    for suffix in ('meta.json', 'arrow', 'pickle', 'json.gz', 'feather', 'parquet'):
+        try:
+            os.remove(path(key, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def prune_if_due() -> None:
+    """ Prune at most once every RESULT_STORE_PRUNE_INTERVAL seconds per process, since it
+        stats every file in the store. An interval of 0 leaves it to 'manage.py prune_results'. """
+    global _last_pruned
+    interval = settings.RESULT_STORE_PRUNE_INTERVAL
+    if interval <= 0:
+        return
+    with _prune_lock:
+        now = time.monotonic()
+        if _last_pruned and now - _last_pruned < interval:
+            return
+        _last_pruned = now
+    prune()
+
+
+def prune() -> None:
+    """ Remove stored results which are older than RESULT_STORE_MAX_AGE """
+    cutoff = time.time() - settings.RESULT_STORE_MAX_AGE
+    with os.scandir(settings.RESULT_STORE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
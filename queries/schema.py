@@ -0,0 +1,113 @@
+"""
+Typed extraction of resource attributes, driven by the params tables.
+
+Every MbtaAttribute records the swagger type and format of its values, so the dtype of
+each column is known before a response arrives. Query plans carry a schema for the
+objects in the query (see Query.compile_plan), and ResourceTable.to_frame builds each
+column with its dtype directly instead of inferring one from the values. 'date-time'
+strings are parsed with the fixed ISO-8601 format the API uses and converted to
+TIME_ZONE, so an attribute has the same dtype in every response, even across a
+daylight saving change.
+
+Columns which aren't in the schema, or whose values don't fit it, are inferred as before.
+"""
+from django.conf import settings
+import re
+import numpy as np
+import pandas as pd
+from params.models import MbtaAttribute
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+DATETIME_UNIT = 'us'
+# pandas 2 guesses one layout for a whole column unless it's told to accept any ISO-8601
+# one. Earlier versions (such as the pinned 0.25) parse each value on its own.
+ISO8601_FORMAT = 'ISO8601' if int(pd.__version__.split('.')[0]) >= 2 else None
+
+STRING = 'string'
+INTEGER = 'integer'
+NUMBER = 'number'
+BOOLEAN = 'boolean'
+DATETIME = 'datetime'
+OBJECT = 'object'
+
+
+def compile_schema(objects) -> dict:
+    """ {resource type: {attribute name: kind}} for some MbtaObjects """
+    names = {o.pk: resource_type(o.name) for o in objects}
+    schema = {type_: {} for type_ in names.values()}
+    attributes = MbtaAttribute.objects.filter(for_object__in=names).values_list(
+        'for_object_id', 'name', 'data_type', 'data_format')
+    for object_id, name, data_type, data_format in attributes:
+        kind = attribute_kind(data_type, data_format)
+        if kind is not None:
+            schema[names[object_id]][name] = kind
+    return schema
+
+
+def attribute_kind(data_type: str, data_format: str) -> str:
+    if data_type == 'string':
+        return DATETIME if data_format == 'date-time' else STRING
+    if data_type in ('array', 'object'):
+        return OBJECT
+    if data_type in (INTEGER, NUMBER, BOOLEAN):
+        return data_type
+    return None
+
+
+def resource_type(object_name: str) -> str:
+    """ The JSON:API type of an object's resources, e.g. 'RoutePattern' -> 'route_pattern' """
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', object_name).lower()
+
+
+def typed_column(values: list, kind: str):
+    """ The values as an array of the kind's dtype, or None if they don't fit it.
+        Integer columns with nulls are nullable Int64 (queries.dtypes downcasts them).
+        Boolean ones are objects, since pandas 0.25 has no nullable boolean dtype. """
+    try:
+        if kind == DATETIME:
+            return parse_datetimes(values)
+        if kind == STRING:
+            # Checked rather than converted, since anything can be converted to a string
+            if pd.api.types.infer_dtype(values, skipna=True) not in ('string', 'empty'):
+                return None
+            return object_array(values)
+        if kind == INTEGER:
+            if pd.api.types.infer_dtype(values, skipna=True) not in ('integer', 'empty'):
+                return None
+            if None not in values:
+                return np.array(values, dtype=np.int64)
+            return pd.array(values, dtype='Int64')
+        if kind == NUMBER:
+            return np.array(values, dtype=np.float64)
+        if kind == BOOLEAN:
+            if pd.api.types.infer_dtype(values, skipna=True) not in ('boolean', 'empty'):
+                return None
+            if None not in values:
+                return np.array(values, dtype=bool)
+            return object_array(values)
+        if kind == OBJECT:
+            return object_array(values)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return None
+
+
+def object_array(values: list) -> np.ndarray:
+    """ An object array of the values, even if they're lists """
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def parse_datetimes(values: list) -> pd.DatetimeIndex:
+    """ The API's timestamps always have the same layout, so they're parsed with a fixed
+        format rather than guessed at. Anything else ISO-8601 (e.g. a date) is still read. """
+    try:
+        parsed = pd.to_datetime(values, format=DATETIME_FORMAT, utc=True)
+    except ValueError:
+        parsed = pd.to_datetime(values, format=ISO8601_FORMAT, utc=True)
+    parsed = parsed.tz_convert(settings.TIME_ZONE)
+    if hasattr(parsed, 'as_unit'):
+        parsed = parsed.as_unit(DATETIME_UNIT)
+    return parsed
@@ -0,0 +1,67 @@
+"""
+Keeps the compiled plans stored on queries (see Query.get_plan) up to date.
+A query whose own includes, attributes or filters change also loses its fingerprint
+(see queries.fingerprint), since it no longer matches the queries it was identical to.
+"""
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from params.models import MbtaAttribute, MbtaInclude, MbtaObject
+from params.signals import params_synced
+from .models import Query, QueryFilter
+
+
+def clear_plans(queries) -> None:
+    queries.exclude(plan='').update(plan='')
+
+
+def query_changed(queries) -> None:
+    queries.update(plan='', fingerprint='')
+
+
+@receiver(m2m_changed, sender=Query.includes.through)
+@receiver(m2m_changed, sender=Query.attributes.through)
+def query_m2m_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            instance.plan = instance.fingerprint = ''
+            query_changed(Query.objects.filter(pk=instance.pk))
+    elif action == 'pre_clear':
+        # Changed from the params side, e.g. MbtaInclude.included_in_queries.clear()
+        query_changed(instance.included_in_queries.all())
+    elif action in ('post_add', 'post_remove'):
+        query_changed(Query.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_save, sender=QueryFilter)
+@receiver(post_delete, sender=QueryFilter)
+def query_filter_changed(sender, instance, **kwargs):
+    query_changed(Query.objects.filter(pk=instance.query_id))
+
+
+@receiver(post_save, sender=MbtaObject)
+def object_changed(sender, instance, created, **kwargs):
+    """ Plans include the object's path and cache TTL """
+    if not created:
+        clear_plans(Query.objects.filter(primary_object=instance))
+
+
+@receiver(post_save, sender=MbtaAttribute)
+@receiver(post_delete, sender=MbtaAttribute)
+def attribute_changed(sender, instance, **kwargs):
+    """ Whether a plan needs sparse fieldsets depends on how many attributes an object has """
+    clear_plans(Query.objects.filter(
+        Q(primary_object_id=instance.for_object_id)
+        | Q(includes__associated_object_id=instance.for_object_id)
+    ))
+
+
+@receiver(post_save, sender=MbtaInclude)
+def include_changed(sender, instance, created, **kwargs):
+    if not created:
+        clear_plans(instance.included_in_queries.all())
+
+
+@receiver(params_synced)
+def params_synced_(sender, **kwargs):
+    clear_plans(Query.objects.all())
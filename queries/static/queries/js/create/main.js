@@ -18,6 +18,9 @@ Elements.primaryObject.onchange = (event) => handleChangePrimaryObject(event.tar
 Elements.includes.onchange = (event) => handleChangeIncludes(event);
 Elements.form.onsubmit = () => showLoadingScreen('Retrieving data...');
 
+// start loading the parameter catalog right away
+Params.loadCatalog();
+
 // set initial values and run the onchange logic for the primary object to ensure the form is fully reset. 
 Elements.filters.value = JSON.stringify({});
 Elements.primaryObject.value = '';
@@ -32,6 +32,8 @@ const Params = {
 
   endpoints: JSON.parse(document.getElementById('endpoints').textContent),
 
+  catalogLoaded: null,
+
   cachedData: {
     objects: {},
     includes: {},
@@ -52,7 +54,36 @@ const Params = {
     data[prop] = data[prop].map(entry => entry.id);
   },
 
-  // Fetches the properties for an object and stores them in the cache.
+  // Fetches the catalog of all objects (once) and stores them in the cache.
+  // The catalog URL is versioned, so the browser can keep it in its own cache.
+  // If it can't be loaded, it's treated as empty (objects are then loaded one at a time)
+  // and fetched again on the next call.
+  loadCatalog() {
+    if (!this.catalogLoaded) {
+      this.catalogLoaded = fetch(this.endpoints.params.catalog)
+        .then(response => {
+          if (!response.ok) {
+            throw new Error(`Couldn't load the catalog: ${response.status}`);
+          }
+          return response.json();
+        })
+        .then(catalog => {
+          Object.entries(catalog.objects).forEach(([pk, data]) => {
+            ['includes', 'filters', 'attributes'].forEach(prop => {
+              this.removeHiddenEntries(data, prop);
+              this.extractEntries(data, prop);
+            });
+            this.cachedData.objects[pk] = data;
+          });
+        })
+        .catch(() => {
+          this.catalogLoaded = null;
+        });
+    }
+    return this.catalogLoaded;
+  },
+
+  // Fetches a single object not in the catalog (e.g. an inactive one).
   async loadObject(pk) {
     const response = await fetch(this.endpoints.params.objects + pk);
     const data = await response.json();
@@ -65,6 +96,7 @@ const Params = {
 
   async objectProps(pk) {
     pk = String(pk);
+    await this.loadCatalog();
     if (!(pk in this.cachedData.objects)) {
       await this.loadObject(pk);
     }
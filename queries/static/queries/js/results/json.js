@@ -0,0 +1,26 @@
+const rawJson = document.getElementById('raw-json');
+let loaded = false;
+
+
+$('#id_tab_raw_data').on('shown.bs.tab', () => {
+    if (!loaded) {
+        loaded = true;
+        loadJson();
+    }
+});
+
+
+async function loadJson() {
+    rawJson.innerText = 'Loading...';
+    try {
+        const response = await fetch(rawJson.dataset.endpoint);
+        if (response.status === 200) {
+            const data = await response.json();
+            rawJson.innerText = JSON.stringify(data, null, 2);
+        } else {
+            rawJson.innerText = 'Sorry, something went wrong.';
+        }
+    } catch (e) {
+        rawJson.innerText = 'Sorry, something went wrong.';
+    }
+}
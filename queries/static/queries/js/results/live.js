@@ -0,0 +1,120 @@
+const elements = {
+    pane: document.getElementById('live'),
+    tab: document.getElementById('id_tab_live'),
+    status: document.getElementById('live_status'),
+    rowCount: document.getElementById('live_row_count'),
+    headerRow: document.getElementById('live').querySelector('thead tr'),
+    tbody: document.getElementById('live').querySelector('tbody'),
+}
+
+/**
+ * The server sends a 'snapshot' of every row, then 'delta' events listing rows which
+ * were added/updated ('upsert') or removed. Rows are keyed by id.
+ * The stream is only open while the tab is visible.
+ */
+const state = {
+    source: null,
+    columns: [],
+    rows: new Map(),
+}
+
+
+function connect() {
+    if (state.source !== null) {
+        return;
+    }
+    state.source = new EventSource(elements.pane.dataset.endpoint);
+    elements.status.innerText = 'Connecting...';
+    state.source.addEventListener('snapshot', event => applySnapshot(JSON.parse(event.data)));
+    state.source.addEventListener('delta', event => applyDelta(JSON.parse(event.data)));
+    state.source.addEventListener('status', event => {
+        elements.status.innerText = `Reconnecting to the MBTA API (${JSON.parse(event.data).error})`;
+    });
+    state.source.onerror = () => {
+        elements.status.innerText = 'Connection lost, reconnecting...';
+    };
+}
+
+
+function disconnect() {
+    if (state.source !== null) {
+        state.source.close();
+        state.source = null;
+        elements.status.innerText = 'Paused';
+    }
+}
+
+
+function applySnapshot(snapshot) {
+    state.columns = snapshot.columns;
+    state.rows.clear();
+
+    while (elements.headerRow.firstChild) {
+        elements.headerRow.removeChild(elements.headerRow.firstChild);
+    }
+    state.columns.forEach(col => {
+        const th = document.createElement('th');
+        th.scope = 'col';
+        th.className = 'sticky-top p-2';
+        th.innerText = col;
+        elements.headerRow.append(th);
+    });
+
+    const fragment = document.createDocumentFragment();
+    snapshot.rows.forEach(row => {
+        const tr = tableRow(row);
+        state.rows.set(row.id, tr);
+        fragment.append(tr);
+    });
+    while (elements.tbody.firstChild) {
+        elements.tbody.removeChild(elements.tbody.firstChild);
+    }
+    elements.tbody.append(fragment);
+    updateStatus();
+}
+
+
+function applyDelta(changes) {
+    changes.forEach(change => {
+        const existing = state.rows.get(change.id);
+        if (change.op === 'remove') {
+            if (existing) {
+                existing.remove();
+                state.rows.delete(change.id);
+            }
+        } else {
+            const tr = tableRow(change.row);
+            tr.className = 'changed';
+            if (existing) {
+                existing.replaceWith(tr);
+            } else {
+                elements.tbody.prepend(tr);
+            }
+            state.rows.set(change.id, tr);
+        }
+    });
+    updateStatus();
+}
+
+
+function tableRow(row) {
+    const tr = document.createElement('tr');
+    state.columns.forEach(col => {
+        const td = document.createElement('td');
+        const value = row[col];
+        td.innerText = (value === null || value === undefined) ? '' : String(value);
+        tr.append(td);
+    });
+    return tr;
+}
+
+
+function updateStatus() {
+    elements.status.innerText = `Live - updated ${new Date().toLocaleTimeString()}`;
+    elements.rowCount.innerText = `${state.rows.size} rows`;
+}
+
+
+$('#id_tab_live').on('shown.bs.tab', connect);
+$('#id_tab_live').on('hidden.bs.tab', disconnect);
+window.addEventListener('beforeunload', disconnect);
@@ -1,14 +1,97 @@
-document.getElementById('report_form').onsubmit = (event) => {
+const POLL_INTERVAL = 1000;  // ms
+
+const elements = {
+    form: document.getElementById('report_form'),
+    formContainer: document.getElementById('report_form_container'),
+    progressContainer: document.getElementById('report_progress_container'),
+    progressMessage: document.getElementById('report_progress_message'),
+    progressBar: document.getElementById('report_progress_bar'),
+    cancelButton: document.getElementById('report_cancel_btn'),
+    reportContainer: document.getElementById('report-container'),
+}
+
+let currentJob = null;
+
+
+elements.form.onsubmit = (event) => {
     event.preventDefault();
     createReport();
 }
 
 
+elements.cancelButton.onclick = () => cancelReport();
+
+
 async function createReport() {
-    showLoadingScreen();
-    const formContainer = document.getElementById('report_form_container');
-    const reportContainer = document.getElementById('report-container');
-    const url = reportUrl();
+    const body = new FormData();
+    selectedCorrelations().forEach(c => body.append('correlations', c));
+    showProgress({progress: 0});
+    try {
+        const response = await fetch(elements.form.dataset.endpoint, {
+            method: 'POST',
+            body: body,
+            headers: {'X-CSRFToken': csrfToken()},
+        });
+        const job = await response.json();
+        if (response.status === 200 && job.status === 'done') {
+            embedReport(job.html_url);  // the report was already cached
+        } else if (response.status === 202) {
+            currentJob = job;
+            pollReport();
+        } else {
+            showError(job.error);
+        }
+    } catch (e) {
+        showError();
+    }
+}
+
+
+async function pollReport() {
+    if (currentJob === null) {
+        return;
+    }
+    try {
+        const response = await fetch(currentJob.status_url);
+        const job = await response.json();
+        if (job.id !== (currentJob && currentJob.id)) {
+            return;
+        }
+        currentJob = job;
+        if (job.status === 'done') {
+            currentJob = null;
+            embedReport(job.html_url);
+        } else if (job.status === 'failed') {
+            currentJob = null;
+            showError(job.error);
+        } else if (job.status === 'cancelled') {
+            currentJob = null;
+            showForm();
+        } else {
+            showProgress(job);
+            window.setTimeout(pollReport, POLL_INTERVAL);
+        }
+    } catch (e) {
+        window.setTimeout(pollReport, POLL_INTERVAL);
+    }
+}
+
+
+async function cancelReport() {
+    if (currentJob === null) {
+        return;
+    }
+    const job = currentJob;
+    currentJob = null;
+    try {
+        await fetch(job.cancel_url, {method: 'POST', headers: {'X-CSRFToken': csrfToken()}});
+    } finally {
+        showForm();
+    }
+}
+
+
+async function embedReport(url) {
     try {
         const response = await fetch(url);
         if (response.status === 200) {
@@ -18,40 +101,54 @@ async function createReport() {
             iframe.setAttribute('class', 'w-100');
             iframe.setAttribute('srcdoc', srcdoc);
             iframe.onload = resizeIframe;
-            reportContainer.append(iframe);
+            elements.reportContainer.append(iframe);
+            elements.formContainer.hidden = true;
+            elements.progressContainer.hidden = true;
+            elements.reportContainer.hidden = false;
         } else {
-            reportContainer.innerText = 'Sorry, something went wrong.';
+            showError();
         }
     } catch (e) {
-        reportContainer.innerText = 'Sorry, something went wrong.';
+        showError();
     }
-    formContainer.hidden = true;
-    reportContainer.hidden = false;
-    hideLoadingScreen();
 }
 
 
-function showLoadingScreen() {
-    document.getElementById('loading-screen-message').innerText = 'Generating report - this may take a while...';
-    $('#modal-loading-screen').modal('show');
+function showProgress(job) {
+    elements.progressMessage.innerText = (job.status === 'queued')
+        ? 'Waiting for a worker to generate the report...'
+        : 'Generating report - this may take a while...';
+    elements.progressBar.style.width = `${job.progress}%`;
+    elements.formContainer.hidden = true;
+    elements.progressContainer.hidden = false;
+}
+
+
+function showForm() {
+    elements.formContainer.hidden = false;
+    elements.progressContainer.hidden = true;
 }
 
 
-function hideLoadingScreen() {
-    $('#modal-loading-screen').modal('hide');
+function showError(message) {
+    elements.formContainer.hidden = true;
+    elements.progressContainer.hidden = true;
+    elements.reportContainer.innerText = message || 'Sorry, something went wrong.';
+    elements.reportContainer.hidden = false;
 }
 
 
-function reportUrl() {
-    let url = document.getElementById('report_form').dataset.endpoint;
-    const correlations = (
+function selectedCorrelations() {
+    return (
         Array.from(document.getElementById('id_report_correlations').querySelectorAll('input[type=checkbox]'))
             .filter(elem => elem.checked)
             .map(elem => elem.value)
     );
-    const correlationsParam = (correlations.length > 0) ? correlations.join(',') : 'NONE';
-    url += `${correlationsParam}/`;
-    return url;
+}
+
+
+function csrfToken() {
+    return elements.form.querySelector('input[name=csrfmiddlewaretoken]').value;
 }
 
 
@@ -63,4 +160,4 @@ function resizeIframe() {
     } else {
         window.setTimeout(resizeIframe, 100);
     }
-}
\ No newline at end of file
+}
@@ -1,9 +1,203 @@
+const ROW_HEIGHT = 31;  // px, must match '.virtual-table tbody td' in results.css
+const BLOCK_SIZE = 200;  // rows fetched per request
+const OVERSCAN = 20;  // rows rendered above and below the visible ones
+
 const elements = {
     editColumnsButton: document.getElementById('edit_columns_button'),
+    viewport: document.getElementById('table_viewport'),
     table: document.getElementById('full-table').querySelector('table'),
+    tbody: document.getElementById('full-table').querySelector('tbody'),
+    search: document.getElementById('table_search'),
+    rowCount: document.getElementById('table_row_count'),
     modal: document.getElementById('modal'),
 }
 
+const columns = Array.from(elements.table.querySelectorAll('th')).map(th => th.id);
+
+/**
+ * The table only ever holds the rows in view. Rows are fetched from the server
+ * in blocks (already sorted and filtered), and cached until the sort or search changes.
+ */
+const state = {
+    sort: null,
+    descending: false,
+    search: '',
+    filtered: 0,
+    total: 0,
+    blocks: new Map(),
+    pending: new Map(),
+    hiddenColumns: new Set(),
+    generation: 0,
+    renderScheduled: false,
+}
+
+
+function blockUrl(blockIndex) {
+    const url = new URL(elements.viewport.dataset.endpoint, window.location.origin);
+    url.searchParams.set('offset', blockIndex * BLOCK_SIZE);
+    url.searchParams.set('limit', BLOCK_SIZE);
+    if (state.sort) {
+        url.searchParams.set('sort', state.sort);
+        url.searchParams.set('order', state.descending ? 'desc' : 'asc');
+    }
+    if (state.search) {
+        url.searchParams.set('search', state.search);
+    }
+    return url;
+}
+
+
+async function fetchBlock(blockIndex) {
+    if (state.blocks.has(blockIndex) || state.pending.has(blockIndex)) {
+        return;
+    }
+    const generation = state.generation;
+    const request = fetch(blockUrl(blockIndex)).then(response => response.json());
+    state.pending.set(blockIndex, request);
+    try {
+        const data = await request;
+        if (generation !== state.generation) {
+            return;  // the sort or search changed while this was loading
+        }
+        state.blocks.set(blockIndex, data.rows);
+        state.filtered = data.filtered;
+        state.total = data.total;
+        updateRowCount();
+        scheduleRender();
+    } finally {
+        if (generation === state.generation) {
+            state.pending.delete(blockIndex);
+        }
+    }
+}
+
+
+function visibleRange() {
+    const first = Math.max(Math.floor(elements.viewport.scrollTop / ROW_HEIGHT) - OVERSCAN, 0);
+    const count = Math.ceil(elements.viewport.clientHeight / ROW_HEIGHT) + (2 * OVERSCAN);
+    const last = Math.min(first + count, state.filtered);
+    return [first, last];
+}
+
+
+function scheduleRender() {
+    if (!state.renderScheduled) {
+        state.renderScheduled = true;
+        window.requestAnimationFrame(() => {
+            state.renderScheduled = false;
+            render();
+        });
+    }
+}
+
+
+function render() {
+    const [first, last] = visibleRange();
+    for (let block = Math.floor(first / BLOCK_SIZE); block <= Math.floor(Math.max(last - 1, 0) / BLOCK_SIZE); block++) {
+        fetchBlock(block);
+    }
+
+    const fragment = document.createDocumentFragment();
+    fragment.append(spacerRow(first * ROW_HEIGHT));
+    for (let i = first; i < last; i++) {
+        fragment.append(tableRow(i));
+    }
+    fragment.append(spacerRow((state.filtered - last) * ROW_HEIGHT));
+
+    while (elements.tbody.firstChild) {
+        elements.tbody.removeChild(elements.tbody.firstChild);
+    }
+    elements.tbody.append(fragment);
+}
+
+
+function tableRow(i) {
+    const block = state.blocks.get(Math.floor(i / BLOCK_SIZE));
+    const values = block ? block[i % BLOCK_SIZE] : null;
+    const tr = document.createElement('tr');
+    tr.dataset.row = i;
+    if (i % 2 === 1) {
+        tr.className = 'row-odd';
+    }
+    columns.forEach((col, j) => {
+        const td = document.createElement('td');
+        td.id = `${i}|${col}`;
+        td.hidden = state.hiddenColumns.has(col);
+        td.innerText = values ? formatValue(values[j]) : '…';
+        tr.append(td);
+    });
+    return tr;
+}
+
+
+function spacerRow(height) {
+    const tr = document.createElement('tr');
+    tr.className = 'spacer';
+    const td = document.createElement('td');
+    td.colSpan = columns.length;
+    td.style.height = `${height}px`;
+    tr.append(td);
+    return tr;
+}
+
+
+function formatValue(value) {
+    if (value === null || value === undefined) {
+        return '';
+    } else if (typeof value === 'object') {
+        return JSON.stringify(value);
+    } else {
+        return String(value);
+    }
+}
+
+
+function updateRowCount() {
+    elements.rowCount.innerText = (state.filtered === state.total)
+        ? `${state.total} rows`
+        : `${state.filtered} of ${state.total} rows`;
+}
+
+
+function reload() {
+    state.generation += 1;
+    state.blocks.clear();
+    state.pending.clear();
+    elements.viewport.scrollTop = 0;
+    fetchBlock(0);
+}
+
+
+elements.viewport.addEventListener('scroll', scheduleRender);
+
+
+elements.table.querySelectorAll('th').forEach(th => {
+    th.onclick = () => {
+        if (state.sort === th.id) {
+            state.descending = !state.descending;
+        } else {
+            state.sort = th.id;
+            state.descending = false;
+        }
+        elements.table.querySelectorAll('th').forEach(other => other.classList.remove('sorted-asc', 'sorted-desc'));
+        th.classList.add(state.descending ? 'sorted-desc' : 'sorted-asc');
+        reload();
+    };
+});
+
+
+let searchTimeout = null;
+elements.search.oninput = () => {
+    window.clearTimeout(searchTimeout);
+    searchTimeout = window.setTimeout(() => {
+        state.search = elements.search.value.trim();
+        reload();
+    }, 300);
+};
+
+
+$('#id_tab_table').on('shown.bs.tab', scheduleRender);
+
 
 elements.editColumnsButton.onclick = (event) => {
 
@@ -19,7 +213,7 @@ elements.editColumnsButton.onclick = (event) => {
     const ul = document.createElement('ul');
     ul.style.listStyle = 'none';
     elements.table.querySelectorAll('th').forEach(col => {
-        
+
         const input = document.createElement('input');
         input.className = 'form-check-input';
         input.setAttribute('type', 'checkbox');
@@ -54,10 +248,12 @@ function handleSave() {
 
 
 function setColumnsDisplayed(columnIds) {
+    state.hiddenColumns = new Set(columns.filter(col => !columnIds.includes(col)));
     elements.table.querySelectorAll('th').forEach(th => {
-        th.hidden = (columnIds.includes(th.id)) ? false : true;
-    });
-    elements.table.querySelectorAll('td').forEach(td => {
-        td.hidden = (columnIds.includes(td.id.split('|')[1])) ? false : true;
+        th.hidden = state.hiddenColumns.has(th.id);
     });
-}
\ No newline at end of file
+    render();
+}
+
+
+fetchBlock(0);
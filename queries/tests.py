@@ -1,3 +1,858 @@
-from django.test import TestCase
+from django.conf import settings
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from unittest import mock
+import importlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import pandas as pd
+import pyarrow.parquet as pq
+from core import upstream
+from core.tests import LOCMEM_CACHES, FakeApiMixin
+from params.models import MbtaAttribute, MbtaFilter, MbtaInclude, MbtaObject
+from . import (
+    benchmarks, dtypes, exports, flatten, ingest, jobs, live, loadtest, report_cache, result_store, schema, timings)
+from .fingerprint import fingerprint
+from .management.commands import benchmark
+from .models import (
+    Query, ReportJob, Results, build_location_plots, create_DataFrame, page_offsets, plan_includes,
+    web_mercator_transformer)
 
-# Create your tests here.
+
+def make_params() -> dict:
+    """ Vehicles, which can include their route and trip, and routes """
+    objects = {
+        name: MbtaObject.objects.create(name=name, path=path, description=name, cache_ttl=60)
+        for name, path in (('Vehicle', '/vehicles'), ('Route', '/routes'), ('Trip', '/trips'))
+    }
+    for name, attributes in (
+        ('Vehicle', [('label', 'string', ''), ('bearing', 'integer', ''), ('updated_at', 'string', 'date-time')]),
+        ('Route', [('long_name', 'string', ''), ('color', 'string', '')]),
+        ('Trip', [('headsign', 'string', '')]),
+    ):
+        for attribute, data_type, data_format in attributes:
+            MbtaAttribute.objects.create(
+                for_object=objects[name], name=attribute, required=False, data_type=data_type,
+                data_format=data_format)
+    for name in ('route', 'trip'):
+        include = MbtaInclude.objects.create(name=name, associated_object=objects[name.title()])
+        include.included_by.add(objects['Vehicle'])
+    for name in ('route', 'direction_id'):
+        MbtaFilter.objects.create(name=name, for_object=objects['Vehicle'])
+    return objects
+
+
+def make_query(primary_object: MbtaObject, includes=(), attributes=None, filters=()) -> Query:
+    """ A query of some includes (by name), attributes (all by default) and (filter name, values) """
+    query = Query.objects.create(primary_object=primary_object)
+    query.includes.set(MbtaInclude.objects.filter(name__in=includes))
+    objects = [primary_object] + [i.associated_object for i in query.includes.all()]
+    if attributes is None:
+        query.attributes.set(MbtaAttribute.objects.filter(for_object__in=objects))
+    else:
+        query.attributes.set(MbtaAttribute.objects.filter(for_object__in=objects, name__in=attributes))
+    for name, values in filters:
+        query.filters.create(on_attribute=primary_object.filters.get(name=name), values=values)
+    return query
+
+
+class TemporaryStoreMixin:
+    """ Keeps the result store (and reports) in a temporary directory """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        override = override_settings(
+            RESULT_STORE_DIR=os.path.join(directory, 'results'),
+            RESULT_STORE_PRUNE_INTERVAL=600,
+            REPORT_DIR=os.path.join(directory, 'reports'),
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        result_store._last_pruned = 0.0
+
+
+class ResultStoreTests(TemporaryStoreMixin, SimpleTestCase):
+
+    def test_round_trip(self):
+        df = pd.DataFrame({'id': ['a', 'b'], 'value': [1.5, None], 'ids': [['x'], []]})
+        key = result_store.save(df, {'name': 'test'}, content=b'{"data": []}')
+        stored = result_store.load(key)
+        self.assertEqual(stored.meta['name'], 'test')
+        self.assertEqual(stored.meta['format'], 'arrow')
+        pd.testing.assert_frame_equal(stored.df, df)
+        self.assertEqual(result_store.load_content(key), b'{"data": []}')
+
+    def test_nullable_integers(self):
+        df = pd.DataFrame({
+            'id': ['a', 'b', 'c'],
+            'small': pd.array([1, None, 3], dtype='Int8'),
+            'large': pd.array([2 ** 62 + 1, None, 1], dtype='Int64'),  # not exact as floats
+        })
+        key = result_store.save(df, {})
+        result_store._frames.clear()
+        stored = result_store.load(key)
+        self.assertEqual(stored.meta['format'], 'arrow')
+        pd.testing.assert_frame_equal(stored.df, df)
+
+    def test_missing_results(self):
+        key = result_store.save(pd.DataFrame({'a': [1]}), {})
+        result_store.delete(key)
+        self.assertIsNone(result_store.load(key))
+
+    def make_old(self, key):
+        old = time.time() - 2 * settings.RESULT_STORE_MAX_AGE
+        os.utime(result_store.path(key, 'meta.json'), (old, old))
+
+    def test_prune_is_throttled(self):
+        first = result_store.save(pd.DataFrame({'a': [1]}), {})
+        self.make_old(first)
+        result_store._last_pruned = 0.0
+        with mock.patch.object(result_store, 'prune', wraps=result_store.prune) as prune:
+            second = result_store.save(pd.DataFrame({'a': [2]}), {})
+            self.make_old(second)
+            result_store.save(pd.DataFrame({'a': [3]}), {})
+        self.assertEqual(prune.call_count, 1)
+        self.assertIsNone(result_store.read_meta(first))
+        # Not pruned again until the interval has passed
+        self.assertIsNotNone(result_store.read_meta(second))
+
+    @override_settings(RESULT_STORE_PRUNE_INTERVAL=0)
+    def test_prune_can_be_left_to_the_command(self):
+        key = result_store.save(pd.DataFrame({'a': [1]}), {})
+        self.make_old(key)
+        result_store.save(pd.DataFrame({'a': [2]}), {})
+        self.assertIsNotNone(result_store.read_meta(key))
+        result_store.prune()
+        self.assertIsNone(result_store.read_meta(key))
+
+
+class FlattenTests(SimpleTestCase):
+    """ The columnar flattener against the original row-by-row one """
+
+    def assert_same_as_legacy(self, resources):
+        legacy = benchmarks.legacy_clean_DataFrame(pd.DataFrame(resources))
+        table, = flatten.tables_by_type(resources).values()
+        pd.testing.assert_frame_equal(table.to_frame(), legacy)
+
+    def test_vehicles(self):
+        self.assert_same_as_legacy(benchmarks.synthetic_vehicles(50))
+
+    def test_schedules(self):
+        data, _ = benchmarks.schedule_scenario(50, random.Random(0))
+        self.assert_same_as_legacy(data)
+
+    def test_alerts(self):
+        data, _ = benchmarks.alert_scenario(20, random.Random(0))
+        self.assert_same_as_legacy(data)
+
+    def test_facility_properties(self):
+        rng = random.Random(0)
+        stops = benchmarks.synthetic_stops(['1', '2', '3'], rng, facilities=3)
+        self.assert_same_as_legacy(benchmarks.synthetic_facilities(stops, rng))
+
+    def test_missing_values(self):
+        self.assert_same_as_legacy([
+            {'type': 'route', 'id': '1', 'attributes': {'color': 'FF0000', 'sort_order': 1},
+             'relationships': {'line': {'data': {'type': 'line', 'id': 'line-1'}}}},
+            {'type': 'route', 'id': '2', 'attributes': {'sort_order': 2, 'text_color': 'FFFFFF'},
+             'relationships': {'line': {'data': None}}},
+            {'type': 'route', 'id': '3', 'attributes': {'color': None, 'sort_order': 3,
+                                                        'created_at': '2019-10-01T10:00:00-04:00'},
+             'relationships': {}},
+        ])
+
+    def test_malformed_properties_are_skipped(self):
+        table = flatten.ResourceTable()
+        table.append({'type': 'facility', 'id': '1', 'attributes': {
+            'properties': ['stray', {'name': 'enclosed', 'value': 1}, {'value': 2}]}})
+        self.assertEqual(list(table.to_frame().columns), ['id', 'enclosed'])
+
+    def test_tables_by_type(self):
+        resources = benchmarks.synthetic_vehicles(3) + [{'type': 'route', 'id': 'Red'}]
+        tables = flatten.tables_by_type(resources)
+        self.assertEqual(list(tables), ['vehicle', 'route'])
+        self.assertEqual(tables['route'].to_frame()['id'].tolist(), ['Red'])
+
+    def test_to_many_relationships_are_lists(self):
+        """ Unlike the original flattener, which dropped them """
+        stops = benchmarks.synthetic_stops(['1', '2'], random.Random(0), facilities=2)
+        table, = flatten.tables_by_type(stops).values()
+        df = table.to_frame()
+        expected = [[f['id'] for f in stop['relationships']['facilities']['data']] for stop in stops]
+        self.assertEqual(df['facilities'].tolist(), expected)
+        self.assertEqual(table.related_types, {'facilities': 'facility', 'parent_station': 'stop', 'zone': 'zone'})
+
+
+class DtypesTests(SimpleTestCase):
+
+    def test_optimize_column(self):
+        def optimized(values, dtype=None):
+            return dtypes.optimize_column(pd.Series(values, dtype=dtype))
+
+        self.assertEqual(optimized([1, 2, 300]).dtype, 'int16')
+        self.assertEqual(optimized([1, 2, 300], dtype=object).dtype, 'int16')
+        with_null = optimized([1, None, 3], dtype=object)
+        self.assertEqual(with_null.dtype, 'Int8')
+        self.assertEqual(with_null.isna().tolist(), [False, True, False])
+        self.assertEqual(optimized([2 ** 60, None], dtype=object).dtype, 'Int64')
+        self.assertEqual(optimized(pd.array([1, None, 300], dtype='Int64')).dtype, 'Int16')
+        self.assertIsNone(optimized([2 ** 70, None], dtype=object))
+        self.assertEqual(optimized([True, False], dtype=object).dtype, bool)
+        self.assertIsNone(optimized([True, None], dtype=object))
+        self.assertEqual(optimized([0.5, float('nan')]).dtype, 'float32')
+        self.assertIsNone(optimized([0.1, float('nan')]))  # not exact as float32
+        self.assertEqual(optimized(['a', 'a', 'b', 'b']).dtype, 'category')
+        self.assertIsNone(optimized(['a', 'b', 'c', 'd']))
+
+    def test_ids_share_categories(self):
+        df = pd.DataFrame({
+            'id': ['1', '2', '3'],
+            'route': ['Red', 'Red', 'Blue'],
+            'trip_route': ['Blue', 'Red', None],
+            'label': ['x', 'y', 'z'],
+        })
+        report = dtypes.optimize(df)
+        self.assertNotIsInstance(df['id'].dtype, pd.CategoricalDtype)  # unique
+        self.assertEqual(list(df['route'].cat.categories), ['Blue', 'Red'])
+        self.assertEqual(df['route'].dtype, df['trip_route'].dtype)
+        self.assertTrue(pd.isna(df['trip_route'][2]))
+        self.assertEqual([c['column'] for c in report['columns']], list(df.columns))
+        self.assertEqual(report['after'], int(df.memory_usage(index=False, deep=True).sum()))
+
+
+class SchemaTests(TestCase):
+
+    def test_compile_schema(self):
+        objects = make_params()
+        self.assertEqual(schema.compile_schema([objects['Vehicle'], objects['Route']]), {
+            'vehicle': {'label': 'string', 'bearing': 'integer', 'updated_at': 'datetime'},
+            'route': {'long_name': 'string', 'color': 'string'},
+        })
+        self.assertEqual(schema.resource_type('RoutePattern'), 'route_pattern')
+
+    def test_typed_column(self):
+        self.assertEqual(schema.typed_column([1, 2], schema.INTEGER).dtype, 'int64')
+        self.assertEqual(schema.typed_column([1, None], schema.INTEGER).dtype, 'Int64')
+        self.assertIsNone(schema.typed_column([2 ** 70, None], schema.INTEGER))
+        self.assertIsNone(schema.typed_column([1.5], schema.INTEGER))
+        self.assertEqual(schema.typed_column([True, False], schema.BOOLEAN).dtype, bool)
+        self.assertEqual(list(schema.typed_column([True, None], schema.BOOLEAN)), [True, None])
+        self.assertIsNone(schema.typed_column([1, 'a'], schema.STRING))
+        self.assertEqual(list(schema.typed_column([[1], {'a': 1}], schema.OBJECT)), [[1], {'a': 1}])
+
+    def test_datetimes(self):
+        parsed = schema.typed_column(
+            ['2019-10-01T10:00:00-04:00', '2019-11-04T10:00:00-05:00', None], schema.DATETIME)
+        self.assertEqual(str(parsed.tz), settings.TIME_ZONE)
+        self.assertEqual([t.hour for t in parsed[:2]], [10, 10])
+        self.assertTrue(pd.isna(parsed[2]))
+        self.assertEqual(len(schema.typed_column(['2019-10-01', '2019-10-01T10:00:00-04:00'], schema.DATETIME)), 2)
+
+    def test_to_frame(self):
+        table = flatten.ResourceTable()
+        table.extend([
+            {'type': 'vehicle', 'id': '1', 'attributes': {'bearing': 90, 'label': 'a'}},
+            {'type': 'vehicle', 'id': '2', 'attributes': {'bearing': 'north', 'label': None}},
+        ])
+        df = table.to_frame({'bearing': schema.INTEGER, 'label': schema.STRING})
+        self.assertEqual(df['bearing'].tolist(), [90, 'north'])  # inferred instead
+        self.assertEqual(df['label'].isna().tolist(), [False, True])
+
+
+class JoinTests(SimpleTestCase):
+
+    def create(self, data: list, included: list, includes=None) -> pd.DataFrame:
+        content = json.dumps({'data': data, 'included': included}).encode()
+        return create_DataFrame(ingest.decode(content), benchmarks.SCHEMAS, includes=includes)
+
+    def test_layout_matches_the_original(self):
+        document = json.loads(benchmarks.synthetic_document('vehicle', 20))
+        df = self.create(document['data'], document['included'], includes=['route', 'stop', 'trip'])
+        legacy = benchmarks.legacy_create_DataFrame(document)
+        self.assertEqual(list(df.columns), list(legacy.columns))
+        self.assertEqual(df['route_long_name'].tolist(), legacy['route_long_name'].tolist())
+
+    def test_only_include_paths_are_joined(self):
+        data, included = benchmarks.vehicle_scenario(10, random.Random(0))
+        df = self.create(data, included, includes=['route', 'stop', 'trip'])
+        self.assertIn('trip_route', df.columns)  # the trip's route is left as an id
+        self.assertNotIn('trip_route_long_name', df.columns)
+
+        df = self.create(data, included, includes=['route', 'stop', 'trip.route'])
+        self.assertIn('trip_route_long_name', df.columns)
+        routes = {r['id']: r['attributes']['long_name'] for r in included if r['type'] == 'route'}
+        trip_routes = {t['id']: t['relationships']['route']['data']['id'] for t in included if t['type'] == 'trip'}
+        self.assertEqual([None if pd.isna(name) else name for name in df['trip_route_long_name']],
+                         [routes.get(trip_routes[v['relationships']['trip']['data']['id']]) for v in data])
+
+        df = self.create(data, included, includes=['route'])
+        self.assertEqual(df['vehicle_trip'].tolist(), [v['relationships']['trip']['data']['id'] for v in data])
+
+    def test_to_many(self):
+        data, included = benchmarks.stop_scenario(5, random.Random(0))
+        df = self.create(data, included, includes=['facilities'])
+        self.assertEqual(len(df), 5)
+        facility_ids = [[f['id'] for f in stop['relationships']['facilities']['data']] for stop in data]
+        self.assertEqual(df['facilities_id'].tolist(), facility_ids)
+        self.assertEqual([len(names) for names in df['facilities_long_name']], [len(ids) for ids in facility_ids])
+
+    def test_repeated_included_resources(self):
+        data, included = benchmarks.vehicle_scenario(10, random.Random(0))
+        df = self.create(data, included + included, includes=['route', 'stop', 'trip'])
+        self.assertEqual(len(df), 10)
+        pd.testing.assert_frame_equal(df, self.create(data, included, includes=['route', 'stop', 'trip']))
+
+    def test_plan_includes(self):
+        self.assertEqual(plan_includes({'params': [['include', 'route,trip.shape'], ['filter[route]', 'Red']]}),
+                         ['route', 'trip.shape'])
+        self.assertEqual(plan_includes({'params': []}), [])
+
+
+class DecodeTests(SimpleTestCase):
+
+    def test_same_as_json(self):
+        data, included = benchmarks.vehicle_scenario(20, random.Random(0))
+        content = json.dumps({'data': data, 'included': included, 'links': {'first': '/vehicles'}}).encode()
+        document = ingest.decode(content)
+        self.assertTrue(document.has_included)
+        self.assertEqual(document.links, {'first': '/vehicles'})
+        self.assertEqual(list(document.data), ['vehicle'])
+        self.assertEqual(sorted(document.included), ['route', 'stop', 'trip'])
+        expected, = flatten.tables_by_type(data).values()
+        pd.testing.assert_frame_equal(document.data['vehicle'].to_frame(), expected.to_frame())
+
+    def test_single_resource_and_errors(self):
+        document = ingest.decode(b'{"data": {"type": "stop", "id": "1", "attributes": {"name": "A"}}}')
+        self.assertEqual(document.data['stop'].to_frame()['name'].tolist(), ['A'])
+        self.assertFalse(document.has_included)
+        document = ingest.decode(b'{"errors": [{"status": "400", "code": "bad_request"}]}')
+        self.assertEqual(document.errors, [{'status': '400', 'code': 'bad_request'}])
+
+    def test_invalid_json(self):
+        with self.assertRaises(ingest.DecodeError):
+            ingest.decode(b'{"data": [')
+
+
+class LocationPlotTests(SimpleTestCase):
+
+    def test_projection(self):
+        x, y = web_mercator_transformer().transform([-71.0589, 0.0], [42.3601, 0.0])
+        self.assertAlmostEqual(x[0], -7910240, delta=10)
+        self.assertAlmostEqual(y[0], 5215074, delta=10)
+        self.assertAlmostEqual(x[1], 0.0, delta=1e-6)
+        self.assertIs(web_mercator_transformer(), web_mercator_transformer())
+
+    def test_nothing_to_plot(self):
+        df = pd.DataFrame({'id': ['1'], 'name': ['A'], 'trip_latitude': [[42.3]], 'trip_longitude': [[-71.1]]})
+        self.assertEqual(build_location_plots(df, 'Vehicle'), [])
+
+
+class RowsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.results = Results(None)
+        self.results.df = pd.DataFrame({
+            'id': ['a', 'b', 'c', 'd'],
+            'route': pd.Categorical(['Red', 'Orange', 'Red', None]),
+            'bearing': [90, 180, 45, 270],
+        })
+
+    def test_window(self):
+        rows = self.results.rows(offset=1, limit=2)
+        self.assertEqual((rows['total'], rows['filtered'], rows['offset']), (4, 4, 1))
+        self.assertEqual(rows['columns'], ['id', 'route', 'bearing'])
+        self.assertEqual(rows['rows'], [['b', 'Orange', 180], ['c', 'Red', 45]])
+
+    def test_sort(self):
+        rows = self.results.rows(sort='bearing', descending=True, limit=2)
+        self.assertEqual([row[0] for row in rows['rows']], ['d', 'b'])
+
+    def test_search_and_filters(self):
+        rows = self.results.rows(search='red')
+        self.assertEqual([row[0] for row in rows['rows']], ['a', 'c'])
+        self.assertEqual(rows['filtered'], 2)
+        rows = self.results.rows(search='red', filters={'bearing': '45', 'unknown': 'x'})
+        self.assertEqual([row[0] for row in rows['rows']], ['c'])
+        rows = self.results.rows(filters={'route': 'blue'})
+        self.assertEqual((rows['filtered'], rows['rows']), (0, []))
+
+
+@override_settings(EXPORT_CHUNK_ROWS=2)
+class ExportTests(TemporaryStoreMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.results = Results(None)
+        self.results.df = pd.DataFrame({
+            'id': ['a', 'b', 'c', 'd', 'e'],
+            'bearing': pd.array([1, 2, 3, None, 5], dtype='Int16'),
+            'stops': [['1'], ['2', '3'], [], ['4'], ['5']],
+        })
+        self.results.save()
+
+    def test_csv_is_streamed_in_chunks(self):
+        chunks = list(exports.csv_chunks(self.results.df))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks), self.results.df.to_csv(index=False))
+        self.assertEqual(list(exports.csv_chunks(self.results.df.iloc[:0])), ['id,bearing,stops\n'])
+
+    def test_jsonl(self):
+        lines = ''.join(exports.jsonl_chunks(self.results.df)).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], ['a', 'b', 'c', 'd', 'e'])
+
+    def test_feather_is_the_stored_file(self):
+        self.assertEqual(exports.feather_path(self.results), result_store.arrow_path(self.results.key))
+        df = result_store.read_arrow(exports.feather_path(self.results))
+        pd.testing.assert_frame_equal(df, self.results.df)
+
+    def test_parquet(self):
+        table = pq.read_table(exports.parquet_path(self.results))
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(table.column('id').to_pylist(), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(table.column('bearing').to_pylist(), [1, 2, 3, None, 5])
+
+    def test_pickled_results(self):
+        self.results.df['mixed'] = [1, [2], 'x', None, 3.5]
+        self.results.save()
+        self.assertIsNone(result_store.arrow_path(self.results.key))
+        table = exports.arrow_table(self.results)
+        self.assertEqual(str(table.schema.field('bearing').type), 'int16')
+        self.assertEqual(table.column('mixed').to_pylist(), ['1', '[2]', 'x', None, '3.5'])
+
+    def test_response(self):
+        response = exports.export(self.results, 'csv', 'vehicles')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="vehicles.csv"')
+        self.assertEqual(b''.join(response.streaming_content).decode(), self.results.df.to_csv(index=False))
+        with self.assertRaises(ValueError):
+            exports.export(self.results, 'xlsx', 'vehicles')
+
+
+class ReportJobTests(TemporaryStoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.query = make_query(make_params()['Vehicle'])
+        self.results = Results(self.query)
+        self.results.df = pd.DataFrame({'id': ['a', 'b'], 'bearing': [1, 2]})
+        self.results.save()
+        patcher = mock.patch.object(jobs, 'get_executor')
+        self.executor = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_run(self):
+        job = jobs.submit(self.query, self.results, ['pearson'], session_key='s')
+        self.assertEqual(job.status, ReportJob.QUEUED)
+        self.executor.submit.assert_called_once_with(jobs.run, job.pk)
+        with mock.patch.object(Results, 'generate_report_html', return_value='<html></html>') as generate:
+            jobs.run(job.pk)
+        generate.assert_called_once_with(correlations=['pearson'])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), (ReportJob.DONE, 100))
+        self.assertTrue(os.path.exists(job.report_path))
+
+        # The same report is then served from the cache
+        cached = jobs.submit(self.query, self.results, ['pearson'], session_key='s')
+        self.assertEqual((cached.status, cached.report_path), (ReportJob.DONE, job.report_path))
+        self.assertEqual(self.executor.submit.call_count, 1)
+
+    def test_jobs_per_session(self):
+        jobs.submit(self.query, self.results, [], session_key='s')
+        with self.assertRaises(jobs.TooManyJobs):
+            jobs.submit(self.query, self.results, ['pearson'], session_key='s')
+        jobs.submit(self.query, self.results, [], session_key='other')
+
+    def test_expired_results(self):
+        job = ReportJob.objects.create(query=self.query, results_key='missing')
+        with self.assertLogs('queries.jobs', 'ERROR'):
+            jobs.run(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.FAILED)
+        self.assertIn('expired', job.error)
+
+    def test_cancel(self):
+        job = jobs.submit(self.query, self.results, [], session_key='s')
+        self.assertTrue(jobs.cancel(job))
+        self.assertEqual(job.status, ReportJob.CANCELLED)
+        jobs.run(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.CANCELLED)
+        self.assertFalse(jobs.cancel(job))
+
+
+class ReportCacheTests(TemporaryStoreMixin, SimpleTestCase):
+
+    def test_frame_fingerprint(self):
+        df = pd.DataFrame({'id': ['a', 'b'], 'stops': [['1'], []], 'bearing': [1, 2]})
+        self.assertEqual(report_cache.frame_fingerprint(df), report_cache.frame_fingerprint(df.copy()))
+        changed = df.copy()
+        changed.loc[1, 'bearing'] = 3
+        self.assertNotEqual(report_cache.frame_fingerprint(df), report_cache.frame_fingerprint(changed))
+        self.assertNotEqual(report_cache.frame_fingerprint(df),
+                            report_cache.frame_fingerprint(df.astype({'bearing': 'float64'})))
+
+    def test_correlation_order_does_not_matter(self):
+        self.assertEqual(report_cache.fingerprint('f', ['pearson', 'kendall']),
+                         report_cache.fingerprint('f', ['kendall', 'pearson']))
+        self.assertNotEqual(report_cache.fingerprint('f', ['pearson']), report_cache.fingerprint('f', []))
+
+    def test_least_recently_used_are_evicted(self):
+        old = report_cache.put('old', 'x' * 1000)
+        used = report_cache.put('used', 'y' * 1000)
+        for age, file_path in ((200, old), (100, used)):
+            past = time.time() - age
+            os.utime(file_path, (past, past))
+        self.assertEqual(report_cache.get('used'), used)  # now the most recently used
+        with override_settings(REPORT_CACHE_MAX_BYTES=os.path.getsize(old) + os.path.getsize(used)):
+            report_cache.put('new', 'z' * 1000)
+        self.assertIsNone(report_cache.get('old'))
+        self.assertIsNotNone(report_cache.get('used'))
+        self.assertIsNotNone(report_cache.get('new'))
+
+
+class QueryPlanTests(TestCase):
+
+    def setUp(self):
+        self.objects = make_params()
+        self.query = make_query(self.objects['Vehicle'], includes=['route'], attributes=['label', 'long_name'],
+                                filters=[('route', 'Red')])
+
+    def plan(self) -> dict:
+        return Query.objects.get(pk=self.query.pk).get_plan()
+
+    def params(self) -> list:
+        return [tuple(param) for param in self.plan()['params']]
+
+    def test_plan(self):
+        plan = self.plan()
+        self.assertEqual(plan['path'], '/vehicles')
+        self.assertEqual(plan['cache_ttl'], 60)
+        self.assertEqual(self.params(), [
+            ('include', 'route'),
+            ('filter[route]', 'Red'),
+            ('fields[vehicle]', 'label'),
+            ('fields[route]', 'long_name'),
+        ])
+        self.assertEqual(plan['schema']['vehicle']['updated_at'], 'datetime')
+
+    def test_plan_is_stored(self):
+        self.plan()
+        query = Query.objects.get(pk=self.query.pk)
+        with self.assertNumQueries(0):
+            query.get_plan()
+
+    def test_compiled_with_a_fixed_number_of_queries(self):
+        query = Query.objects.get(pk=self.query.pk)
+        with self.assertNumQueries(8):
+            query.compile_plan()
+        make_query(self.objects['Vehicle'], includes=['route', 'trip'], filters=[('route', 'Red'), ('direction_id', '0')])
+        query = Query.objects.latest('pk')
+        with self.assertNumQueries(8):
+            query.compile_plan()
+
+    def assert_recompiled(self, change):
+        self.plan()
+        change()
+        self.assertEqual(Query.objects.get(pk=self.query.pk).plan, '')
+
+    def test_includes_change(self):
+        self.assert_recompiled(lambda: self.query.includes.add(MbtaInclude.objects.get(name='trip')))
+        self.assertEqual(self.params()[0], ('include', 'route,trip'))
+
+    def test_attributes_change(self):
+        self.assert_recompiled(lambda: self.query.attributes.remove(MbtaAttribute.objects.get(name='long_name')))
+        self.assertIn(('fields[route]', ''), self.params())
+
+    def test_filters_change(self):
+        self.assert_recompiled(lambda: self.query.filters.update_or_create(
+            on_attribute=MbtaFilter.objects.get(name='route'), defaults={'values': 'Blue'}))
+        self.assertIn(('filter[route]', 'Blue'), self.params())
+        self.assert_recompiled(lambda: self.query.filters.get().delete())
+        self.assertNotIn('filter[route]', dict(self.params()))
+
+    def test_object_change(self):
+        def change():
+            vehicle = self.objects['Vehicle']
+            vehicle.cache_ttl = 5
+            vehicle.save()
+        self.assert_recompiled(change)
+        self.assertEqual(self.plan()['cache_ttl'], 5)
+
+    def test_params_change(self):
+        self.assert_recompiled(lambda: MbtaAttribute.objects.create(
+            for_object=self.objects['Route'], name='text_color', required=False, data_type='string'))
+        self.assert_recompiled(lambda: MbtaInclude.objects.get(name='route').save())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FetchResultsTests(FakeApiMixin, TemporaryStoreMixin, TestCase):
+    """ Getting results from the fake API """
+
+    def setUp(self):
+        super().setUp()
+        override = override_settings(MBTA_API_ROOT=self.api_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        caches[settings.MBTA_API_CACHE_ALIAS].clear()
+        self.query = make_query(make_params()['Vehicle'])
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+
+    def test_single_response(self):
+        results = self.query.fetch_results(self.request)
+        self.assertIsNone(results.error)
+        self.assertEqual(len(results.df), 5)
+        self.assertEqual(self.query.requests.get().response_status_code, 200)
+
+    @override_settings(MBTA_API_PAGE_SIZE=2, MBTA_API_PAGE_WORKERS=2)
+    def test_pages(self):
+        results = self.query.fetch_results(self.request)
+        self.assertIsNone(results.error)
+        expected = Results(self.query, upstream.get(f'{self.api_root}/vehicles')).df
+        pd.testing.assert_frame_equal(results.df, expected)
+        self.assertEqual(len(json.loads(results.content)), 3)
+        api_request = self.query.requests.get()
+        self.assertEqual((api_request.response_status_code, api_request.cache_misses), (200, 3))
+
+    def test_timings_are_recorded(self):
+        self.query.fetch_results(self.request)
+        stages = self.query.requests.get().get_timings()
+        self.assertEqual(list(stages), [s for s in timings.STAGES if s in stages])
+        for stage in ('ttfb', 'download', 'decode', 'flatten', 'optimize'):
+            self.assertIn(stage, stages)
+
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        response = self.client.get(reverse('queries:request-timings'))
+        self.assertEqual(response.context['summary'][0]['object'], 'Vehicle')
+
+    def test_shared_results_are_recorded(self):
+        self.request.session = {}
+        fetched = self.query.get_results(self.request)
+        shared = self.query.get_results(self.request)
+        self.assertEqual(shared.key, fetched.key)
+        hit, miss = self.query.requests.order_by('-pk')
+        self.assertEqual((miss.cache_hits, miss.cache_misses), (0, 1))
+        self.assertEqual((hit.cache_hits, hit.cache_misses), (1, 0))
+        self.assertEqual(hit.response_size_bytes, miss.response_size_bytes)
+        self.assertEqual(list(hit.get_timings()), ['load'])
+
+    def test_page_offsets(self):
+        self.assertEqual(list(page_offsets({'last': '/vehicles?page[offset]=6&page[limit]=3'}, 3)), [3, 6])
+        self.assertEqual(list(page_offsets({'last': '/vehicles?page[offset]=0&page[limit]=3'}, 3)), [])
+        self.assertEqual(list(page_offsets({}, 3)), [])
+
+
+class LiveStreamTests(SimpleTestCase):
+    """ Applying events to a live stream, without its upstream thread """
+
+    def setUp(self):
+        self.stream = live.LiveStream('key', '/vehicles', {}, {}, 'vehicle')
+
+    def vehicle(self, id: str, label: str) -> dict:
+        return {'type': 'vehicle', 'id': id, 'attributes': {'label': label}}
+
+    def test_apply(self):
+        self.stream.apply('reset', [self.vehicle('1', 'a'), self.vehicle('2', 'b'), {'type': 'route', 'id': 'Red'}])
+        self.stream.apply('update', self.vehicle('1', 'c'))
+        self.stream.apply('add', self.vehicle('3', 'd'))
+        self.stream.apply('remove', {'type': 'vehicle', 'id': '2'})
+        self.stream.apply('add', {'type': 'route', 'id': 'Blue'})
+        self.assertEqual(self.stream.df['label'].to_dict(), {'1': 'c', '3': 'd'})
+        self.assertEqual(self.stream.version, 4)
+
+        with self.stream.condition:
+            self.assertIsNone(self.stream.changes_since(0))  # before the reset
+            self.assertEqual([c['op'] for c in self.stream.changes_since(1)], ['upsert', 'upsert', 'remove'])
+            self.assertEqual(self.stream.changes_since(4), [])
+
+    def test_subscribe(self):
+        self.stream.apply('reset', [self.vehicle('1', 'a')])
+        events = self.stream.subscribe()
+        self.assertTrue(next(events).startswith('event: snapshot\n'))
+        self.assertEqual(self.stream.subscribers, 1)
+        self.stream.apply('update', self.vehicle('1', 'b'))
+        delta = next(events)
+        self.assertTrue(delta.startswith('event: delta\n'))
+        self.assertIn('"label": "b"', delta)
+        events.close()
+        self.assertEqual(self.stream.subscribers, 0)
+
+    def test_unstarted_subscriber_is_not_counted(self):
+        self.stream.subscribe().close()
+        self.assertEqual(self.stream.subscribers, 0)
+        self.stream.idle_since -= settings.LIVE_STREAM_IDLE_SECONDS + 1
+        self.assertTrue(self.stream.should_stop())
+
+
+class FingerprintTests(SimpleTestCase):
+
+    def test_normalized(self):
+        self.assertEqual(
+            fingerprint(1, [3, 2], [5, 4], {7: 'b, a,a', 8: ''}),
+            fingerprint('1', ['2', '3'], ['4', '5'], {'7': ['a', 'b']}))
+        self.assertNotEqual(fingerprint(1, [2], [4], {7: 'a'}), fingerprint(1, [2], [4], {7: 'b'}))
+        self.assertNotEqual(fingerprint(1, [2], [4], {7: 'a'}), fingerprint(1, [2], [4], {8: 'a'}))
+        self.assertNotEqual(fingerprint(1, [2], [4], {}), fingerprint(1, [], [4], {}))
+
+    def test_repeated_filters_are_kept(self):
+        pairs = [(7, 'a'), (7, 'b')]
+        self.assertEqual(fingerprint(1, [], [], pairs), fingerprint(1, [], [], list(reversed(pairs))))
+        self.assertNotEqual(fingerprint(1, [], [], pairs), fingerprint(1, [], [], {7: 'b'}))
+        self.assertEqual(fingerprint(1, [], [], [(7, 'a')]), fingerprint(1, [], [], {7: 'a'}))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueryCreateTests(TestCase):
+
+    def setUp(self):
+        self.objects = make_params()
+        self.vehicle = self.objects['Vehicle']
+        self.route_filter = self.vehicle.filters.get(name='route')
+
+    def create(self, filters: dict, attributes=('label', 'bearing')) -> Query:
+        response = self.client.post(reverse('queries:create'), {
+            'primary_object': self.vehicle.pk,
+            'attributes': list(self.vehicle.attributes.filter(name__in=attributes).values_list('pk', flat=True)),
+            'includes': [],
+            'filters': json.dumps(filters),
+        })
+        self.assertEqual(response.status_code, 302)
+        return Query.objects.get(pk=response['Location'].rstrip('/').split('/')[-1])
+
+    def test_identical_queries_are_reused(self):
+        query = self.create({self.route_filter.pk: 'Red,Blue'})
+        self.assertEqual(query.fingerprint, query.compute_fingerprint())
+        self.assertEqual(self.create({self.route_filter.pk: ' Blue,Red,Red'}), query)
+        self.assertNotEqual(self.create({self.route_filter.pk: 'Red'}), query)
+        self.assertNotEqual(self.create({}, attributes=['label']), query)
+        self.assertEqual(Query.objects.count(), 3)
+
+    def test_concurrently_created_query_is_reused(self):
+        query = self.create({})
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=None):
+            self.assertEqual(self.create({}), query)
+        self.assertEqual(Query.objects.count(), 1)
+
+    def test_fingerprints_are_unique(self):
+        query = self.create({})
+        other = make_query(self.vehicle)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Query.objects.filter(pk=other.pk).update(fingerprint=query.fingerprint)
+        Query.objects.filter(pk=other.pk).update(fingerprint='')  # any number without one
+
+    def test_repeated_filters(self):
+        both = make_query(self.vehicle, filters=[('route', 'Red'), ('route', 'Blue')]).compute_fingerprint()
+        for values in ('Red', 'Blue'):
+            self.assertNotEqual(both, make_query(self.vehicle, filters=[('route', values)]).compute_fingerprint())
+
+    def test_migration_keeps_the_first_of_identical_queries(self):
+        migration = importlib.import_module('queries.migrations.0009_unique_query_fingerprint')
+        first, second = make_query(self.vehicle), make_query(self.vehicle)
+        migration.recompute_fingerprints(apps, None)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.fingerprint, second.fingerprint), (first.compute_fingerprint(), ''))
+
+
+class TimingsTests(SimpleTestCase):
+
+    def test_stages(self):
+        stages = timings.Timings()
+        with stages.stage('flatten'):
+            pass
+        stages.add({'decode': 0.5, 'flatten': 0.25})
+        stages.add(None)
+        self.assertEqual(list(stages.rounded()), ['decode', 'flatten'])
+        self.assertEqual(stages.rounded()['decode'], 0.5)
+        self.assertGreaterEqual(stages['flatten'], 0.25)
+
+    def test_summarize(self):
+        summary = timings.summarize([
+            ('Vehicle', {'decode': 1.0, 'flatten': 2.0}),
+            ('Vehicle', {'decode': 3.0}),
+            ('Alert', {'render': 1.0}),
+        ])
+        self.assertEqual([s['object'] for s in summary], ['Alert', 'Vehicle'])
+        vehicle = summary[1]
+        self.assertEqual(vehicle['count'], 2)
+        self.assertEqual([(s['stage'], s['count'], s['p50']) for s in vehicle['stages']],
+                         [('decode', 2, 2.0), ('flatten', 1, 2.0)])
+
+
+class BenchmarkTests(SimpleTestCase):
+
+    def test_compare(self):
+        baseline = {'seconds': 1.0, 'peak_bytes': 10 * 2 ** 20}
+        self.assertEqual(benchmark.compare(baseline, None, 0.25), ('-', False))
+        self.assertEqual(benchmark.compare({'seconds': 1.1, 'peak_bytes': 10 * 2 ** 20}, baseline, 0.25),
+                         ('+10% time +0% mem', False))
+        description, regressed = benchmark.compare({'seconds': 1.5, 'peak_bytes': 10 * 2 ** 20}, baseline, 0.25)
+        self.assertEqual((description, regressed), ('+50% time +0% mem REGRESSION', True))
+        _, regressed = benchmark.compare({'seconds': 1.0, 'peak_bytes': 20 * 2 ** 20}, baseline, 0.25)
+        self.assertTrue(regressed)
+
+    def test_small_changes_are_noise(self):
+        baseline = {'seconds': 0.001, 'peak_bytes': 1000}
+        self.assertEqual(benchmark.compare({'seconds': 0.002, 'peak_bytes': 3000}, baseline, 0.25),
+                         ('+100% time +200% mem', False))
+        self.assertEqual(benchmark.compare({'seconds': 0.0, 'peak_bytes': 0}, {'seconds': 0, 'peak_bytes': 0}, 0.25),
+                         ('+0% time +0% mem', False))
+
+    def test_baseline(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        options = dict(scenarios=['vehicle'], sizes=[10], stages=['decode', 'create_DataFrame'], repeat=1,
+                       baseline=os.path.join(directory, 'baseline.json'), stdout=io.StringIO(), stderr=io.StringIO())
+        with mock.patch.object(benchmarks, 'measure', return_value={'seconds': 1.0, 'peak_bytes': 0}):
+            call_command('benchmark', save_baseline=True, **options)
+            call_command('benchmark', **options)
+        with open(options['baseline']) as f:
+            saved = json.load(f)
+        self.assertEqual(saved['environment'], benchmarks.environment())
+        self.assertEqual(sorted(saved['measurements']), ['vehicle/10/create_DataFrame', 'vehicle/10/decode'])
+
+        with mock.patch.object(benchmarks, 'measure', return_value={'seconds': 2.0, 'peak_bytes': 0}):
+            with self.assertRaisesRegex(CommandError, '1 regression.*vehicle/10/decode'):
+                call_command('benchmark', **dict(options, stages=['decode']))
+
+
+class LoadTestTests(SimpleTestCase):
+
+    def test_failed_creates_back_off(self):
+        user = loadtest.VirtualUser('http://testserver', [], ['create'], [], seed=0)
+        outcomes = [None, None, None, 'url', None, 'url']
+        clock = [0.0]
+
+        def create_query():
+            if len(outcomes) == 1:
+                clock[0] = 60.0  # the deadline
+            return outcomes.pop(0)
+
+        delays = []
+        with mock.patch.object(user, 'create_query', side_effect=create_query), \
+                mock.patch.object(loadtest.time, 'sleep', side_effect=delays.append), \
+                mock.patch.object(loadtest.time, 'monotonic', side_effect=lambda: clock[0]):
+            user.run(60.0)
+        self.assertEqual(user.failures, 4)
+        self.assertEqual(len(delays), 4)
+        for delay, full in zip(delays, [0.1, 0.2, 0.4, 0.1]):
+            self.assertTrue(full / 2 <= delay <= full)
+
+    def test_summarize(self):
+        samples = [loadtest.Sample('create', 302, 0.1), loadtest.Sample('create', 0, 0.3),
+                   loadtest.Sample('results', 200, 0.2)]
+        summary = loadtest.summarize(samples, 2.0)
+        self.assertEqual([(s['endpoint'], s['requests'], s['errors']) for s in summary],
+                         [('create', 2, 1), ('results', 1, 0)])
+        self.assertEqual(summary[0]['throughput'], 1.0)
@@ -0,0 +1,78 @@
+"""
+Per-stage timings of getting a query's results, stored on its Request.
+
+- queue: waiting for the API's rate limit (see core.ratelimit)
+- connect: DNS lookups and TCP/TLS handshakes, when a new connection was needed
+- ttfb: from sending the request until the response headers arrived
+- download: reading the response body
+- load: loading results which were shared by an identical query (see Query.get_results)
+- decode: parsing the JSON document into column tables (see queries.ingest)
+- flatten: building DataFrames from the tables
+- joins: joining included resources (see queries.joins)
+- optimize: shrinking column dtypes (see queries.dtypes)
+- plots: building the location plots
+- render: rendering the results page
+
+Responses served from the response cache have no network stages. Pages which are
+fetched concurrently are summed, so a stage is the time spent on it, not the time the
+user waited for it.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+import numpy as np
+
+
+STAGES = [
+    'queue', 'connect', 'ttfb', 'download', 'load', 'decode', 'flatten', 'joins', 'optimize', 'plots', 'render',
+]
+PERCENTILES = [50, 95, 99]
+
+
+class Timings(OrderedDict):
+    """ Seconds spent in each stage """
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add({name: time.perf_counter() - started})
+
+    def add(self, timings: dict) -> None:
+        for name, seconds in (timings or {}).items():
+            self[name] = self.get(name, 0.0) + seconds
+
+    def rounded(self) -> OrderedDict:
+        """ In stage order, to the millisecond, for storing """
+        ordered = sorted(self, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES))
+        return OrderedDict((name, round(self[name], 3)) for name in ordered)
+
+
+def summarize(rows) -> list:
+    """ Percentiles of each stage per object, from (object name, timings dict) pairs.
+        Returns [{'object', 'count', 'stages': [{'stage', 'count', 'p50', 'p95', 'p99'}]}]. """
+    samples = OrderedDict()
+    for object_name, timings in rows:
+        stages = samples.setdefault(object_name, {'count': 0, 'stages': OrderedDict()})
+        stages['count'] += 1
+        for name, seconds in timings.items():
+            stages['stages'].setdefault(name, []).append(seconds)
+
+    summary = []
+    for object_name in sorted(samples):
+        stages = samples[object_name]['stages']
+        summary.append({
+            'object': object_name,
+            'count': samples[object_name]['count'],
+            'stages': [
+                dict(
+                    stage=name,
+                    count=len(stages[name]),
+                    **{f'p{p}': v for p, v in zip(PERCENTILES, np.percentile(stages[name], PERCENTILES))},
+                )
+                for name in STAGES if name in stages
+            ],
+        })
+    return summary
@@ -6,7 +6,17 @@ app_name = 'queries'
 urlpatterns = [
     path('create/', views.QueryCreate.as_view(), name='create'),
     path('requests/', views.RequestList.as_view(), name='request-list'),
+    path('requests/timings/', views.request_timings, name='request-timings'),
     path('results/<int:pk>/', views.QueryResults.as_view(), name='results'),
-    path('results/<int:pk>/csv/', views.results_as_csv, name='results-csv'),
-    path('results/<int:pk>/report/<str:correlations>/', views.results_create_report),
+    path('results/<int:pk>/rows/', views.results_rows, name='results-rows'),
+    path('results/<int:pk>/live/', views.results_live, name='results-live'),
+    path('results/<int:pk>/csv/', views.results_export, {'fmt': 'csv'}, name='results-csv'),
+    path('results/<int:pk>/jsonl/', views.results_export, {'fmt': 'jsonl'}, name='results-jsonl'),
+    path('results/<int:pk>/feather/', views.results_export, {'fmt': 'feather'}, name='results-feather'),
+    path('results/<int:pk>/parquet/', views.results_export, {'fmt': 'parquet'}, name='results-parquet'),
+    path('results/<int:pk>/json/', views.results_as_json, name='results-json'),
+    path('results/<int:pk>/report/', views.report_create, name='report-create'),
+    path('reports/<int:job_id>/', views.report_status, name='report-status'),
+    path('reports/<int:job_id>/cancel/', views.report_cancel, name='report-cancel'),
+    path('reports/<int:job_id>/html/', views.report_html, name='report-html'),
 ]
@@ -1,13 +1,28 @@
-from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.shortcuts import get_object_or_404, redirect, render
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse)
+from django.utils.cache import patch_vary_headers
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from django.views import generic
-from django.db import transaction
+from django.views.decorators.http import require_POST
+from django.db import IntegrityError, transaction
 from .forms import QueryForm
-from .models import Query, QueryFilter, Request
+from .models import Query, QueryFilter, ReportJob, Request
+from . import exports, jobs, live, result_store, timings
+from .fingerprint import fingerprint, normalize_values
+from params import catalog as params_catalog
 from params.models import MbtaFilter
+import datetime
+import gzip
 import json
-import logging
+import os
+
+
+MAX_ROWS_PER_WINDOW = 1000
+REPORT_CORRELATIONS = ['pearson', 'spearman', 'kendall', 'phi_k', 'cramers', 'recoded']
 
 
 class QueryCreate(generic.CreateView):
@@ -22,19 +37,39 @@ class QueryCreate(generic.CreateView):
         context['endpoints'] = {
             'params': {
                 'objects': reverse('params:objects'),
+                'catalog': reverse('params:catalog-version', kwargs={'version': params_catalog.get().version}),
             }
         }
         return context
 
     def form_valid(self, form):
-        with transaction.atomic():
-            filters = json.loads(form.cleaned_data['filters'])
-            self.object = form.save()
-            for id_, values in filters.items():
-                a = MbtaFilter.objects.get(pk=id_)
-                QueryFilter.objects.create(
-                    query=self.object, on_attribute=a, values=','.join(values))
-        return super(QueryCreate, self).form_valid(form)
+        """ A query identical to an existing one (see queries.fingerprint) isn't created
+            again: the existing one is used, along with its cached results and reports """
+        filters = json.loads(form.cleaned_data['filters'])
+        query_fingerprint = fingerprint(
+            form.cleaned_data['primary_object'].pk,
+            [x.pk for x in form.cleaned_data['includes']],
+            [x.pk for x in form.cleaned_data['attributes']],
+            filters,
+        )
+        self.object = Query.objects.filter(fingerprint=query_fingerprint).first()
+        if self.object is None:
+            try:
+                with transaction.atomic():
+                    self.object = form.save()
+                    for id_, values in filters.items():
+                        values = normalize_values(values)
+                        if values:
+                            a = MbtaFilter.objects.get(pk=id_)
+                            QueryFilter.objects.create(
+                                query=self.object, on_attribute=a, values=','.join(values))
+                    # Set last, since the signals clear it while the query is being put together
+                    self.object.fingerprint = query_fingerprint
+                    Query.objects.filter(pk=self.object.pk).update(fingerprint=query_fingerprint)
+            except IntegrityError:
+                # The same query was submitted concurrently, and the other request won
+                self.object = Query.objects.get(fingerprint=query_fingerprint)
+        return HttpResponseRedirect(self.get_success_url())
 
     def get_success_url(self):
         return reverse('queries:results', kwargs={'pk': self.object.pk})
@@ -49,42 +84,207 @@ class RequestList(generic.ListView):
     paginate_by = 5
 
 
+@staff_member_required
+def request_timings(request):
+    """ Percentiles of the time spent in each stage of recent requests, per object
+        (see queries.timings). 'days' sets how far back to look (7 by default). """
+    try:
+        days = max(int(request.GET.get('days', 7)), 1)
+    except ValueError:
+        days = 7
+    since = timezone.now() - datetime.timedelta(days=days)
+    rows = Request.objects.filter(datetime__gte=since).exclude(timings='').values_list(
+        'query__primary_object__name', 'timings')
+    summary = timings.summarize((name, json.loads(stages)) for name, stages in rows.iterator())
+    return render(request, 'queries/request_timings.html', context={
+        'days': days,
+        'summary': summary,
+        'stages': timings.STAGES,
+    })
+
+
 class QueryResults(generic.DetailView):
     """ The 'Results' model (which is memory-only) actually drives the majority
         of what is seen in this view. It gets set up as part of get_context_data."""
     model = Query
     template_name = 'queries/results.html'
 
+    def get(self, request, *args, **kwargs):
+        """ Duplicates of a query are sent to the original, which has the cached results """
+        self.object = self.get_object()
+        canonical = self.object.canonical()
+        if canonical.pk != self.object.pk:
+            return redirect('queries:results', pk=canonical.pk)
+        context = self.get_context_data(object=self.object)
+        results = context['results']
+        if results.error is None and results.df is not None:
+            results.location_plots  # built here, so that it's timed apart from rendering
+        response = self.render_to_response(context)
+        if results.api_request is not None:
+            with results.timings.stage('render'):
+                response.render()
+            results.record_timings()
+        return response
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['results'] = context['query'].get_results(self.request)
-        context['report_correlations'] = ['pearson', 'spearman', 'kendall', 'phi_k', 'cramers', 'recoded']
+        context['report_correlations'] = REPORT_CORRELATIONS
+        context['live'] = context['query'].primary_object.name in settings.LIVE_STREAM_OBJECTS
         return context
 
 
-def results_as_csv(request, pk):
+def results_live(request, pk):
+    """ Live results, as server-sent events (see queries.live) """
+    query = get_object_or_404(Query.objects.select_related('primary_object'), pk=pk)
+    if query.primary_object.name not in settings.LIVE_STREAM_OBJECTS:
+        raise Http404(f'{query.primary_object} can not be streamed')
+    stream = live.get_stream(Request(query=query))
+    response = StreamingHttpResponse(stream.subscribe(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def results_rows(request, pk):
     """
-    For a given query, this will convert the pandas dataframe of results into
-    a CSV file and download it onto the user's device.
+    A sorted and filtered window of the results table, as JSON.
+    The table tab uses this for virtual scrolling, so the browser only holds the rows in view.
+    Parameters: offset, limit, sort (a column), order ('asc' or 'desc'), search, filter[<column>].
     """
     query = get_object_or_404(Query, pk=pk)
     results = query.get_results(request, get_from_cache=True)
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="mbta_api_query_{query.pk}.csv"'
-    results.df.to_csv(path_or_buf=response, index=False)
+    if results.df is None:
+        return JsonResponse({'error': results.error}, status=404)
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+        limit = min(max(int(request.GET.get('limit', 100)), 0), MAX_ROWS_PER_WINDOW)
+    except ValueError:
+        return JsonResponse({'error': 'offset and limit must be integers'}, status=400)
+    filters = {
+        key[len('filter['):-1]: value for key, value in request.GET.items()
+        if key.startswith('filter[') and key.endswith(']')
+    }
+    window = results.rows(
+        offset=offset,
+        limit=limit,
+        sort=request.GET.get('sort'),
+        descending=(request.GET.get('order') == 'desc'),
+        search=request.GET.get('search', ''),
+        filters=filters,
+    )
+    return JsonResponse(window)
+
+
+def results_export(request, pk, fmt):
+    """
+    For a given query, this will stream the pandas dataframe of results as a
+    CSV, JSON Lines, Feather or Parquet file and download it onto the user's device.
+    """
+    query = get_object_or_404(Query, pk=pk)
+    results = query.get_results(request, get_from_cache=True)
+    if results.df is None:
+        raise Http404('There are no results to export')
+    return exports.export(results, fmt, filename=f'mbta_api_query_{query.pk}')
+
+
+def results_as_json(request, pk):
+    """
+    The raw JSON response for a query, served straight from the result store.
+    It gets pretty-printed by the browser, so the server never has to decode it again.
+    """
+    query = get_object_or_404(Query, pk=pk)
+    results = query.get_results(request, get_from_cache=True)
+    path = result_store.content_path(results.key)
+    if path is None:
+        raise Http404('No response content is stored for this query')
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = FileResponse(open(path, 'rb'), content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(results.content, content_type='application/json')
+    patch_vary_headers(response, ['Accept-Encoding'])
     return response
 
 
-def results_create_report(request, pk, correlations):
-    """ Generates a pandas profiling report. Spits back the HTML for the entire doc.
-        Unfortunately this includes all the bootstrap stuff, so it's huge.
-        Gotta embed it in an iframe """
+@require_POST
+def report_create(request, pk):
+    """ Queues a pandas profiling report for the query's results. The report is generated
+        by a background worker; the page polls report_status until it's ready. """
     query = get_object_or_404(Query, pk=pk)
     results = query.get_results(request, get_from_cache=True)
-    correlations = None if correlations == 'NONE' else correlations.split(',')
+    if results.df is None:
+        return JsonResponse({'error': 'There are no results to report on'}, status=404)
+    correlations = [c for c in request.POST.getlist('correlations') if c in REPORT_CORRELATIONS]
+    if not request.session.session_key:
+        request.session.save()
     try:
-        report = results.generate_report_html(correlations=correlations)
-        return HttpResponse(report)
-    except Exception as e:
-        logging.exception(f'Error creating profile report: {e}')
-        return HttpResponse(status=500)
+        job = jobs.submit(
+            query,
+            results,
+            correlations,
+            user=request.user if request.user.is_authenticated else None,
+            session_key=request.session.session_key,
+        )
+    except jobs.TooManyJobs as e:
+        return JsonResponse({'error': str(e)}, status=429)
+    return JsonResponse(report_status_data(job), status=(200 if job.status == ReportJob.DONE else 202))
+
+
+def report_status(request, job_id):
+    """ The status of a report job, as JSON """
+    job = get_object_or_404(ReportJob, pk=job_id)
+    jobs.expire_if_stale(job)
+    return JsonResponse(report_status_data(job))
+
+
+@require_POST
+def report_cancel(request, job_id):
+    job = get_object_or_404(ReportJob, pk=job_id)
+    if not owns_job(request, job):
+        return JsonResponse({'error': 'Only the user who requested a report can cancel it'}, status=403)
+    jobs.cancel(job)
+    return JsonResponse(report_status_data(job))
+
+
+def report_html(request, job_id):
+    """ Spits back the HTML for the entire report doc.
+        Unfortunately this includes all the bootstrap stuff, so it's huge.
+        Gotta embed it in an iframe.
+        Reports are content-addressed, so the file name doubles as an ETag. """
+    job = get_object_or_404(ReportJob, pk=job_id, status=ReportJob.DONE)
+    etag = '"{}"'.format(os.path.basename(job.report_path).split('.')[0])
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    else:
+        try:
+            if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+                response = FileResponse(open(job.report_path, 'rb'), content_type='text/html')
+                response['Content-Encoding'] = 'gzip'
+            else:
+                with gzip.open(job.report_path, 'rb') as f:
+                    response = HttpResponse(f.read(), content_type='text/html')
+        except FileNotFoundError:
+            raise Http404('This report has been evicted from the cache, please generate it again')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=86400'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def report_status_data(job: ReportJob) -> dict:
+    return {
+        'id': job.pk,
+        'status': job.status,
+        'progress': job.progress,
+        'error': job.error,
+        'status_url': reverse('queries:report-status', kwargs={'job_id': job.pk}),
+        'cancel_url': reverse('queries:report-cancel', kwargs={'job_id': job.pk}),
+        'html_url': reverse('queries:report-html', kwargs={'job_id': job.pk}) if job.status == ReportJob.DONE else None,
+    }
+
+
+def owns_job(request, job: ReportJob) -> bool:
+    if request.user.is_authenticated:
+        return job.user_id == request.user.pk
+    return bool(job.session_key) and job.session_key == request.session.session_key